@@ -0,0 +1,148 @@
+"""
+Load test of the email send endpoint served by WSGI sync workers versus ASGI.
+
+Three servers are started in turn with the same number of worker processes: gunicorn sync workers
+on the sync endpoint, uvicorn on the sync endpoint (run on Django's thread pool) and uvicorn on
+the async endpoint. Each one receives the same number of requests from the same number of
+concurrent clients. SendGrid is replaced by a local aiohttp stand-in answering after a fixed
+latency, so the numbers show how many slow provider calls a process keeps in flight.
+
+Needs the servers and aiohttp installed: pip install -r requirements-dev.txt
+
+Run with: python -m benchmarks.asgi_load [requests] [concurrency] [latency_ms] [workers]
+"""
+import os
+import sys
+import time
+import uuid
+import socket
+import asyncio
+import subprocess
+import multiprocessing
+from statistics import quantiles
+
+import httpx
+from aiohttp import web
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start.")
+
+
+def serve_sendgrid(port, latency):
+    """
+    SendGrid stand-in accepting every mail send after `latency` seconds.
+    """
+    async def mail_send(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.Response(status=202)
+
+    app = web.Application()
+    app.router.add_post("/v3/mail/send", mail_send)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+async def load(url, requests, concurrency):
+    """
+    Send `requests` POSTs with `concurrency` in flight and return the elapsed time and latencies.
+    """
+    headers = {"Authorization": "Bearer benchmark"}
+    latencies = list()
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def client_loop(client):
+        while not queue.empty():
+            queue.get_nowait()
+            # A unique idempotency key per request, so no send is suppressed as a duplicate.
+            body = {"payload": [{
+                "to": ["user@example.com"], "subject": "Benchmark", "message": "<p>Benchmark</p>",
+                "idempotency_key": uuid.uuid4().hex,
+            }]}
+            started = time.perf_counter()
+            response = await client.post(url, json=body, headers=headers)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        return time.perf_counter() - started, latencies
+
+
+def measure(name, command, path, env, requests, concurrency):
+    port = free_port()
+    server = subprocess.Popen(
+        [arg.format(port=port) for arg in command],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        # Warm up the workers before measuring.
+        asyncio.run(load(f"http://127.0.0.1:{port}{path}", concurrency, concurrency))
+        elapsed, latencies = asyncio.run(load(f"http://127.0.0.1:{port}{path}", requests, concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+    percentiles = quantiles(latencies, n=100)
+    print(
+        f"{name:>28}: {requests / elapsed:8.1f} req/s, "
+        f"p50 {percentiles[49] * 1000:7.1f} ms, p99 {percentiles[98] * 1000:7.1f} ms"
+    )
+
+
+def run(requests, concurrency, latency, workers):
+    sendgrid_port = free_port()
+    sendgrid = multiprocessing.Process(target=serve_sendgrid, args=(sendgrid_port, latency), daemon=True)
+    sendgrid.start()
+    wait_for_port(sendgrid_port)
+
+    env = dict(
+        os.environ,
+        DJANGO_SETTINGS_MODULE="notification_service.settings",
+        API_KEY="benchmark",
+        SENDGRID_API_KEY="SG.benchmark",
+        SENDGRID_SENDER_EMAIL="sender@example.com",
+        SENDGRID_API_HOST=f"http://127.0.0.1:{sendgrid_port}",
+    )
+    gunicorn = [
+        sys.executable, "-m", "gunicorn", "notification_service.wsgi:application",
+        "--bind", "127.0.0.1:{port}", "--workers", str(workers), "--worker-class", "sync",
+    ]
+    uvicorn = [
+        sys.executable, "-m", "uvicorn", "notification_service.asgi:application",
+        "--host", "127.0.0.1", "--port", "{port}", "--workers", str(workers), "--no-access-log",
+    ]
+
+    print(f"{requests} requests, {concurrency} concurrent, {latency * 1000:.0f} ms provider latency, {workers} workers")
+    measure("gunicorn sync, sync view", gunicorn, "/api/send/email/sendgrid/", env, requests, concurrency)
+    measure("uvicorn, sync view", uvicorn, "/api/send/email/sendgrid/", env, requests, concurrency)
+    measure("uvicorn, async view", uvicorn, "/api/send/email/sendgrid/async/", env, requests, concurrency)
+
+    sendgrid.terminate()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+        float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.1,
+        int(sys.argv[4]) if len(sys.argv) > 4 else 2,
+    )
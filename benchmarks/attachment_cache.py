@@ -0,0 +1,55 @@
+"""
+Benchmark of building SMTP emails that share one attachment with and without the attachment cache.
+
+Only message preparation is measured (what send_smtp_email_batch does before talking to the
+server): time and peak memory, as reported by tracemalloc, to build every EmailMessage.
+
+Run with: python -m benchmarks.attachment_cache [emails] [attachment_mb]
+"""
+import os
+import sys
+import time
+import base64
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_service.settings')
+django.setup()
+
+from email_service import smtp as smtp_module  # noqa: E402
+from email_service.attachments import AttachmentCache  # noqa: E402
+
+
+def measure(name, emails, file_content, cache):
+    smtp_module.attachment_cache = cache
+    # Every payload item carries its own copy of the base64 string, as after JSON parsing.
+    payloads = [
+        {"file_name": "report.pdf", "file": (file_content + " ")[:-1]}
+        for _ in range(emails)
+    ]
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    messages = [
+        smtp_module._build_smtp_message([f"user{index}@example.com"], "Report", "<p>Report</p>", attachments=[attachment])
+        for index, attachment in enumerate(payloads)
+    ]
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:>16}: {elapsed * 1000:8.1f} ms, peak {peak / 1024 / 1024:8.1f} MB for {len(messages)} emails")
+
+
+def run(emails, attachment_mb):
+    file_content = base64.b64encode(os.urandom(int(attachment_mb * 1024 * 1024))).decode()
+    measure("no cache", emails, file_content, AttachmentCache(max_bytes=0))
+    measure("attachment cache", emails, file_content, AttachmentCache())
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
@@ -0,0 +1,191 @@
+"""
+Benchmark of the firebase_admin batch path versus the FCM v1 sender multiplexed over HTTP/2.
+
+FCM is replaced by local stand-ins: an HTTP/1.1 server answering the multipart batch endpoint
+used by messaging.send_multicast, and a cleartext HTTP/2 server (h2) answering messages:send.
+Every HTTP request is answered after the same simulated FCM latency, so the numbers reflect
+request multiplexing and client overhead only, not TLS or real FCM processing.
+
+Run with: python -m benchmarks.fcm_v1 [tokens] [latency_ms]
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_service.settings')
+django.setup()
+
+import firebase_admin  # noqa: E402
+import google.oauth2.credentials  # noqa: E402
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+from firebase_admin import credentials, messaging  # noqa: E402
+
+from push_notifications import fcm_v1 as fcm_v1_module  # noqa: E402
+from push_notifications import firebase as firebase_module  # noqa: E402
+
+
+class NoDeadTokens:
+    """
+    Dead token registry stand-in that keeps the benchmark off the database.
+    """
+
+    def filter(self, tokens):
+        return tokens, []
+
+    def add_from_result(self, tokens, responses):
+        pass
+
+
+class StaticCredential(credentials.Base):
+    """
+    Firebase credential with a fixed access token, so no OAuth request is made.
+    """
+
+    def get_credential(self):
+        return google.oauth2.credentials.Credentials("benchmark")
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    """
+    Answers the FCM batch endpoint with one successful response per sub-request.
+    """
+
+    latency = 0.0
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        time.sleep(self.latency)
+        content_ids = re.findall(r"Content-ID: <([^>]+)>", body, re.IGNORECASE)
+        parts = [
+            "--batch_benchmark\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id}>\r\n\r\n"
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f'{{"name": "projects/benchmark/messages/{index}"}}\r\n'
+            for index, content_id in enumerate(content_ids)
+        ]
+        response = ("".join(parts) + "--batch_benchmark--\r\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/mixed; boundary=batch_benchmark")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class H2Protocol(asyncio.Protocol):
+    """
+    Cleartext HTTP/2 server answering every messages:send request with a message name.
+    """
+
+    latency = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        self.connection.initiate_connection()
+        self.transport.write(self.connection.data_to_send())
+
+    def data_received(self, data):
+        for event in self.connection.receive_data(data):
+            if isinstance(event, h2.events.DataReceived):
+                self.connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.get_running_loop().call_later(self.latency, self.respond, event.stream_id)
+        self.transport.write(self.connection.data_to_send())
+
+    def respond(self, stream_id):
+        body = json.dumps({"name": f"projects/benchmark/messages/{stream_id}"}).encode()
+        self.connection.send_headers(stream_id, [
+            (":status", "200"),
+            ("content-type", "application/json"),
+            ("content-length", str(len(body))),
+        ])
+        self.connection.send_data(stream_id, body, end_stream=True)
+        self.transport.write(self.connection.data_to_send())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_batch(port, latency, ready):
+    BatchHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", port), BatchHandler)
+    ready.set()
+    server.serve_forever()
+
+
+def serve_h2(port, latency, ready):
+    H2Protocol.latency = latency
+
+    async def serve():
+        server = await asyncio.get_running_loop().create_server(H2Protocol, "127.0.0.1", port)
+        ready.set()
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def start_server(target, latency):
+    """
+    Run a stand-in in its own process, so it does not compete with the sender for the GIL.
+    """
+    port, ready = free_port(), multiprocessing.Event()
+    process = multiprocessing.Process(target=target, args=(port, latency, ready), daemon=True)
+    process.start()
+    ready.wait()
+    return process, port
+
+
+def measure(name, tokens, send):
+    device_tokens = [f"token-{index}" for index in range(tokens)]
+    started = time.perf_counter()
+    result = send("Benchmark", "Benchmark", {"key": "value"}, device_tokens, 1)
+    elapsed = time.perf_counter() - started
+    assert result.success_count == tokens, result.failed_tokens
+    print(f"{name:>24}: {tokens / elapsed:9.1f} messages/s ({elapsed * 1000:.1f} ms for {tokens} tokens)")
+
+
+def run(tokens, latency):
+    batch_server, batch_port = start_server(serve_batch, latency)
+    h2_server, h2_port = start_server(serve_h2, latency)
+
+    firebase_admin.initialize_app(StaticCredential(), {"projectId": "benchmark"}, name="[DEFAULT]")
+    messaging._MessagingService.FCM_BATCH_URL = f"http://127.0.0.1:{batch_port}/batch"
+    firebase_module.dead_token_registry = fcm_v1_module.dead_token_registry = NoDeadTokens()
+    fcm_v1_module._fcm_v1_sender = fcm_v1_module.FCMv1Sender(
+        "benchmark",
+        google.oauth2.credentials.Credentials("benchmark"),
+        url=f"http://127.0.0.1:{h2_port}/v1/projects/{{project_id}}/messages:send",
+        http2_prior_knowledge=True,
+    )
+
+    measure("firebase_admin batch", tokens, firebase_module.send_firebase_push_notification)
+    measure("FCM v1 over HTTP/2", tokens, fcm_v1_module.send_fcm_v1_push_notification)
+
+    batch_server.terminate()
+    h2_server.terminate()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+        float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02,
+    )
@@ -0,0 +1,76 @@
+"""
+Benchmark of SMTP sends with a new connection per email versus one pooled connection per payload list.
+
+Emails go to a local aiosmtpd stand-in (pip install -r requirements-dev.txt), so the numbers reflect connection
+setup and SMTP round trips only; against a real relay every new connection also pays for
+STARTTLS and AUTH.
+
+Run with: python -m benchmarks.smtp_connection [emails]
+"""
+import os
+import sys
+import time
+import socket
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_service.settings')
+django.setup()
+
+from aiosmtpd.controller import Controller  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from email_service.smtp import _build_smtp_message, send_smtp_email_batch, smtp_connection_pool  # noqa: E402
+
+
+class DiscardHandler:
+    """
+    Accepts and drops every message.
+    """
+
+    async def handle_DATA(self, server, session, envelope):
+        return "250 Message accepted for delivery"
+
+
+def payload(index):
+    return {"to": [f"user{index}@example.com"], "subject": "Benchmark", "message": "<p>Benchmark</p>"}
+
+
+def send_with_new_connection(payloads):
+    for item in payloads:
+        _build_smtp_message(item["to"], item["subject"], item["message"]).send()
+
+
+def measure(name, emails, send):
+    payloads = [payload(index) for index in range(emails)]
+    started = time.perf_counter()
+    send(payloads)
+    elapsed = time.perf_counter() - started
+    print(f"{name:>22}: {emails / elapsed:8.1f} emails/s ({elapsed * 1000 / emails:.2f} ms/email)")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(emails):
+    controller = Controller(DiscardHandler(), hostname="127.0.0.1", port=free_port())
+    controller.start()
+    settings.EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+    settings.EMAIL_HOST = controller.hostname
+    settings.EMAIL_PORT = controller.port
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_HOST_USER = ""
+    settings.EMAIL_HOST_PASSWORD = ""
+
+    measure("connection per email", emails, send_with_new_connection)
+    measure("pooled connection", emails, send_smtp_email_batch)
+
+    smtp_connection_pool.close_all()
+    controller.stop()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
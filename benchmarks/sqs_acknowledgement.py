@@ -0,0 +1,83 @@
+"""
+Benchmark comparing the SQS calls needed to acknowledge delivered notifications.
+
+The legacy path received a message with VisibilityTimeout=0 and scanned it for the
+receipt handle before deleting it; the acknowledger deletes by receipt handle in batches.
+
+Run with: python -m benchmarks.sqs_acknowledgement [notifications]
+"""
+import os
+import sys
+import random
+from collections import Counter
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_service.settings')
+django.setup()
+
+from utilities.sqs import SQSAcknowledger  # noqa: E402
+from utilities.queue_backends import SQSQueueBackend  # noqa: E402
+
+
+class CountingSQSClient:
+    """
+    Fake SQS client holding in-flight messages and counting every API call.
+    """
+
+    def __init__(self, receipt_handles):
+        self.in_flight = set(receipt_handles)
+        self.calls = Counter()
+
+    def receive_message(self, **kwargs):
+        self.calls["receive_message"] += 1
+        if not self.in_flight:
+            return {"Messages": []}
+        receipt_handle = random.choice(tuple(self.in_flight))
+        return {"Messages": [{"ReceiptHandle": receipt_handle, "Body": "{}"}]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.calls["delete_message"] += 1
+        self.in_flight.discard(ReceiptHandle)
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.calls["delete_message_batch"] += 1
+        for entry in Entries:
+            self.in_flight.discard(entry["ReceiptHandle"])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries], "Failed": []}
+
+
+def legacy_acknowledge(client, receipt_handle):
+    """
+    The receive-and-scan acknowledgement that GetSQSDataAPIView used before.
+    """
+    response = client.receive_message(MaxNumberOfMessages=1, VisibilityTimeout=0, WaitTimeSeconds=0)
+    for message in response.get("Messages", []):
+        if message["ReceiptHandle"] == receipt_handle:
+            client.delete_message(QueueUrl=None, ReceiptHandle=receipt_handle)
+
+
+def run(notifications):
+    receipt_handles = [f"receipt-{index}" for index in range(notifications)]
+
+    legacy_client = CountingSQSClient(receipt_handles)
+    for receipt_handle in receipt_handles:
+        legacy_acknowledge(legacy_client, receipt_handle)
+
+    batched_client = CountingSQSClient(receipt_handles)
+    acknowledger = SQSAcknowledger(backend=SQSQueueBackend(client=batched_client, queue_url="local"), flush_interval=0)
+    for receipt_handle in receipt_handles:
+        acknowledger.acknowledge(receipt_handle)
+    acknowledger.flush()
+
+    for name, client in (("receive-and-scan", legacy_client), ("batched delete", batched_client)):
+        total_calls = sum(client.calls.values())
+        print(
+            f"{name:>16}: {total_calls} SQS calls, "
+            f"{total_calls / notifications:.2f} calls/notification, "
+            f"{len(client.in_flight)} messages left to be redelivered"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
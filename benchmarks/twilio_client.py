@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of SMS sends per second with a new Twilio client per send versus the cached client.
+
+Twilio API calls are redirected to a local HTTP/1.1 keep-alive stand-in, so the numbers only
+reflect client construction and connection setup, not Twilio's own latency. Against the real
+API the gap is larger, as every new connection also pays for a TLS handshake.
+
+Run with: python -m benchmarks.twilio_client [sends]
+"""
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_service.settings')
+os.environ.setdefault('TWILIO_ACCOUNT_SID', 'ACbenchmark')
+os.environ.setdefault('TWILIO_AUTH_TOKEN', 'benchmark')
+os.environ.setdefault('TWILIO_PHONE_NUMBER', '+15005550006')
+django.setup()
+
+from twilio.rest import Client  # noqa: E402
+
+from sms_service import twilio as twilio_module  # noqa: E402
+
+
+class TwilioStandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request like the Twilio Messages API does for a queued message.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"sid": "SMbenchmark", "status": "queued"}).encode()
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def local_http_client_class(base_url):
+    class LocalTwilioHttpClient(twilio_module.DeadlineTwilioHttpClient):
+        """
+        Sends the requests meant for api.twilio.com to the local stand-in.
+        """
+
+        def request(self, method, url, *args, **kwargs):
+            url = url.replace("https://api.twilio.com", base_url)
+            return super().request(method, url, *args, **kwargs)
+
+    return LocalTwilioHttpClient
+
+
+def send_with_new_client(http_client_class):
+    client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"), http_client=http_client_class())
+    client.messages.create(body="benchmark", from_=os.getenv("TWILIO_PHONE_NUMBER"), to="+15005550001")
+
+
+def measure(name, sends, send):
+    started = time.perf_counter()
+    for _ in range(sends):
+        send()
+    elapsed = time.perf_counter() - started
+    print(f"{name:>18}: {sends / elapsed:8.1f} sends/s ({elapsed * 1000 / sends:.2f} ms/send)")
+
+
+def run(sends):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TwilioStandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_client_class = local_http_client_class(f"http://127.0.0.1:{server.server_port}")
+
+    measure("client per send", sends, lambda: send_with_new_client(http_client_class))
+
+    # get_twilio_client builds its clients with DeadlineTwilioHttpClient, drop any client built before the swap.
+    twilio_module.DeadlineTwilioHttpClient = http_client_class
+    twilio_module._twilio_clients.clear()
+    measure("cached client", sends, lambda: twilio_module.send_twilio_sms("benchmark", "+15005550001"))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
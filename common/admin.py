@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import NotificationLog
+
+
+@admin.register(NotificationLog)
+class NotificationLogAdmin(admin.ModelAdmin):
+    list_display = ("channel", "provider", "status", "attempt", "latency", "created_at")
+    list_filter = ("channel", "provider", "status")
+    search_fields = ("recipient_hash", "provider_message_id")
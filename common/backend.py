@@ -0,0 +1,191 @@
+from asgiref.sync import sync_to_async
+
+from utilities.utils import logger
+from utilities.sqs import decode_message_body
+from utilities.retry import dead_letter, schedule_retry
+from utilities.deadline import request_deadline
+from .delivery_log import delivery_attempt
+from push_notifications.views import SendPushAPIView
+from email_service.views import SendEmailAPIView
+from sms_service.views import SmsServiceAPIView
+
+
+class QueueMessageService:
+    @staticmethod
+    def load_message(message_body):
+        """
+        Decode the body of a queued notification message.
+
+        Compressed bodies are inflated and offloaded ones are fetched back from the blob store.
+
+        :param message_body: The JSON string stored in the queue message.
+        :return: Dictionary with provider_type, service_type and service_data.
+        """
+        return decode_message_body(message_body)
+
+    @staticmethod
+    def dispatch(request_data):
+        """
+        Send a queued notification through the service of its channel.
+
+        Parts that failed with a retryable error are re-enqueued with a backoff and a message that
+        failed for good goes to the dead-letter queue, see settle. The message is sent under a
+        request deadline, the parts left without time are deferred the same way, and its sends are
+        logged as the attempt of the message.
+
+        :param request_data: Decoded queue message with provider_type, service_type and service_data.
+        :return: A tuple (success, errors) where success tells if the message was processed and
+                 can be removed from the queue, and errors holds the failure details if any.
+        """
+        with request_deadline(), delivery_attempt(request_data.get("attempt", 1)):
+            return QueueMessageService._dispatch(request_data)
+
+    @staticmethod
+    def _dispatch(request_data):
+        service_type = request_data.get("service_type")
+        provider_type = request_data.get("provider_type")
+        service_data = request_data.get("service_data")
+        logger.info(f"Dispatching queued {service_type} message via {provider_type}.")
+
+        try:
+            if service_type == "push":
+                push_view = SendPushAPIView()
+                try:
+                    result = push_view.send_push_service(provider_type, service_data)
+                except Exception as e:
+                    result = e
+                return QueueMessageService.settle(
+                    request_data, *QueueMessageService.push_outcome(push_view, service_data, provider_type, result)
+                )
+
+            if service_type == "sms":
+                sms_view = SmsServiceAPIView()
+                sms_view.send_sms_service(provider_type, service_data)
+                return QueueMessageService.settle(request_data, *QueueMessageService.sms_outcome(sms_view))
+
+            if service_type == "email":
+                email_view = SendEmailAPIView()
+                response = email_view.send_email_service(provider_type, service_data)
+                return QueueMessageService.settle(
+                    request_data, *QueueMessageService.email_outcome(email_view, service_data, response)
+                )
+
+        except Exception as e:
+            logger.error(f"Failed to dispatch queued {service_type} message: {str(e)}")
+            return False, str(e)
+
+        logger.error(f"Unrecognized service type in queued message: {service_type}")
+        return False, f"Unrecognized service type: {service_type}"
+
+    @staticmethod
+    async def dispatch_async(request_data):
+        """
+        Async version of dispatch, sending through the async provider clients.
+
+        :return: A tuple (success, errors), as dispatch.
+        """
+        with request_deadline(), delivery_attempt(request_data.get("attempt", 1)):
+            return await QueueMessageService._dispatch_async(request_data)
+
+    @staticmethod
+    async def _dispatch_async(request_data):
+        service_type = request_data.get("service_type")
+        provider_type = request_data.get("provider_type")
+        service_data = request_data.get("service_data")
+        logger.info(f"Dispatching queued {service_type} message via {provider_type}.")
+
+        try:
+            if service_type == "push":
+                push_view = SendPushAPIView()
+                try:
+                    result = await push_view.send_push_service_async(provider_type, service_data)
+                except Exception as e:
+                    result = e
+                outcome = QueueMessageService.push_outcome(push_view, service_data, provider_type, result)
+
+            elif service_type == "sms":
+                sms_view = SmsServiceAPIView()
+                await sms_view.send_sms_service_async(provider_type, service_data)
+                outcome = QueueMessageService.sms_outcome(sms_view)
+
+            elif service_type == "email":
+                email_view = SendEmailAPIView()
+                response = await email_view.send_email_service_async(provider_type, service_data)
+                outcome = QueueMessageService.email_outcome(email_view, service_data, response)
+
+            else:
+                outcome = None
+
+            if outcome is not None:
+                errors, retry_payload, failed = outcome
+                if not retry_payload and not failed:
+                    return True, errors
+                return await sync_to_async(QueueMessageService.settle, thread_sensitive=False)(request_data, *outcome)
+
+        except Exception as e:
+            logger.error(f"Failed to dispatch queued {service_type} message: {str(e)}")
+            return False, str(e)
+
+        logger.error(f"Unrecognized service type in queued message: {service_type}")
+        return False, f"Unrecognized service type: {service_type}"
+
+    @staticmethod
+    def email_outcome(email_view, service_data, response):
+        """
+        Outcome of a queued email, as the (errors, retry_payload, failed) arguments of settle.
+        """
+        email_view.record_send_failures([(service_data, service_data)], [response])
+        errors = email_view.failed_payload[0]["errors"] if email_view.failed_payload else None
+        return errors, email_view.retry_payload, bool(email_view.failed_payload)
+
+    @staticmethod
+    def sms_outcome(sms_view):
+        """
+        Outcome of a queued SMS. Numbers rejected by the provider will not succeed on redelivery, they are reported only.
+        """
+        return sms_view.failed_messages_response_list or None, sms_view.retry_payload, False
+
+    @staticmethod
+    def push_outcome(push_view, service_data, provider_type, result):
+        """
+        Outcome of a queued push notification, failed for good when it raised an error that is not retryable.
+        """
+        push_view.record_result(provider_type, service_data, service_data, result)
+        errors = push_view.failed_payload[0]["errors"] if push_view.failed_payload else None
+        return errors, push_view.retry_payload, isinstance(result, Exception) and not push_view.retry_payload
+
+    @staticmethod
+    def settle(request_data, errors, retry_payload, failed):
+        """
+        Settle a dispatched message: re-enqueue the parts that failed with a retryable error after
+        their backoff (or dead-letter them once out of attempts), and dead-letter a message that
+        failed for good as a whole.
+
+        Every part is scheduled before the message is judged. The message is only redelivered when
+        nothing of it was sent, its single retry part being the whole message: once a retry is on
+        the queue or part of the message went out, the dedupe store would suppress the redelivery
+        or it would send that part again, so the parts that could not be scheduled are
+        dead-lettered on their own instead.
+
+        :param errors: Errors of the parts that failed for good.
+        :param retry_payload: List of (item, service_data, error) tuples of the parts to retry.
+        :param failed: Whether the whole message failed for good.
+        :return: A tuple (success, errors) as dispatch; success is False if nothing was sent, the
+                 retry could not be moved to the queue and the message must be redelivered.
+        """
+        if failed:
+            return dead_letter(request_data, errors), errors
+        unscheduled = [
+            (service_data, error)
+            for _, service_data, error in retry_payload
+            if schedule_retry({**request_data, "service_data": service_data}, error) is None
+        ]
+        if not unscheduled:
+            return True, errors
+        nothing_sent = len(retry_payload) == 1 and retry_payload[0][1] == request_data.get("service_data")
+        if nothing_sent:
+            return False, unscheduled[0][1]
+        for service_data, error in unscheduled:
+            if not dead_letter({**request_data, "service_data": service_data}, error):
+                logger.error(f"Dropped the retry of a {request_data.get('service_type')} message part: {error}")
+        return True, errors
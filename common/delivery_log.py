@@ -0,0 +1,162 @@
+import os
+import atexit
+import hashlib
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from utilities.utils import logger
+from utilities.retry import DeferredError, get_retry_policy
+from .models import NotificationLog
+
+
+# Delivery log entries written to the database in one bulk insert.
+DELIVERY_LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", 200))
+# Seconds an entry waits in the buffer at most before it is written.
+DELIVERY_LOG_FLUSH_INTERVAL = float(os.getenv("DELIVERY_LOG_FLUSH_INTERVAL", 2.0))
+
+# Attempt of the notification being sent, set while a queue message is dispatched.
+_attempt = ContextVar("delivery_attempt", default=1)
+
+
+def hash_recipient(recipient):
+    """
+    SHA-256 of a recipient (email address, phone number or device token), the form recipients are logged in.
+    """
+    return hashlib.sha256(str(recipient).strip().lower().encode()).hexdigest()
+
+
+def delivery_status(provider_type, error):
+    """
+    Status of a send that raised error (None for a successful send) with the given provider.
+    """
+    if error is None:
+        return NotificationLog.SENT
+    if isinstance(error, DeferredError):
+        return NotificationLog.DEFERRED
+    if get_retry_policy(provider_type).is_retryable(error):
+        return NotificationLog.RETRYING
+    return NotificationLog.FAILED
+
+
+@contextmanager
+def delivery_attempt(attempt):
+    """
+    Context manager logging the sends made within it as the given attempt of their notification.
+    """
+    token = _attempt.set(attempt)
+    try:
+        yield
+    finally:
+        _attempt.reset(token)
+
+
+class DeliveryLogBuffer:
+    """
+    In-process buffer of NotificationLog entries, written with bulk_create once `batch_size`
+    entries are pending or `flush_interval` seconds have passed since the first one.
+
+    The writes run on a timer thread, so adding entries never costs the sending thread or event
+    loop a database round trip. Entries that cannot be written are dropped with an error.
+    """
+
+    def __init__(self, batch_size=DELIVERY_LOG_BATCH_SIZE, flush_interval=DELIVERY_LOG_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = list()
+        self._lock = threading.Lock()
+        self._timer = None
+        self._flush_due = False
+
+    def add(self, entries):
+        """
+        Buffer unsaved NotificationLog entries to be written.
+        """
+        with self._lock:
+            self._pending.extend(entries)
+            if len(self._pending) >= self.batch_size:
+                if not self._flush_due:
+                    self._start_timer(0)
+            elif self._timer is None and self.flush_interval > 0:
+                self._start_timer(self.flush_interval)
+
+    def flush(self):
+        """
+        Write every pending entry right away.
+        """
+        with self._lock:
+            entries = self._take_pending()
+        self._write(entries)
+
+    def _start_timer(self, delay):
+        # Called with the lock held.
+        if self._timer is not None:
+            self._timer.cancel()
+        self._flush_due = delay == 0
+        self._timer = threading.Timer(delay, self._flush_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread ends here, its database connection would otherwise stay open.
+            connections.close_all()
+
+    def _take_pending(self):
+        entries, self._pending = self._pending, list()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._flush_due = False
+        return entries
+
+    def _write(self, entries):
+        if not entries:
+            return
+        try:
+            NotificationLog.objects.bulk_create(entries, batch_size=self.batch_size)
+        except Exception as e:
+            logger.error(f"Failed to write {len(entries)} delivery log entries: {e}")
+
+
+delivery_log_buffer = DeliveryLogBuffer()
+atexit.register(delivery_log_buffer.flush)
+
+
+def log_delivery(channel, provider, recipients, error=None, provider_message_id=None, latency=None):
+    """
+    Log the outcome of a send to every recipient of recipients, through the shared delivery log buffer.
+
+    :param channel: "email", "sms" or "push".
+    :param provider: Provider the send was made with.
+    :param recipients: Email addresses, phone numbers or device tokens the send was made to.
+    :param error: Error the send failed with, None if it succeeded.
+    :param provider_message_id: Id the provider gave the sent message, if any.
+    :param latency: Seconds the provider took to answer, None if it was not called.
+    """
+    if not getattr(settings, "DELIVERY_LOG_ENABLED", True):
+        return
+    status = delivery_status(provider, error)
+    if status == NotificationLog.DEFERRED:
+        latency = None
+    attempt = _attempt.get()
+    created_at = timezone.now()
+    delivery_log_buffer.add([
+        NotificationLog(
+            channel=channel,
+            provider=provider,
+            recipient_hash=hash_recipient(recipient),
+            status=status,
+            provider_message_id=provider_message_id or "",
+            latency=latency,
+            attempt=attempt,
+            created_at=created_at,
+        )
+        for recipient in recipients
+    ])
@@ -0,0 +1,45 @@
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from common.worker import SQSWorker
+
+
+class Command(BaseCommand):
+    """
+    Command for consuming queued notifications without the Lambda and HTTP hops.
+    """
+
+    help = "Long-poll the queue and send the queued notifications in-process."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=int(os.getenv("SQS_WORKER_CONCURRENCY", 10)),
+            help="Maximum number of messages processed at the same time.",
+        )
+        parser.add_argument(
+            "--visibility-timeout", type=int, default=int(os.getenv("SQS_WORKER_VISIBILITY_TIMEOUT", 60)),
+            help="Seconds a received message stays hidden, extended while its send is running.",
+        )
+        parser.add_argument("--wait-time", type=int, default=20, help="Long polling wait time in seconds.")
+        parser.add_argument("--max-messages", type=int, default=10, help="Messages requested per receive call.")
+        parser.add_argument(
+            "--lane-wait-time", type=int, default=int(os.getenv("SQS_WORKER_LANE_WAIT_TIME", 2)),
+            help="Longest wait on the critical lane when every lane is empty, before polling the lower lanes again.",
+        )
+
+    def handle(self, *args, **options):
+        worker = SQSWorker(
+            concurrency=options["concurrency"],
+            wait_time=options["wait_time"],
+            max_messages=options["max_messages"],
+            visibility_timeout=options["visibility_timeout"],
+            lane_wait_time=options["lane_wait_time"],
+        )
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+
+        self.stdout.write(f"Starting SQS worker with concurrency {options['concurrency']}.")
+        worker.run()
+        self.stdout.write("SQS worker stopped.")
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.7 on 2026-10-18 17:59
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('email', 'Email'), ('sms', 'Sms'), ('push', 'Push')], max_length=16)),
+                ('provider', models.CharField(max_length=32)),
+                ('recipient_hash', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('deferred', 'Deferred')], db_index=True, max_length=16)),
+                ('provider_message_id', models.CharField(blank=True, max_length=255)),
+                ('latency', models.FloatField(blank=True, null=True)),
+                ('attempt', models.PositiveSmallIntegerField(default=1)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -1,3 +1,38 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class NotificationLog(models.Model):
+    """
+    Outcome of a send of a notification to one recipient, written in batches by the delivery log.
+    """
+    SENT = "sent"
+    FAILED = "failed"
+    RETRYING = "retrying"
+    DEFERRED = "deferred"
+    STATUS_CHOICES = (
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+        (RETRYING, "Retrying"),
+        (DEFERRED, "Deferred"),
+    )
+    CHANNEL_CHOICES = (
+        ("email", "Email"),
+        ("sms", "Sms"),
+        ("push", "Push"),
+    )
+
+    channel = models.CharField(max_length=16, choices=CHANNEL_CHOICES)
+    provider = models.CharField(max_length=32)
+    # SHA-256 of the email address, phone number or device token, so no recipient is stored
+    recipient_hash = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, db_index=True)
+    provider_message_id = models.CharField(max_length=255, blank=True)
+    # seconds the provider took to answer, null when the provider was not called
+    latency = models.FloatField(null=True, blank=True)
+    attempt = models.PositiveSmallIntegerField(default=1)
+    # time of the send rather than of the write, the log being written in batches
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.channel} via {self.provider}: {self.status}"
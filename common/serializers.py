@@ -0,0 +1,17 @@
+from rest_framework import serializers
+
+
+class SQSRecordSerializer(serializers.Serializer):
+    """
+    Serializer for a single SQS record forwarded by the queue consumer.
+    """
+    message_id = serializers.CharField(allow_null=False, allow_blank=False)
+    json_string = serializers.CharField(allow_null=False, allow_blank=False)
+    receipt_handle = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+
+
+class SQSRecordBatchSerializer(serializers.Serializer):
+    """
+    Serializer for a batch of SQS records forwarded by the queue consumer.
+    """
+    records = serializers.ListField(child=SQSRecordSerializer(), allow_empty=False)
@@ -1,7 +1,10 @@
 from django.urls import path
-from .views import GetSQSDataAPIView
+from .views import AsyncGetSQSDataAPIView, ConcurrencyLimitsAPIView, GetSQSDataAPIView, GetSQSDataBulkAPIView
 
 
 urlpatterns = [
     path('getSQSData', GetSQSDataAPIView.as_view(), name='get-sqs-data'),
+    path('getSQSData/async', AsyncGetSQSDataAPIView.as_view(), name='get-sqs-data-async'),
+    path('getSQSData/bulk', GetSQSDataBulkAPIView.as_view(), name='get-sqs-data-bulk'),
+    path('concurrencyLimits', ConcurrencyLimitsAPIView.as_view(), name='concurrency-limits'),
 ]
@@ -1,23 +1,26 @@
-import json
-
+from adrf.generics import GenericAPIView as AsyncGenericAPIView
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.generics import (
     CreateAPIView,
+    GenericAPIView,
 )
 from rest_framework import serializers
 from rest_framework.response import Response
 
 from utilities.utils import (
+    logger,
     ResponseInfo,
 )
 from utilities import messages
+from utilities.constants import DEFAULT_PRIORITY
 from utilities.permissions import (
     IsAuthenticatedPermission,
 )
-from utilities.sqs import receiver_message_sqs
-from push_notifications.views import SendPushAPIView
-from email_service.views import SendEmailAPIView
-from sms_service.views import SmsServiceAPIView
+from utilities.sqs import acknowledge_message_sqs, release_message_body
+from utilities.concurrency import concurrency_stats
+from .backend import QueueMessageService
+from .serializers import SQSRecordBatchSerializer
 
 
 class GetSQSDataAPIView(CreateAPIView):
@@ -41,24 +44,129 @@ class GetSQSDataAPIView(CreateAPIView):
         """
         POSt Method to get data from SQS.
         """
-        print("Data HERE", request.data)
-        request_data = json.loads(request.data["json_string"])
+        logger.debug(f"Received SQS message: {request.data}")
+        request_data = QueueMessageService.load_message(request.data["json_string"])
         receipt_handle = request.data["receipt_handle"]
 
-        if request_data["service_type"] == "push":
-            SendPushAPIView().send_push_service(request_data["provider_type"], request_data["service_data"])
-            receiver_message_sqs(receipt_handle)
+        success, errors = QueueMessageService.dispatch(request_data)
+        if success:
+            acknowledge_message_sqs(receipt_handle, request_data.get("priority", DEFAULT_PRIORITY), request.data["json_string"])
+
+        self.response_format["data"] = None
+        self.response_format["error"] = errors
+        self.response_format["status_code"] = status.HTTP_200_OK
+        self.response_format["message"] = [messages.SUCCESS if success else messages.FAILURE]
+        return Response(self.response_format)
 
-        if request_data["service_type"] == "sms":
-            SmsServiceAPIView().send_sms_service(request_data["provider_type"], request_data["service_data"])
-            receiver_message_sqs(receipt_handle)
 
-        if request_data["service_type"] == "email":
-            SendEmailAPIView().send_email_service(request_data["provider_type"], request_data["service_data"])
-            receiver_message_sqs(receipt_handle)
+class AsyncGetSQSDataAPIView(AsyncGenericAPIView, GetSQSDataAPIView):
+    """
+    Class for creating api for getting data for scheduler, served on the ASGI event loop.
+    """
+
+    async def post(self, request, *args, **kwargs):
+        """
+        POST Method to dispatch an SQS message through the async provider clients.
+        """
+        logger.debug(f"Received SQS message: {request.data}")
+        request_data = QueueMessageService.load_message(request.data["json_string"])
+        receipt_handle = request.data["receipt_handle"]
+
+        success, errors = await QueueMessageService.dispatch_async(request_data)
+        if success:
+            await sync_to_async(acknowledge_message_sqs, thread_sensitive=False)(
+                receipt_handle, request_data.get("priority", DEFAULT_PRIORITY), request.data["json_string"]
+            )
 
         self.response_format["data"] = None
+        self.response_format["error"] = errors
+        self.response_format["status_code"] = status.HTTP_200_OK
+        self.response_format["message"] = [messages.SUCCESS if success else messages.FAILURE]
+        return Response(self.response_format)
+
+
+class GetSQSDataBulkAPIView(CreateAPIView):
+    """
+    Class for creating api for processing a whole batch of SQS records in one request.
+    """
+
+    permission_classes = (IsAuthenticatedPermission,)
+    authentication_classes = ()
+    serializer_class = SQSRecordBatchSerializer
+
+    def __init__(self, **kwargs):
+        """
+        Constructor function for formatting the web response to return.
+        """
+        self.response_format = ResponseInfo().response
+        self.pagination = None
+        super(GetSQSDataBulkAPIView, self).__init__(**kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """
+        POST Method to dispatch every SQS record of a batch to its channel.
+
+        Records are not deleted here, the consumer reports the failed message ids back to SQS
+        as batchItemFailures so only those are redelivered.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = list()
+        for record in serializer.validated_data["records"]:
+            try:
+                request_data = QueueMessageService.load_message(record["json_string"])
+                success, errors = QueueMessageService.dispatch(request_data)
+            except (ValueError, TypeError, AttributeError, OSError) as e:
+                logger.error(f"Invalid SQS record {record['message_id']}: {str(e)}")
+                success, errors = False, messages.INVALID_MESSAGE_CONTENT
+
+            results.append({
+                "message_id": record["message_id"],
+                "success": success,
+                "errors": errors,
+            })
+
+        # The consumer deletes the successful records, their offloaded bodies are not needed anymore.
+        for record, result in zip(serializer.validated_data["records"], results):
+            if result["success"]:
+                release_message_body(record["json_string"])
+
+        failed_ids = [result["message_id"] for result in results if not result["success"]]
+        logger.info(f"Processed {len(results)} SQS records, {len(failed_ids)} failed.")
+
+        self.response_format["data"] = {
+            "results": results,
+            "batch_item_failures": [{"itemIdentifier": message_id} for message_id in failed_ids],
+        }
         self.response_format["error"] = None
         self.response_format["status_code"] = status.HTTP_200_OK
         self.response_format["message"] = [messages.SUCCESS]
         return Response(self.response_format)
+
+
+class ConcurrencyLimitsAPIView(GenericAPIView):
+    """
+    Class for creating api for reading the adaptive concurrency limits of the providers in this process.
+    """
+
+    permission_classes = (IsAuthenticatedPermission,)
+    authentication_classes = ()
+    serializer_class = serializers.Serializer
+
+    def __init__(self, **kwargs):
+        """
+        Constructor function for formatting the web response to return.
+        """
+        self.response_format = ResponseInfo().response
+        super(ConcurrencyLimitsAPIView, self).__init__(**kwargs)
+
+    def get(self, request, *args, **kwargs):
+        """
+        GET Method listing, per provider, the current limit, the calls in flight and waiting and the usual latency.
+        """
+        self.response_format["data"] = concurrency_stats()
+        self.response_format["error"] = None
+        self.response_format["status_code"] = status.HTTP_200_OK
+        self.response_format["message"] = [messages.LIST_FETCHED_SUCCESS.format("Concurrency limit")]
+        return Response(self.response_format)
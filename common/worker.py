@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities.sqs import SQSAcknowledger
+from utilities.queue_backends import get_queue_lanes
+from utilities.constants import DEFAULT_PRIORITY
+from utilities.utils import logger
+from .backend import QueueMessageService
+
+
+# Seconds the worker pauses after a failed receive, doubled on each consecutive failure up to RECEIVE_ERROR_MAX_BACKOFF.
+RECEIVE_ERROR_BACKOFF = float(os.getenv("RECEIVE_ERROR_BACKOFF", 1))
+RECEIVE_ERROR_MAX_BACKOFF = float(os.getenv("RECEIVE_ERROR_MAX_BACKOFF", 30))
+
+
+class SQSWorker:
+    """
+    Long-running consumer that long-polls the queue and dispatches notifications in-process.
+
+    - Polls with WaitTimeSeconds/MaxNumberOfMessages, only asking for as many messages as there are free slots.
+    - Drains the priority lanes in order: a lower lane is only polled when every higher lane is empty.
+    - Runs up to `concurrency` sends at a time on a thread pool.
+    - Extends the visibility of messages whose send is still running before they time out.
+    - Backs off exponentially while the queue cannot be read, instead of polling it in a loop.
+    - On stop(), stops polling, finishes the in-flight messages and flushes pending deletes.
+    """
+
+    def __init__(self, backend=None, concurrency=10, wait_time=20, max_messages=10, visibility_timeout=60, lanes=None, lane_wait_time=2):
+        """
+        :param backend: Single queue backend to consume, instead of every priority lane.
+        :param lanes: List of (priority, backend) tuples, highest priority first; defaults to the
+                      configured priority lanes.
+        :param lane_wait_time: Longest wait on the highest lane when every lane is empty, so the
+                               lower lanes are polled again at least that often.
+        """
+        if lanes is None:
+            lanes = [(DEFAULT_PRIORITY, backend)] if backend is not None else get_queue_lanes()
+        self.lanes = lanes
+        self.backends = dict(lanes)
+        self.concurrency = concurrency
+        self.wait_time = wait_time
+        self.max_messages = max_messages
+        self.visibility_timeout = visibility_timeout
+        self.lane_wait_time = lane_wait_time
+        self.acknowledgers = {priority: SQSAcknowledger(backend=lane_backend) for priority, lane_backend in lanes}
+
+        self._stopping = threading.Event()
+        self._condition = threading.Condition()
+        # receipt handle -> (monotonic time at which the message becomes visible again, priority lane)
+        self._in_flight = dict()
+
+    def stop(self, *args):
+        """
+        Ask the worker to stop polling and drain the in-flight messages.
+        """
+        logger.info("Queue worker is stopping, draining in-flight messages.")
+        self._stopping.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def run(self):
+        """
+        Poll the queue until stop() is called.
+        """
+        logger.info(f"Queue worker started with concurrency {self.concurrency}.")
+        heartbeat = threading.Thread(target=self._extend_visibility_loop, daemon=True)
+        heartbeat.start()
+
+        receive_errors = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stopping.is_set():
+                free_slots = self._wait_for_free_slots()
+                if free_slots == 0:
+                    continue
+
+                try:
+                    priority, messages = self._receive(free_slots)
+                except Exception as e:
+                    backoff = min(RECEIVE_ERROR_BACKOFF * 2 ** receive_errors, RECEIVE_ERROR_MAX_BACKOFF)
+                    receive_errors += 1
+                    logger.error(f"{e}, retrying in {backoff:g} seconds.")
+                    self._stopping.wait(backoff)
+                    continue
+                receive_errors = 0
+                for message in messages:
+                    with self._condition:
+                        self._in_flight[message["ReceiptHandle"]] = (time.monotonic() + self.visibility_timeout, priority)
+                    executor.submit(self._process, message, priority)
+
+        for acknowledger in self.acknowledgers.values():
+            acknowledger.flush()
+        logger.info("Queue worker stopped.")
+
+    def _receive(self, max_messages):
+        """
+        Receive messages from the highest priority lane that has some.
+
+        :return: A tuple (priority, messages).
+        """
+        if len(self.lanes) > 1:
+            for priority, backend in self.lanes:
+                messages = backend.receive_messages(
+                    max_messages=max_messages, wait_time=0, visibility_timeout=self.visibility_timeout,
+                )
+                if messages:
+                    return priority, messages
+
+        # Every lane is empty, wait on the highest one and come back to the others regularly.
+        priority, backend = self.lanes[0]
+        wait_time = self.wait_time if len(self.lanes) == 1 else min(self.wait_time, self.lane_wait_time)
+        return priority, backend.receive_messages(
+            max_messages=max_messages, wait_time=wait_time, visibility_timeout=self.visibility_timeout,
+        )
+
+    def _wait_for_free_slots(self):
+        with self._condition:
+            while len(self._in_flight) >= self.concurrency and not self._stopping.is_set():
+                self._condition.wait()
+            if self._stopping.is_set():
+                return 0
+            return min(self.max_messages, self.concurrency - len(self._in_flight))
+
+    def _process(self, message, priority):
+        receipt_handle = message["ReceiptHandle"]
+        try:
+            request_data = QueueMessageService.load_message(message["Body"])
+            success, errors = QueueMessageService.dispatch(request_data)
+            if success:
+                self.acknowledgers[priority].acknowledge(receipt_handle, message["Body"])
+            else:
+                # Left on the queue, it becomes visible again once the visibility timeout expires.
+                logger.error(f"Failed to process queue message {message.get('MessageId')}: {errors}")
+        except Exception as e:
+            logger.error(f"Invalid queue message {message.get('MessageId')}: {str(e)}")
+        finally:
+            with self._condition:
+                self._in_flight.pop(receipt_handle, None)
+                self._condition.notify_all()
+
+    def _extend_visibility_loop(self):
+        interval = max(self.visibility_timeout / 3, 1)
+        while True:
+            time.sleep(interval)
+            if self._stopping.is_set() and not self._in_flight:
+                return
+            self._extend_visibility()
+
+    def _extend_visibility(self):
+        """
+        Extend the visibility of messages that would become visible within half a timeout.
+        """
+        now = time.monotonic()
+        expiring = dict()
+        with self._condition:
+            for receipt_handle, (visible_at, priority) in self._in_flight.items():
+                if visible_at - now < self.visibility_timeout / 2:
+                    expiring.setdefault(priority, list()).append(receipt_handle)
+                    self._in_flight[receipt_handle] = (now + self.visibility_timeout, priority)
+
+        for priority, receipt_handles in expiring.items():
+            self.backends[priority].change_visibility(receipt_handles, self.visibility_timeout)
+            logger.debug(f"Extended visibility of {len(receipt_handles)} {priority} messages.")
@@ -0,0 +1,139 @@
+import os
+import base64
+import hashlib
+import mimetypes
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+from utilities.utils import logger
+from utilities.storage import get_file_store
+
+
+# Decoded attachment bytes kept in memory for reuse, least recently used ones are evicted first.
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+@lru_cache(maxsize=256)
+def guess_content_type(file_name):
+    """
+    Infer the MIME type of an attachment from its file extension.
+    """
+    extension = file_name.rsplit('.', 1)[-1].lower()
+    content_type, _ = mimetypes.guess_type(f"file.{extension}")
+    return content_type or 'application/octet-stream'  # Default to 'application/octet-stream' if MIME type cannot be determined
+
+
+class DecodedAttachment:
+    """
+    Decoded content and MIME type of an attachment.
+    """
+
+    def __init__(self, file_name, content, content_type):
+        self.file_name = file_name
+        self.content = content
+        self.content_type = content_type
+
+
+class AttachmentCache:
+    """
+    LRU cache of decoded attachments keyed by the SHA-256 of their base64 content, or by their
+    file id for files uploaded to the file store. The base64 content of stored files, sent inline
+    to SendGrid, is cached by file id too.
+
+    The same file sent to many recipients is decoded once and every email references the same
+    bytes; the cache holds at most `max_bytes` of content, larger files are not cached.
+    """
+
+    def __init__(self, max_bytes=ATTACHMENT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, file_name, base64_data):
+        """
+        Return the decoded attachment, decoding and caching it on first use.
+
+        :raises ValueError: If the content is not valid base64.
+        """
+        key = hashlib.sha256(base64_data.encode()).digest()
+        content = self._lookup(key)
+        if content is None:
+            content = base64.b64decode(base64_data)
+            self._add(key, content)
+        return DecodedAttachment(file_name, content, guess_content_type(file_name))
+
+    def get_stored(self, file_name, file_id):
+        """
+        Return an attachment uploaded to the file store, reading and caching it on first use.
+
+        :raises FileNotFoundError: If no file has the given id.
+        """
+        content = self._lookup(file_id)
+        if content is None:
+            content = get_file_store().read(file_id)
+            self._add(file_id, content)
+        return DecodedAttachment(file_name, content, guess_content_type(file_name))
+
+    def get_encoded(self, file_id):
+        """
+        Return the base64 content of a file uploaded to the file store, as the SendGrid API takes it,
+        reading and encoding it on first use.
+
+        :raises FileNotFoundError: If no file has the given id.
+        """
+        key = ("base64", file_id)
+        encoded = self._lookup(key)
+        if encoded is None:
+            with get_file_store().open(file_id) as content:
+                encoded = base64.b64encode(content).decode()
+            self._add(key, encoded)
+        return encoded
+
+    def resolve(self, attachment):
+        """
+        Return the decoded content of an attachment payload, given inline as base64 or by file id.
+        """
+        if attachment.get('file_id'):
+            return self.get_stored(attachment['file_name'], attachment['file_id'])
+        return self.get(attachment['file_name'], attachment['file'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+            return content
+
+    def _add(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = content
+            self._size += len(content)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                logger.debug(f"Evicted a {len(evicted)} bytes attachment from the cache.")
+
+
+def encode_attachment(attachment):
+    """
+    Return the base64 content of an attachment payload, reading uploaded files from the file store.
+
+    :raises FileNotFoundError: If no file has the attachment's file id.
+    """
+    if attachment.get('file_id'):
+        return attachment_cache.get_encoded(attachment['file_id'])
+    return attachment['file']
+
+
+attachment_cache = AttachmentCache()
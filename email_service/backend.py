@@ -1,12 +1,28 @@
-from .sendgrid import send_sendgrid_email
-from .smtp import send_smtp_email
+import os
+import asyncio
+from asgiref.sync import sync_to_async
+
+from .sendgrid import send_sendgrid_email, send_sendgrid_email_batch
+from .sendgrid import send_sendgrid_email_async, send_sendgrid_email_batch_async
+from .smtp import send_smtp_email, send_smtp_email_batch
 from utilities.utils import logger
+from utilities.retry import DeferredError, failure_details
+from utilities.circuit_breaker import CircuitOpenError, get_circuit_breaker
+from utilities.concurrency import get_concurrency_limiter
+
+
+EMAIL_PROVIDERS = ('smtp', 'sendgrid')
+# Provider SendGrid emails fail over to while the SendGrid circuit is open, empty disables the failover.
+SENDGRID_FAILOVER_PROVIDER = os.getenv("SENDGRID_FAILOVER_PROVIDER", "smtp")
+EMAIL_FAILOVER_PROVIDERS = {'sendgrid': SENDGRID_FAILOVER_PROVIDER}
+
 
 class EmailService:
     @staticmethod
     def send_email(provider_type, to, subject=None, message=None, template_id=None, dynamic_template_data=None, cc=None, bcc=None, attachments=None):
         """
-        Sends an email using the specified provider (SMTP or SendGrid).
+        Sends an email using the specified provider (SMTP or SendGrid), or the provider it fails
+        over to while the circuit of the specified one is open.
         
         Parameters:
         - provider_type: The email provider to use ('smtp' or 'sendgrid').
@@ -25,37 +41,290 @@ class EmailService:
         - response_body: Message or error description.
         - headers: Any additional headers returned by the email service.
         """
+        try:
+            provider_type = EmailService.route(provider_type, template_id)
+        except CircuitOpenError as e:
+            return EmailService._circuit_open_response(e)
+        return EmailService._send_email(provider_type, to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments)
+
+    @staticmethod
+    def send_email_batch(provider_type, payloads):
+        """
+        Sends a list of emails, merging compatible ones into shared provider requests where possible.
+
+        For SendGrid, payloads with the same template (or the same subject and message when no template
+        is used) and the same attachments are sent as one request with a personalization per recipient.
+        For SMTP, every payload is sent over one pooled connection. Payloads are routed as in
+        send_email, so part of a batch may fail over to another provider.
+
+        Parameters:
+        - provider_type: The email provider to use ('smtp' or 'sendgrid').
+        - payloads: List of email payloads accepted by send_email.
+
+        Returns:
+        A list with one (success, response_body, headers) tuple per payload, in order.
+        """
+        responses, routes = EmailService._route_batch(provider_type, payloads)
+        for routed_provider, indexes in routes.items():
+            group_responses = EmailService._send_email_batch(routed_provider, [payloads[index] for index in indexes])
+            for index, response in zip(indexes, group_responses):
+                responses[index] = response
+        return responses
+
+    @staticmethod
+    async def send_email_async(provider_type, to, subject=None, message=None, template_id=None, dynamic_template_data=None, cc=None, bcc=None, attachments=None):
+        """
+        Async version of send_email. SendGrid emails are sent with the async HTTP client, SMTP
+        emails on a worker thread since the SMTP connection is blocking.
+
+        Returns:
+        A tuple (success, response_body, headers), as send_email.
+        """
+        try:
+            provider_type = EmailService.route(provider_type, template_id)
+        except CircuitOpenError as e:
+            return EmailService._circuit_open_response(e)
+        if provider_type != 'sendgrid':
+            return await sync_to_async(EmailService._send_email, thread_sensitive=False)(
+                provider_type, to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments
+            )
+        return await EmailService._send_sendgrid_email_async(to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments)
+
+    @staticmethod
+    async def send_email_batch_async(provider_type, payloads):
+        """
+        Async version of send_email_batch, sending the SendGrid requests of the batch concurrently.
+
+        Returns:
+        A list with one (success, response_body, headers) tuple per payload, in order.
+        """
+        async def send_routed(routed_provider, indexes):
+            routed_payloads = [payloads[index] for index in indexes]
+            if routed_provider != 'sendgrid':
+                return await sync_to_async(EmailService._send_email_batch, thread_sensitive=False)(routed_provider, routed_payloads)
+            return await EmailService._send_sendgrid_email_batch_async(routed_payloads)
+
+        responses, routes = EmailService._route_batch(provider_type, payloads)
+        results = await asyncio.gather(*(send_routed(routed_provider, indexes) for routed_provider, indexes in routes.items()))
+        for indexes, group_responses in zip(routes.values(), results):
+            for index, response in zip(indexes, group_responses):
+                responses[index] = response
+        return responses
+
+    @staticmethod
+    def route(provider_type, template_id=None):
+        """
+        Provider to send an email with: provider_type while its circuit lets calls through, else
+        the provider it fails over to, if that one can send the email and its circuit is closed.
+        SMTP cannot render SendGrid templates, so templated emails do not fail over to it.
+
+        :raises CircuitOpenError: If no provider can send the email now.
+        """
+        if provider_type not in EMAIL_PROVIDERS or get_circuit_breaker(provider_type).allow_request():
+            return provider_type
+        failover_provider = EMAIL_FAILOVER_PROVIDERS.get(provider_type)
+        if failover_provider and not (failover_provider == 'smtp' and template_id) \
+                and get_circuit_breaker(failover_provider).allow_request():
+            logger.warning(f"Circuit of {provider_type} is open, sending with {failover_provider}.")
+            return failover_provider
+        raise CircuitOpenError(provider_type)
+
+    @staticmethod
+    def _route_batch(provider_type, payloads):
+        """
+        Route every payload of a batch.
+
+        :return: A tuple (responses, routes): a list with the failed response of the payloads no
+                 provider can send now and None for the others, and a dictionary of the indexes of
+                 the other payloads by the provider they are sent with.
+        """
+        responses = [None] * len(payloads)
+        routes = dict()
+        for index, payload in enumerate(payloads):
+            try:
+                routed_provider = EmailService.route(provider_type, payload.get('template_id'))
+            except CircuitOpenError as e:
+                responses[index] = EmailService._circuit_open_response(e)
+                continue
+            routes.setdefault(routed_provider, list()).append(index)
+        return responses, routes
+
+    @staticmethod
+    def _circuit_open_response(error):
+        logger.warning(f"Error in sending email: {error}")
+        return False, str(error), failure_details(error.name, error)
+
+    @staticmethod
+    def _deferred_response(provider_type, error):
+        logger.warning(f"Email via {provider_type} deferred to the queue: {error}")
+        return False, str(error), failure_details(provider_type, error)
+
+    @staticmethod
+    def _overloaded(responses):
+        """
+        Whether a provider call failed with a retryable error, telling the provider is overloaded.
+        Deferred sends never reached the provider.
+        """
+        return any(
+            not success and details and details.get('retryable') and not details.get('deferred')
+            for success, _, details in responses
+        )
+
+    @staticmethod
+    def _send_email(provider_type, to, subject=None, message=None, template_id=None, dynamic_template_data=None, cc=None, bcc=None, attachments=None):
+        """
+        Sends an email with the given provider, without routing.
+        """
         try:
             # Ensure lists are used for email addresses and attachments
-            if not isinstance(to, list):
-                to = [to]
-            if cc and not isinstance(cc, list):
-                cc = [cc]
-            if bcc and not isinstance(bcc, list):
-                bcc = [bcc]
-            if attachments and not isinstance(attachments, list):
-                attachments = [attachments]
+            to, cc, bcc, attachments = EmailService._as_lists(to, cc, bcc, attachments)
 
             # Log email sending details
             logger.info(f"Sending email. Provider: {provider_type}, To: {to}, Subject: {subject}")
 
             # Call the appropriate method based on the provider_type
             if provider_type == 'smtp':
-                response = EmailService._send_smtp_email(to, subject, message, cc, bcc, attachments)
+                with get_concurrency_limiter('smtp').slot() as call:
+                    response = EmailService._send_smtp_email(to, subject, message, cc, bcc, attachments)
+                    call.overloaded = EmailService._overloaded([response])
                 logger.info("SMTP email sent successfully.")
                 return response
             elif provider_type == 'sendgrid':
-                response = EmailService._send_sendgrid_email(to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments)
+                with get_concurrency_limiter('sendgrid').slot() as call:
+                    response = EmailService._send_sendgrid_email(to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments)
+                    call.overloaded = EmailService._overloaded([response])
                 logger.info("SendGrid email sent successfully.")
                 return response
             else:
                 # Handle invalid provider_type
                 raise ValueError("Invalid provider_type. Expected 'smtp' or 'sendgrid'.")
+        except DeferredError as e:
+            return EmailService._deferred_response(provider_type, e)
         except Exception as e:
             # Log any errors that occur
             logger.error(f"Error in sending email: {e}")
             return False, str(e), {}
 
+    @staticmethod
+    def _send_email_batch(provider_type, payloads):
+        """
+        Sends a list of emails with the given provider, without routing.
+        """
+        if provider_type == 'smtp':
+            logger.info(f"Sending {len(payloads)} emails over a shared SMTP connection.")
+            try:
+                with get_concurrency_limiter('smtp').slot() as call:
+                    responses = send_smtp_email_batch(payloads)
+                    call.overloaded = EmailService._overloaded(responses)
+            except DeferredError as e:
+                responses = [EmailService._deferred_response('smtp', e)] * len(payloads)
+            return responses
+        if provider_type != 'sendgrid':
+            return [EmailService._send_email(provider_type, **payload) for payload in payloads]
+
+        responses = [None] * len(payloads)
+        for indexes in EmailService._sendgrid_groups(payloads):
+            if len(indexes) == 1:
+                responses[indexes[0]] = EmailService._send_email(provider_type, **payloads[indexes[0]])
+                continue
+
+            logger.info(f"Sending {len(indexes)} emails in a merged SendGrid request.")
+            try:
+                with get_concurrency_limiter('sendgrid').slot() as call:
+                    group_responses = send_sendgrid_email_batch([payloads[index] for index in indexes])
+                    call.overloaded = EmailService._overloaded(group_responses)
+            except DeferredError as e:
+                group_responses = [EmailService._deferred_response('sendgrid', e)] * len(indexes)
+            except Exception as e:
+                logger.error(f"Error in sending email batch: {e}")
+                group_responses = [(False, str(e), {})] * len(indexes)
+            for index, response in zip(indexes, group_responses):
+                responses[index] = response
+        return responses
+
+    @staticmethod
+    async def _send_sendgrid_email_async(to, subject=None, message=None, template_id=None, dynamic_template_data=None, cc=None, bcc=None, attachments=None):
+        """
+        Sends an email with SendGrid's async HTTP client, without routing.
+        """
+        try:
+            to, cc, bcc, attachments = EmailService._as_lists(to, cc, bcc, attachments)
+            logger.info(f"Sending email. Provider: sendgrid, To: {to}, Subject: {subject}")
+            async with get_concurrency_limiter('sendgrid').slot_async() as call:
+                response = await send_sendgrid_email_async(to, subject, message, template_id, dynamic_template_data, cc, bcc, attachments)
+                call.overloaded = EmailService._overloaded([response])
+            return response
+        except DeferredError as e:
+            return EmailService._deferred_response('sendgrid', e)
+        except Exception as e:
+            logger.error(f"Error in sending email: {e}")
+            return False, str(e), {}
+
+    @staticmethod
+    async def _send_sendgrid_email_batch_async(payloads):
+        """
+        Sends a list of emails with SendGrid's async HTTP client, the requests of the batch concurrently.
+        """
+        async def send_group(indexes):
+            if len(indexes) == 1:
+                return [await EmailService._send_sendgrid_email_async(**payloads[indexes[0]])]
+            logger.info(f"Sending {len(indexes)} emails in a merged SendGrid request.")
+            try:
+                async with get_concurrency_limiter('sendgrid').slot_async() as call:
+                    group_responses = await send_sendgrid_email_batch_async([payloads[index] for index in indexes])
+                    call.overloaded = EmailService._overloaded(group_responses)
+                return group_responses
+            except DeferredError as e:
+                return [EmailService._deferred_response('sendgrid', e)] * len(indexes)
+            except Exception as e:
+                logger.error(f"Error in sending email batch: {e}")
+                return [(False, str(e), {})] * len(indexes)
+
+        groups = EmailService._sendgrid_groups(payloads)
+        responses = [None] * len(payloads)
+        for indexes, group_responses in zip(groups, await asyncio.gather(*(send_group(indexes) for indexes in groups))):
+            for index, response in zip(indexes, group_responses):
+                responses[index] = response
+        return responses
+
+    @staticmethod
+    def _as_lists(to, cc, bcc, attachments):
+        """
+        Wrap single email addresses and attachments in lists.
+        """
+        if not isinstance(to, list):
+            to = [to]
+        if cc and not isinstance(cc, list):
+            cc = [cc]
+        if bcc and not isinstance(bcc, list):
+            bcc = [bcc]
+        if attachments and not isinstance(attachments, list):
+            attachments = [attachments]
+        return to, cc, bcc, attachments
+
+    @staticmethod
+    def _sendgrid_groups(payloads):
+        """
+        Indexes of the payloads grouped by the SendGrid request they can share.
+        """
+        groups = dict()
+        for index, payload in enumerate(payloads):
+            groups.setdefault(EmailService._sendgrid_group_key(payload), list()).append(index)
+        return list(groups.values())
+
+    @staticmethod
+    def _sendgrid_group_key(payload):
+        """
+        Key of the payloads that can share one SendGrid request.
+        """
+        attachments = tuple(
+            (attachment['file_name'], attachment.get('file'), attachment.get('file_id'))
+            for attachment in payload.get('attachments') or []
+        )
+        if payload.get('template_id'):
+            return 'template', payload['template_id'], attachments
+        return 'content', payload.get('subject'), payload.get('message'), attachments
+
     @staticmethod
     def _send_smtp_email(to_emails, subject, message, cc_emails=None, bcc_emails=None, attachments=None):
         """
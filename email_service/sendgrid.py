@@ -1,113 +1,439 @@
 import os
+import time
+import asyncio
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Personalization, Content, Cc, Bcc, Attachment
 from sendgrid.helpers.mail import FileContent, FileName, FileType
 from utilities.utils import logger
+from utilities.retry import failure_details
+from utilities.circuit_breaker import record_call
+from utilities.rate_limit import get_rate_limiter, rate_limit_key
+from utilities.deadline import call_timeouts
+from utilities.async_http import get_async_client
+from common.delivery_log import log_delivery
+from .attachments import encode_attachment, guess_content_type
 
-def send_sendgrid_email(to_emails, subject, message, template_id, dynamic_data, cc_emails=None, bcc_emails=None, attachments=None):
+
+# Base URL of the SendGrid API.
+SENDGRID_API_HOST = os.getenv("SENDGRID_API_HOST", "https://api.sendgrid.com")
+# Timeouts in seconds for connecting to and reading from the SendGrid API.
+SENDGRID_CONNECT_TIMEOUT = float(os.getenv("SENDGRID_CONNECT_TIMEOUT", 5))
+SENDGRID_READ_TIMEOUT = float(os.getenv("SENDGRID_READ_TIMEOUT", 30))
+# Keep-alive connections kept open to the SendGrid API, shared by the sending threads.
+SENDGRID_POOL_SIZE = int(os.getenv("SENDGRID_POOL_SIZE", 32))
+# Mail send requests per second allowed for the SendGrid account across the workers of the box, 0 disables the cap.
+SENDGRID_REQUESTS_PER_SECOND = float(os.getenv("SENDGRID_REQUESTS_PER_SECOND", 0))
+# Most personalizations SendGrid accepts in a single mail send request.
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+# Most recipients (to, cc and bcc of every personalization) SendGrid accepts in a single mail send request.
+SENDGRID_MAX_RECIPIENTS = 1000
+
+
+class SendGridResponse:
     """
-    Sends an email using SendGrid's API.
-    
-    Parameters:
-    - to_emails: List of recipient email addresses.
-    - subject: Subject of the email (used if not using a template).
-    - message: Body of the email (used if not using a template).
-    - template_id: (Optional) ID of the SendGrid template to use.
-    - dynamic_data: (Optional) Data to populate dynamic fields in the SendGrid template.
-    - cc_emails: (Optional) List of CC email addresses.
-    - bcc_emails: (Optional) List of BCC email addresses.
-    - attachments: (Optional) List of dictionaries representing file attachments.
-    
-    Returns:
-    A tuple (status_code, response_body, response_headers) where:
-    - status_code: HTTP status code of the response.
-    - response_body: Body of the response.
-    - response_headers: Headers of the response.
+    Response of a SendGrid API call, with the attributes of the SendGrid library's response.
+    """
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+
+class SendGridAPIError(Exception):
+    """
+    Error response returned by the SendGrid API.
+    """
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        super().__init__(f"HTTP Error {status_code}: {body}")
+
+
+class PooledSendGridAPIClient(SendGridAPIClient):
+    """
+    SendGridAPIClient that sends over a pooled keep-alive requests session with timeouts, cut to
+    what is left of the request deadline.
+
+    The library's own client opens a new connection for every request; this one keeps up to
+    `pool_size` connections open and is safe to share between threads.
+    """
+
+    def __init__(self, api_key=None, connect_timeout=SENDGRID_CONNECT_TIMEOUT, read_timeout=SENDGRID_READ_TIMEOUT, pool_size=SENDGRID_POOL_SIZE, host=SENDGRID_API_HOST):
+        super().__init__(api_key, host=host)
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.headers.update(self._default_headers)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def send(self, message, timeout=None):
+        """
+        Send a Mail object or request body through the v3 mail send API.
+
+        :raises SendGridAPIError: If SendGrid answers with an error status.
+        :raises RateLimitExceeded: If the account's rate limit leaves no token in time.
+        :raises DeadlineExceeded: If too little of the request deadline is left.
+        """
+        if not isinstance(message, dict):
+            message = message.get()
+
+        if SENDGRID_REQUESTS_PER_SECOND > 0:
+            self.rate_limiter.acquire_or_defer()
+        response = self.session.post(f"{self.host}/v3/mail/send", json=message, timeout=call_timeouts(*(timeout or self.timeout)))
+        if response.status_code >= 400:
+            raise SendGridAPIError(response.status_code, response.text, response.headers)
+        return SendGridResponse(response.status_code, response.content, response.headers)
+
+    async def send_async(self, message, timeout=None):
+        """
+        Same as send, over the shared async HTTP client of the running event loop.
+
+        :raises SendGridAPIError: If SendGrid answers with an error status.
+        :raises RateLimitExceeded: If the account's rate limit leaves no token in time.
+        :raises DeadlineExceeded: If too little of the request deadline is left.
+        """
+        if not isinstance(message, dict):
+            message = message.get()
+
+        if SENDGRID_REQUESTS_PER_SECOND > 0:
+            await self.rate_limiter.acquire_or_defer_async()
+        connect_timeout, read_timeout = call_timeouts(*(timeout or self.timeout))
+        response = await get_async_client("sendgrid", self._new_async_client).post(
+            f"{self.host}/v3/mail/send",
+            json=message,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        if response.status_code >= 400:
+            raise SendGridAPIError(response.status_code, response.text, response.headers)
+        return SendGridResponse(response.status_code, response.content, response.headers)
+
+    @property
+    def rate_limiter(self):
+        """
+        Token bucket of the account of the client's API key.
+        """
+        return get_rate_limiter(rate_limit_key("sendgrid", self.api_key), SENDGRID_REQUESTS_PER_SECOND)
+
+    def _new_async_client(self):
+        return httpx.AsyncClient(
+            headers=self._default_headers,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+        )
+
+
+_sendgrid_client = None
+_sendgrid_client_lock = threading.Lock()
+
+
+def get_sendgrid_client():
+    """
+    Return the process-wide SendGrid client, creating it on first use.
+    """
+    global _sendgrid_client
+    if _sendgrid_client is None:
+        with _sendgrid_client_lock:
+            if _sendgrid_client is None:
+                _sendgrid_client = PooledSendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+                logger.info("Created SendGrid client.")
+    return _sendgrid_client
+
+def _build_mail(template_id, subject, message, attachments=None):
+    """
+    Create a Mail object with the sender, template or content and attachments, without recipients.
     """
-    
     # Create a new Mail object
     mail = Mail()
-    
+
     # Set the sender email address
     mail.from_email = Email(os.getenv('SENDGRID_SENDER_EMAIL'))
 
     # If a template ID is provided, configure the email for template usage
     if template_id:
         logger.info(f"Using template ID: {template_id}")
-        
         mail.template_id = template_id
+    else:
+        # If no template is used, configure the email with subject and content
+        logger.info("Sending a non-template email.")
+        mail.subject = subject
+        mail.content = Content("text/html", message if message else "")
+
+    # Add attachments if provided
+    if attachments:
+        logger.info("Adding attachments.")
+
+        for attachment in attachments:
+            # Create an Attachment object for each file
+            attachment_obj = Attachment(
+                FileContent(encode_attachment(attachment)),
+                FileName(attachment['file_name']),
+                FileType(guess_content_type(attachment['file_name']))
+            )
+            mail.add_attachment(attachment_obj)
+            logger.info(f"Attachment added: {attachment['file_name']}")
+
+    return mail
+
+
+def _build_personalizations(to_emails, template_id, dynamic_data, cc_emails=None, bcc_emails=None):
+    """
+    Create the personalizations of one email: one per recipient for templates, otherwise a single
+    personalization holding every recipient.
+    """
+    if template_id:
+        personalizations = list()
         for email in to_emails:
             # Create a Personalization object for each recipient
             personalization = Personalization()
             personalization.add_to(To(email))
-            
+
             # Add dynamic data to the template, if provided
             if dynamic_data:
                 personalization.dynamic_template_data = {}
                 for key, value in dynamic_data.items():
                     personalization.dynamic_template_data[key] = value
-            
+
             # Add CC recipients if provided
             if cc_emails:
                 for cc_email in cc_emails:
                     personalization.add_cc(Cc(cc_email))
-            
+
             # Add BCC recipients if provided
             if bcc_emails:
                 for bcc_email in bcc_emails:
                     personalization.add_bcc(Bcc(bcc_email))
-            
-            # Add personalization to the mail object
-            mail.add_personalization(personalization)
+
+            personalizations.append(personalization)
             logger.info(f"Added personalization for email: {email}")
-    else:
-        # If no template is used, configure the email with subject and content
-        logger.info("Sending a non-template email.")
-        mail.subject = subject
-        mail.content = Content("text/html", message if message else "")
-        
-        # Add each recipient to the email
-        for email in to_emails:
-            mail.add_to(To(email))
-            logger.info(f"Added recipient: {email}")
-        
-        # Add CC recipients if provided
-        if cc_emails:
-            for cc_email in cc_emails:
-                mail.add_cc(Cc(cc_email))
-                logger.info(f"Added CC recipient: {cc_email}")
-        
-        # Add BCC recipients if provided
-        if bcc_emails:
-            for bcc_email in bcc_emails:
-                mail.add_bcc(Bcc(bcc_email))
-                logger.info(f"Added BCC recipient: {bcc_email}")
+        return personalizations
+
+    personalization = Personalization()
+    # Add each recipient to the email
+    for email in to_emails:
+        personalization.add_to(To(email))
+        logger.info(f"Added recipient: {email}")
+
+    # Add CC recipients if provided
+    if cc_emails:
+        for cc_email in cc_emails:
+            personalization.add_cc(Cc(cc_email))
+            logger.info(f"Added CC recipient: {cc_email}")
+
+    # Add BCC recipients if provided
+    if bcc_emails:
+        for bcc_email in bcc_emails:
+            personalization.add_bcc(Bcc(bcc_email))
+            logger.info(f"Added BCC recipient: {bcc_email}")
+    return [personalization]
+
+
+def _log(payloads, started_at, response=None, error=None):
+    """
+    Log the outcome of a SendGrid request to the recipients of the payloads it sent.
+    """
+    recipients = [
+        email
+        for payload in payloads
+        for email in list(payload['to']) + list(payload.get('cc') or []) + list(payload.get('bcc') or [])
+    ]
+    message_id = response.headers.get("X-Message-Id") if response is not None else None
+    log_delivery("email", "sendgrid", recipients, error, message_id, time.monotonic() - started_at)
+
+
+def _failure(error):
+    """
+    Failed email result of a SendGrid call, reported to the SendGrid circuit breaker when retryable.
+    A call deferred by the rate limit or the request deadline never reached SendGrid and is not reported.
+    """
+    details = failure_details("sendgrid", error)
+    if not details.get("deferred"):
+        record_call("sendgrid", bool(details))
+    return False, str(error), details
 
-    # Add attachments if provided
-    if attachments:
-        logger.info("Adding attachments.")
-        
-        for attachment in attachments:
-            # Create an Attachment object for each file
-            attachment_obj = Attachment(
-                FileContent(attachment['file']),
-                FileName(attachment['file_name']),
-                FileType('application/octet-stream')  # Default MIME type
-            )
-            mail.add_attachment(attachment_obj)
-            logger.info(f"Attachment added: {attachment['file_name']}")
 
+def send_sendgrid_email(to_emails, subject, message, template_id, dynamic_data, cc_emails=None, bcc_emails=None, attachments=None):
+    """
+    Sends an email using SendGrid's API.
+    
+    Parameters:
+    - to_emails: List of recipient email addresses.
+    - subject: Subject of the email (used if not using a template).
+    - message: Body of the email (used if not using a template).
+    - template_id: (Optional) ID of the SendGrid template to use.
+    - dynamic_data: (Optional) Data to populate dynamic fields in the SendGrid template.
+    - cc_emails: (Optional) List of CC email addresses.
+    - bcc_emails: (Optional) List of BCC email addresses.
+    - attachments: (Optional) List of dictionaries representing file attachments.
+    
+    Returns:
+    A tuple (status_code, response_body, response_headers) where:
+    - status_code: HTTP status code of the response.
+    - response_body: Body of the response.
+    - response_headers: Headers of the response.
+    """
+    
+    mail = _build_mail(template_id, subject, message, attachments)
+    for personalization in _build_personalizations(to_emails, template_id, dynamic_data, cc_emails, bcc_emails):
+        mail.add_personalization(personalization)
+
+    payloads = [{'to': to_emails, 'cc': cc_emails, 'bcc': bcc_emails}]
+    started_at = time.monotonic()
     try:
-        # Create a SendGrid API client using the API key
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
+        # Reuse the shared SendGrid API client and its open connections
+        sg = get_sendgrid_client()
         
         # Send the email and get the response
         response = sg.send(mail)
         
         # Log the successful email send
         logger.info(f"Email sent successfully. Status code: {response.status_code}")
+        record_call("sendgrid", False)
+        _log(payloads, started_at, response)
         return response.status_code, response.body, response.headers
     except Exception as e:
         # Log any errors that occur during email sending
         logger.error(f"Error sending email: {str(e)}")
-        return False, str(e), {}
+        _log(payloads, started_at, error=e)
+        return _failure(e)
+
+
+async def send_sendgrid_email_async(to_emails, subject, message, template_id, dynamic_data, cc_emails=None, bcc_emails=None, attachments=None):
+    """
+    Async version of send_sendgrid_email, sending over the shared async HTTP client.
+
+    Returns:
+    A tuple (status_code, response_body, response_headers), status_code is False if the email failed.
+    """
+    mail = _build_mail(template_id, subject, message, attachments)
+    for personalization in _build_personalizations(to_emails, template_id, dynamic_data, cc_emails, bcc_emails):
+        mail.add_personalization(personalization)
+
+    payloads = [{'to': to_emails, 'cc': cc_emails, 'bcc': bcc_emails}]
+    started_at = time.monotonic()
+    try:
+        response = await get_sendgrid_client().send_async(mail)
+        logger.info(f"Email sent successfully. Status code: {response.status_code}")
+        record_call("sendgrid", False)
+        _log(payloads, started_at, response)
+        return response.status_code, response.body, response.headers
+    except Exception as e:
+        logger.error(f"Error sending email: {str(e)}")
+        _log(payloads, started_at, error=e)
+        return _failure(e)
+
+
+def _build_batch_mails(payloads):
+    """
+    Create the Mail objects of a batch, each with up to SENDGRID_MAX_PERSONALIZATIONS personalizations
+    and SENDGRID_MAX_RECIPIENTS recipients.
+
+    The personalizations of a payload are never split over several mails, so a failed request only
+    ever fails whole payloads and retrying them sends nothing twice. A payload over the limits on its
+    own is sent in a mail of its own.
+
+    :return: List of (payload_indexes, mail) tuples, payload_indexes being the payloads the mail sends.
+    """
+    first = payloads[0]
+    chunks = list()
+    indexes, personalizations, recipient_count = list(), list(), 0
+    for index, payload in enumerate(payloads):
+        payload_personalizations = _build_personalizations(
+            payload['to'], first.get('template_id'), payload.get('dynamic_template_data'),
+            payload.get('cc'), payload.get('bcc'),
+        )
+        payload_recipient_count = sum(
+            len(personalization.tos) + len(personalization.ccs) + len(personalization.bccs)
+            for personalization in payload_personalizations
+        )
+        if personalizations and (
+            len(personalizations) + len(payload_personalizations) > SENDGRID_MAX_PERSONALIZATIONS
+            or recipient_count + payload_recipient_count > SENDGRID_MAX_RECIPIENTS
+        ):
+            chunks.append((indexes, personalizations))
+            indexes, personalizations, recipient_count = list(), list(), 0
+        indexes.append(index)
+        personalizations.extend(payload_personalizations)
+        recipient_count += payload_recipient_count
+    if personalizations:
+        chunks.append((indexes, personalizations))
+
+    mails = list()
+    for indexes, personalizations in chunks:
+        mail = _build_mail(first.get('template_id'), first.get('subject'), first.get('message'), first.get('attachments'))
+        for personalization in personalizations:
+            mail.add_personalization(personalization)
+        mails.append((indexes, mail))
+    return mails
+
+
+def _merge_batch_results(payload_count, mail_results):
+    """
+    Map the result of each batch request back to the payloads it sent.
+    """
+    results = [None] * payload_count
+    for indexes, result in mail_results:
+        for index in indexes:
+            results[index] = result
+    return results
+
+
+def send_sendgrid_email_batch(payloads):
+    """
+    Sends several emails sharing the same template or content, sender and attachments with as few
+    SendGrid API calls as possible, packing up to SENDGRID_MAX_PERSONALIZATIONS personalizations
+    and SENDGRID_MAX_RECIPIENTS recipients in each request.
+
+    Parameters:
+    - payloads: List of email payloads (to, subject, message, template_id, dynamic_template_data,
+      cc, bcc, attachments); template_id, subject, message and attachments are taken from the first one.
+
+    Returns:
+    A list with one (status_code, response_body, response_headers) tuple per payload, in order;
+    status_code is False for the payloads whose request failed.
+    """
+    mail_results = list()
+    for indexes, mail in _build_batch_mails(payloads):
+        started_at = time.monotonic()
+        try:
+            response = get_sendgrid_client().send(mail)
+            logger.info(f"Email batch of {len(mail.personalizations)} personalizations sent successfully. Status code: {response.status_code}")
+            record_call("sendgrid", False)
+            _log([payloads[index] for index in indexes], started_at, response)
+            result = (response.status_code, response.body, response.headers)
+        except Exception as e:
+            logger.error(f"Error sending email batch: {str(e)}")
+            _log([payloads[index] for index in indexes], started_at, error=e)
+            result = _failure(e)
+        mail_results.append((indexes, result))
+
+    return _merge_batch_results(len(payloads), mail_results)
+
+
+async def send_sendgrid_email_batch_async(payloads):
+    """
+    Async version of send_sendgrid_email_batch, sending the requests of the batch concurrently.
+
+    Returns:
+    A list with one (status_code, response_body, response_headers) tuple per payload, in order.
+    """
+    async def send(indexes, mail):
+        started_at = time.monotonic()
+        try:
+            response = await get_sendgrid_client().send_async(mail)
+            logger.info(f"Email batch of {len(mail.personalizations)} personalizations sent successfully. Status code: {response.status_code}")
+            record_call("sendgrid", False)
+            _log([payloads[index] for index in indexes], started_at, response)
+            return indexes, (response.status_code, response.body, response.headers)
+        except Exception as e:
+            logger.error(f"Error sending email batch: {str(e)}")
+            _log([payloads[index] for index in indexes], started_at, error=e)
+            return indexes, _failure(e)
+
+    mail_results = await asyncio.gather(*(send(indexes, mail) for indexes, mail in _build_batch_mails(payloads)))
+    return _merge_batch_results(len(payloads), mail_results)
@@ -1,4 +1,6 @@
 from rest_framework import serializers
+from utilities import messages
+from utilities.storage import get_file_store
 
 class AttachmentSerializer(serializers.Serializer):
     """
@@ -7,9 +9,34 @@ class AttachmentSerializer(serializers.Serializer):
     Fields:
     - file_name: The name of the file attachment.
     - file: The base64-encoded content of the file.
+    - file_id: Id of a file uploaded to the file store, sent instead of the content.
     """
     file_name = serializers.CharField(max_length=255)
-    file = serializers.CharField(allow_blank=True, allow_null=True)
+    file = serializers.CharField(allow_blank=True, allow_null=True, required=False)
+    file_id = serializers.CharField(required=False)
+
+    def validate(self, data):
+        """
+        Ensure the attachment has either its base64 content or the id of an uploaded file.
+        """
+        if 'file_id' in data:
+            if data.get('file') is not None:
+                raise serializers.ValidationError({'file_id': 'Send either file or file_id, not both.'})
+            if not get_file_store().exists(data['file_id']):
+                raise serializers.ValidationError({'file_id': messages.DOES_NOT_EXIST.format('File')})
+        elif 'file' not in data:
+            raise serializers.ValidationError({'file': messages.THIS_FIELD_REQUIRED})
+        return data
+
+
+class AttachmentUploadSerializer(serializers.Serializer):
+    """
+    Serializer for uploading a file to the file store.
+
+    Fields:
+    - file: The uploaded file.
+    """
+    file = serializers.FileField(allow_empty_file=True)
 
 class EmailSerializer(serializers.Serializer):
     """
@@ -24,6 +51,7 @@ class EmailSerializer(serializers.Serializer):
     - cc: (Optional) List of CC email addresses.
     - bcc: (Optional) List of BCC email addresses.
     - attachments: (Optional) List of attachments.
+    - idempotency_key: (Optional) Key identifying the email, a repeated key within the dedupe window is not sent again.
     """
     to = serializers.ListField(
         child=serializers.EmailField(),
@@ -48,6 +76,7 @@ class EmailSerializer(serializers.Serializer):
         required=False,
         allow_empty=True
     )
+    idempotency_key = serializers.CharField(max_length=255, required=False)
 
     def validate(self, data):
         """
@@ -1,13 +1,153 @@
 import os
-from django.core.mail import EmailMessage
-import base64
-import mimetypes
+import time
+import queue
+import smtplib
+import threading
+from contextlib import contextmanager
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import make_msgid
+from django.core.mail.utils import DNS_NAME
 from utilities.utils import logger
+from utilities.retry import DeferredError, failure_details
+from utilities.circuit_breaker import record_call
+from utilities.deadline import call_timeout
+from common.delivery_log import log_delivery
+from .attachments import attachment_cache
+
+
+# Open SMTP connections kept for reuse, shared by the threads sending emails.
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 4))
+# Seconds to wait for the SMTP server when connecting and for each reply.
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 30))
+
+
+class SMTPConnectionPool:
+    """
+    Bounded pool of open email backend connections.
+
+    At most `max_size` connections exist at a time; a connection is opened once (TCP, STARTTLS
+    and AUTH) and handed back to the pool after use instead of being closed.
+    """
+
+    def __init__(self, max_size=SMTP_POOL_SIZE):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow an open connection, waiting for one to be free if the pool is exhausted.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = get_connection(fail_silently=False, timeout=SMTP_TIMEOUT)
+                set_smtp_timeout(connection)
+                connection.open()
+
+            try:
+                yield connection
+            except Exception:
+                # Do not hand a connection in an unknown state to the next sender.
+                self._close(connection)
+                raise
+            self._idle.put(connection)
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """
+        Close every idle connection of the pool.
+        """
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug(f"Error closing SMTP connection: {e}")
+
+
+smtp_connection_pool = SMTPConnectionPool()
+
+
+def _log(email, started_at=None, error=None):
+    """
+    Log the outcome of the send of an EmailMessage to its recipients.
+    """
+    latency = time.monotonic() - started_at if started_at is not None else None
+    log_delivery("email", "smtp", email.recipients(), error, email.extra_headers.get("Message-ID"), latency)
+
+
+def set_smtp_timeout(connection):
+    """
+    Cut the timeout of a connection, and of its open socket, to what is left of the request deadline.
+
+    :raises DeadlineExceeded: If too little of the request deadline is left.
+    """
+    connection.timeout = call_timeout(SMTP_TIMEOUT)
+    sock = getattr(getattr(connection, "connection", None), "sock", None)
+    if sock is not None:
+        sock.settimeout(connection.timeout)
+
+
+def _send_with_reconnect(connection, email):
+    """
+    Send a message over an open connection, reconnecting once if the server dropped it.
+    """
+    try:
+        return connection.send_messages([email])
+    except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+        logger.info(f"SMTP connection dropped ({e}), reconnecting.")
+        connection.close()
+        connection.open()
+        return connection.send_messages([email])
+
+
+def _build_smtp_message(to_emails, subject, message, cc_emails=None, bcc_emails=None, attachments=None):
+    """
+    Create the EmailMessage for an email, resolving its attachments through the attachment cache.
+    """
+    # Create an EmailMessage object with the provided subject, message, and recipient addresses
+    email = EmailMessage(subject, message, os.getenv('DEFAULT_FROM_EMAIL'), to_emails)
+
+    # Set the content subtype to HTML
+    email.content_subtype = "html"
+
+    # Set the Message-ID up front so the delivery log can refer to the message
+    email.extra_headers["Message-ID"] = make_msgid(domain=DNS_NAME)
+
+    # Add CC recipients if provided
+    if cc_emails:
+        email.cc = cc_emails
+
+    # Add BCC recipients if provided
+    if bcc_emails:
+        email.bcc = bcc_emails
+
+    # Process and attach files if provided
+    if attachments:
+        for attachment in attachments:
+            # Decode the base64 data or read the uploaded file once per distinct file and infer its MIME type from the file extension
+            decoded = attachment_cache.resolve(attachment)
+
+            # Attach the decoded file to the email
+            email.attach(decoded.file_name, decoded.content, decoded.content_type)
+
+    return email
+
 
 def send_smtp_email(to_emails, subject, message, cc_emails=None, bcc_emails=None, attachments=None):
     """
     Sends an email via SMTP using Django's EmailMessage class.
-    
+
     Parameters:
     - to_emails: List of recipient email addresses.
     - subject: Subject of the email.
@@ -17,67 +157,88 @@ def send_smtp_email(to_emails, subject, message, cc_emails=None, bcc_emails=None
     - attachments: (Optional) List of dictionaries representing file attachments, where each dictionary contains:
         - 'file_name': Name of the file.
         - 'file': Base64 encoded content of the file.
-    
+        - 'file_id': Id of a file uploaded to the file store, used instead of 'file'.
+
     Returns:
     A tuple (success, message, details) where:
     - success: Boolean indicating if the email was sent successfully.
     - message: Message indicating the result of the email sending attempt.
     - details: Additional details (e.g., error message).
     """
+    return send_smtp_email_batch([{
+        'to': to_emails,
+        'subject': subject,
+        'message': message,
+        'cc': cc_emails,
+        'bcc': bcc_emails,
+        'attachments': attachments,
+    }])[0]
+
+
+def send_smtp_email_batch(payloads):
+    """
+    Sends several emails via SMTP over a single pooled connection.
+
+    Parameters:
+    - payloads: List of email payloads with to, subject, message, cc, bcc and attachments.
+
+    Returns:
+    A list with one (success, message, details) tuple per payload, in order.
+    """
+    results = list()
+    emails = list()
+    for payload in payloads:
+        try:
+            emails.append(_build_smtp_message(
+                payload['to'], payload.get('subject'), payload.get('message'),
+                payload.get('cc'), payload.get('bcc'), payload.get('attachments'),
+            ))
+            results.append(None)
+        except Exception as e:
+            # Log the error and return a failure response if there's an issue with decoding an attachment
+            logger.error(f"Error preparing email: {str(e)}")
+            log_delivery("email", "smtp", list(payload['to']) + list(payload.get('cc') or []) + list(payload.get('bcc') or []), e)
+            emails.append(None)
+            results.append((False, str(e), {}))
+
+    if all(email is None for email in emails):
+        return results
+
     try:
-        # Create an EmailMessage object with the provided subject, message, and recipient addresses
-        email = EmailMessage(subject, message, os.getenv('DEFAULT_FROM_EMAIL'), to_emails)
-        
-        # Set the content subtype to HTML
-        email.content_subtype = "html"
-        
-        # Add CC recipients if provided
-        if cc_emails:
-            email.cc = cc_emails
-        
-        # Add BCC recipients if provided
-        if bcc_emails:
-            email.bcc = bcc_emails
-        
-        # Process and attach files if provided
-        if attachments:
-            decoded_attachments = []
-            for attachment in attachments:
+        with smtp_connection_pool.connection() as connection:
+            for index, email in enumerate(emails):
+                if email is None:
+                    continue
+                started_at = time.monotonic()
                 try:
-                    # Extract file name and base64 encoded data
-                    file_name = attachment['file_name']
-                    base64_data = attachment['file']
-                    
-                    # Decode the base64 data to get file content
-                    file_content = base64.b64decode(base64_data)
-                    
-                    # Infer the MIME type from the file extension
-                    extension = file_name.rsplit('.', 1)[-1].lower()
-                    content_type, _ = mimetypes.guess_type(f"file.{extension}")
-                    content_type = content_type or 'application/octet-stream'  # Default to 'application/octet-stream' if MIME type cannot be determined
-
-                    # Append the decoded attachment to the list
-                    decoded_attachments.append((file_name, file_content, content_type))
-                except Exception as e:
-                    # Log the error and return a failure response if there's an issue with decoding an attachment
-                    return False, str(e), {}
-
-            # Attach each file to the email
-            for file_name, file_content, content_type in decoded_attachments:
-                email.attach(file_name, file_content, content_type)
-        
-        # Send the email
-        email.send()
-        
-        # Log success messages
-        logger.debug("Email sending process completed.")
-        logger.info("Email sent successfully via SMTP.")
-        
-        # Return success response
-        return True, "Email sent successfully via SMTP", {}
+                    set_smtp_timeout(connection)
+                    _send_with_reconnect(connection, email)
+                    logger.info("Email sent successfully via SMTP.")
+                    record_call("smtp", False)
+                    _log(email, started_at)
+                    results[index] = (True, "Email sent successfully via SMTP", {})
+                except DeferredError as e:
+                    # Not attempted, the messages left are deferred to the queue.
+                    logger.warning(f"Email deferred to the queue: {str(e)}")
+                    _log(email, error=e)
+                    results[index] = (False, str(e), failure_details("smtp", e))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                    # Rejected by the server for this message only, the connection is still usable.
+                    logger.error(f"Error sending email: {str(e)}")
+                    details = failure_details("smtp", e)
+                    record_call("smtp", bool(details))
+                    _log(email, started_at, e)
+                    results[index] = (False, str(e), details)
     except Exception as e:
         # Log the error if sending the email fails
         logger.error(f"Error sending email: {str(e)}")
-        
-        # Return failure response with error details
-        return False, str(e), {}
+        details = failure_details("smtp", e)
+        if not details.get("deferred"):
+            record_call("smtp", bool(details))
+        for email, result in zip(emails, results):
+            if result is None:
+                _log(email, error=e)
+        results = [result or (False, str(e), details) for result in results]
+
+    logger.debug("Email sending process completed.")
+    return results
@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import SendEmailAPIView
+from .views import AsyncSendEmailAPIView, SendEmailAPIView, UploadAttachmentAPIView
 
 urlpatterns = [
     path('send/email/<str:provider_type>/', SendEmailAPIView.as_view(), name='send-email'),
+    path('send/email/<str:provider_type>/async/', AsyncSendEmailAPIView.as_view(), name='send-email-async'),
+    path('attachments/upload/', UploadAttachmentAPIView.as_view(), name='upload-attachment'),
 ]
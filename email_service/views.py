@@ -1,16 +1,23 @@
 import copy
+from adrf.generics import GenericAPIView as AsyncGenericAPIView
+from asgiref.sync import sync_to_async
 from rest_framework.generics import CreateAPIView
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import EmailSerializer
+from .serializers import AttachmentUploadSerializer, EmailSerializer
 from .backend import EmailService
 from utilities.utils import ResponseInfo, CustomException
 from utilities import messages
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from utilities.sqs import push_message_to_sqs
+from utilities.sqs import push_messages_to_sqs
 from utilities.utils import logger
 from utilities.permissions import IsAuthenticatedPermission
+from utilities.storage import get_file_store
+from utilities.dedupe import get_dedupe_store
+from utilities.retry import schedule_payload_retries
+from utilities.constants import DEFAULT_PRIORITY, PRIORITY_CHOICES
 
 class SendEmailAPIView(CreateAPIView):
     """
@@ -30,29 +37,77 @@ class SendEmailAPIView(CreateAPIView):
         self.response_format = ResponseInfo().response
         self.failed_messages_response_list = list()
         self.failed_payload = list()
+        self.retry_payload = list()
+        self.retried_payload = list()
+        self.priority = DEFAULT_PRIORITY
         logger.info("Initializing SendEmailAPIView.")
         super(SendEmailAPIView, self).__init__(**kwargs)
 
     def send_email_service(self, service_type, payload):
         """
-        Method to make service for push service.
+        Method to make service for push service, skipping emails already sent within the dedupe window.
         """
-        return EmailService().send_email(service_type, **payload)
+        return get_dedupe_store().send_once(
+            "email", payload,
+            lambda data: EmailService().send_email(service_type, **data),
+            is_sent=self.email_sent, duplicate_result=self.duplicate_result(),
+        )
 
-    @swagger_auto_schema(
-        manual_parameters=[
-            openapi.Parameter(
-                'provider_type',
-                openapi.IN_PATH,
-                description="Provider type",
-                type=openapi.TYPE_STRING,
-                enum=['smtp', 'sendgrid']
-            ),
-        ]
-    )
-    def post(self, request, provider_type, *args, **kwargs):
+    def send_email_batch_service(self, service_type, payloads):
         """
-        Handle POST requests to send an email. Validates the request and calls the EmailService to send the email.
+        Method to send several emails, merging compatible ones into shared provider requests and
+        skipping the ones already sent within the dedupe window.
+        """
+        return get_dedupe_store().send_batch_once(
+            "email", payloads,
+            lambda data: EmailService().send_email_batch(service_type, data),
+            is_sent=self.email_sent, duplicate_result=self.duplicate_result(),
+        )
+
+    async def send_email_service_async(self, service_type, payload):
+        """
+        Async version of send_email_service.
+        """
+        return await get_dedupe_store().send_once_async(
+            "email", payload,
+            lambda data: EmailService().send_email_async(service_type, **data),
+            is_sent=self.email_sent, duplicate_result=self.duplicate_result(),
+        )
+
+    async def send_email_batch_service_async(self, service_type, payloads):
+        """
+        Async version of send_email_batch_service.
+        """
+        return await get_dedupe_store().send_batch_once_async(
+            "email", payloads,
+            lambda data: EmailService().send_email_batch_async(service_type, data),
+            is_sent=self.email_sent, duplicate_result=self.duplicate_result(),
+        )
+
+    @staticmethod
+    def email_sent(response):
+        return bool(response[0])
+
+    @staticmethod
+    def email_retryable(response):
+        """
+        Whether a failed email result comes from an error worth retrying, as flagged by the provider function.
+        """
+        return not response[0] and bool(response[2]) and bool(response[2].get("retryable"))
+
+    @staticmethod
+    def duplicate_result():
+        """
+        Result reported for an email already sent, a success for the caller.
+        """
+        return True, messages.ALREADY_SENT.format("Email"), {}
+
+    def split_payload(self, request, provider_type):
+        """
+        Validate the payload items of a request, recording the invalid ones as failed.
+
+        :return: A tuple (queued_payload, direct_payload) of (requested_data, data) pairs, data being
+                 the queue message for queued items and the validated data for the others.
         """
         EMAIL_CHOICES = ['sendgrid', 'smtp']
 
@@ -66,6 +121,13 @@ class SendEmailAPIView(CreateAPIView):
             raise CustomException(error_message)
 
         use_sqs = request.data.get('use_sqs', False)
+        priority = request.data.get('priority', DEFAULT_PRIORITY)
+        if priority not in PRIORITY_CHOICES:
+            logger.error(f"Invalid priority: {priority}")
+            raise CustomException(messages.VALID_PARAMS.format(', '.join(PRIORITY_CHOICES)))
+        self.priority = priority
+        queued_payload = list()
+        direct_payload = list()
         # Serialize and validate the request data
         for requested_data in request.data.get('payload', []):
             serializer = self.get_serializer(data=requested_data, context={'provider_type': provider_type})
@@ -80,30 +142,15 @@ class SendEmailAPIView(CreateAPIView):
                     message = {
                         "provider_type": provider_type,
                         "service_type": "email",
+                        "priority": priority,
                         "service_data": {
                             **validated_data
                         }
                     }
-                    push_message_to_sqs(message)
+                    queued_payload.append((requested_data, message))
 
                 else:
-                    # Call EmailService to send the email
-                    response = self.send_email_service(provider_type, serializer.validated_data)
-                    logger.info("Email sent successfully.")
-                    success, body, headers = response
-
-                    if success:
-                        # Configure response for successful email sending
-                        self.response_format["data"] = None
-                        self.response_format["error"] = None
-                        self.response_format["status_code"] = status.HTTP_200_OK
-                        self.response_format["message"] = [messages.SEND_SUCCESS.format("Email")]
-                    else:
-                        # Configure response for failed email sending
-                        payload_copy = copy.deepcopy(requested_data)
-                        payload_copy["errors"] = body
-                        self.failed_payload.append(payload_copy)                        
-                        logger.error(f"Failed to send email. Error: {body}")
+                    direct_payload.append((requested_data, validated_data))
             else:
 
                 payload_copy = copy.deepcopy(requested_data)
@@ -112,8 +159,50 @@ class SendEmailAPIView(CreateAPIView):
                 # Log validation errors
                 logger.warning(f"Validation errors: {serializer.errors}")
 
+        return queued_payload, direct_payload
+
+    def record_send_failures(self, direct_payload, responses):
+        """
+        Record the payload items the provider failed to send, the ones worth retrying apart.
+        """
+        for (requested_data, data), response in zip(direct_payload, responses):
+            success, body, _ = response
+            if not success and self.email_retryable(response):
+                logger.warning(f"Failed to send email, retrying later. Error: {body}")
+                self.retry_payload.append((requested_data, data, body))
+            elif not success:
+                # Configure response for failed email sending
+                payload_copy = copy.deepcopy(requested_data)
+                payload_copy["errors"] = body
+                self.failed_payload.append(payload_copy)
+                logger.error(f"Failed to send email. Error: {body}")
+        logger.info(f"{len(direct_payload)} emails processed.")
+
+    def record_queue_failures(self, queued_payload, failed_messages):
+        """
+        Record the payload items that could not be enqueued.
+        """
+        for index, error in failed_messages:
+            payload_copy = copy.deepcopy(queued_payload[index][0])
+            payload_copy["errors"] = error
+            self.failed_payload.append(payload_copy)
+
+    def schedule_retries(self, provider_type):
+        """
+        Enqueue the retry of the payload items that failed with a retryable error.
+        """
+        retried_payload, failed_payload = schedule_payload_retries("email", provider_type, self.priority, self.retry_payload)
+        self.retried_payload.extend(retried_payload)
+        self.failed_payload.extend(failed_payload)
+        self.retry_payload = list()
+
+    def sent_response(self):
+        """
+        Response listing the failed payload items and the ones scheduled for a retry, if any.
+        """
         response_data = {
-            "failed_payload": None
+            "failed_payload": None,
+            "retried_payload": self.retried_payload or None,
         }
         if len(self.failed_payload) > 0:
             response_data["failed_payload"] = self.failed_payload
@@ -124,3 +213,109 @@ class SendEmailAPIView(CreateAPIView):
         self.response_format["status_code"] = status.HTTP_200_OK
         self.response_format["message"] = [messages.SEND_SUCCESS.format("Email")]
         return Response(self.response_format)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'provider_type',
+                openapi.IN_PATH,
+                description="Provider type",
+                type=openapi.TYPE_STRING,
+                enum=['smtp', 'sendgrid']
+            ),
+        ]
+    )
+    def post(self, request, provider_type, *args, **kwargs):
+        """
+        Handle POST requests to send an email. Validates the request and calls the EmailService to send the email.
+        """
+        queued_payload, direct_payload = self.split_payload(request, provider_type)
+
+        if direct_payload:
+            # Call EmailService to send the emails, compatible ones share a provider request
+            responses = self.send_email_batch_service(provider_type, [data for _, data in direct_payload])
+            self.record_send_failures(direct_payload, responses)
+            if self.retry_payload:
+                self.schedule_retries(provider_type)
+
+        if queued_payload:
+            # Enqueue every valid payload item in as few SQS batch calls as possible
+            self.record_queue_failures(queued_payload, push_messages_to_sqs([message for _, message in queued_payload]))
+
+        return self.sent_response()
+
+
+class AsyncSendEmailAPIView(AsyncGenericAPIView, SendEmailAPIView):
+    """
+    send email using sendgrid and smtp service, without holding a thread while the provider answers
+    """
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'provider_type',
+                openapi.IN_PATH,
+                description="Provider type",
+                type=openapi.TYPE_STRING,
+                enum=['smtp', 'sendgrid']
+            ),
+        ]
+    )
+    async def post(self, request, provider_type, *args, **kwargs):
+        """
+        Handle POST requests to send an email on the ASGI event loop.
+        """
+        queued_payload, direct_payload = self.split_payload(request, provider_type)
+
+        if direct_payload:
+            responses = await self.send_email_batch_service_async(provider_type, [data for _, data in direct_payload])
+            self.record_send_failures(direct_payload, responses)
+            if self.retry_payload:
+                await sync_to_async(self.schedule_retries, thread_sensitive=False)(provider_type)
+
+        if queued_payload:
+            failed_messages = await sync_to_async(push_messages_to_sqs, thread_sensitive=False)(
+                [message for _, message in queued_payload]
+            )
+            self.record_queue_failures(queued_payload, failed_messages)
+
+        return self.sent_response()
+
+
+class UploadAttachmentAPIView(CreateAPIView):
+    """
+    upload an attachment once to the file store, emails then reference it by its file_id
+    """
+    permission_classes = (IsAuthenticatedPermission, )
+    authentication_classes = ()
+    parser_classes = (MultiPartParser, )
+    serializer_class = AttachmentUploadSerializer
+
+    def __init__(self, **kwargs):
+        """
+        Constructor function for formatting the web response to return.
+        """
+        self.response_format = ResponseInfo().response
+        super(UploadAttachmentAPIView, self).__init__(**kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Handle POST requests with a multipart file, storing it by the SHA-256 of its content.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        uploaded_file = serializer.validated_data['file']
+
+        # Stream the upload into the store, an identical file already stored is not written again
+        file_id = get_file_store().save(uploaded_file.chunks())
+        logger.info(f"Uploaded attachment {uploaded_file.name} as {file_id}.")
+
+        self.response_format["data"] = {
+            "file_id": file_id,
+            "file_name": uploaded_file.name,
+            "size": uploaded_file.size,
+        }
+        self.response_format["error"] = None
+        self.response_format["status_code"] = status.HTTP_201_CREATED
+        self.response_format["message"] = [messages.UPLOADED.format("Attachment")]
+        return Response(self.response_format, status=status.HTTP_201_CREATED)
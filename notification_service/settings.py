@@ -75,6 +75,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'utilities.middleware.RequestDeadlineMiddleware',
 ]
 
 ROOT_URLCONF = 'notification_service.urls'
@@ -162,6 +163,44 @@ EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS')
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 
+# queue used when use_sqs is set, 'sqs' for Amazon SQS or 'local' for a SQLite queue on this box
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'sqs')
+# SQLite file of the local queue, ':memory:' keeps the queue inside the process
+LOCAL_QUEUE_PATH = os.getenv('LOCAL_QUEUE_PATH', os.path.join(BASE_DIR, 'queue.sqlite3'))
+# priority lanes of the queue, each with its own SQS queue (lanes without one share SQS_URL) and delay
+QUEUE_PRIORITY_LANES = {
+    'critical': {
+        'sqs_url': os.getenv('SQS_CRITICAL_URL'),
+        'delay_seconds': int(os.getenv('QUEUE_CRITICAL_DELAY_SECONDS', 0)),
+    },
+    'default': {
+        'sqs_url': os.getenv('SQS_URL'),
+        'delay_seconds': int(os.getenv('QUEUE_DEFAULT_DELAY_SECONDS', 10)),
+    },
+    'bulk': {
+        'sqs_url': os.getenv('SQS_BULK_URL'),
+        'delay_seconds': int(os.getenv('QUEUE_BULK_DELAY_SECONDS', 10)),
+    },
+}
+# SQS queue of the notifications that failed for good or ran out of retries
+SQS_DEAD_LETTER_URL = os.getenv('SQS_DEAD_LETTER_URL')
+
+# SQLite file of the keys of recently sent notifications, used to suppress duplicate sends
+DEDUPE_STORE_PATH = os.getenv('DEDUPE_STORE_PATH', os.path.join(BASE_DIR, 'dedupe.sqlite3'))
+# SQLite file of the token buckets of the provider accounts, shared by the workers of the box
+RATE_LIMIT_STORE_PATH = os.getenv('RATE_LIMIT_STORE_PATH', os.path.join(BASE_DIR, 'rate_limit.sqlite3'))
+
+# write the outcome of every send to the NotificationLog table, through an in-process buffer
+DELIVERY_LOG_ENABLED = os.getenv('DELIVERY_LOG_ENABLED', 'True') == 'True'
+
+# directory of the content-addressed store of uploaded attachments
+FILE_STORE_PATH = os.getenv('FILE_STORE_PATH', os.path.join(BASE_DIR, 'file_store'))
+# store of queue bodies too large to travel in SQS messages, 'local' for a directory or 's3' for a bucket
+BLOB_STORE_BACKEND = os.getenv('BLOB_STORE_BACKEND', 'local')
+BLOB_STORE_PATH = os.getenv('BLOB_STORE_PATH', os.path.join(BASE_DIR, 'blob_store'))
+BLOB_STORE_BUCKET = os.getenv('BLOB_STORE_BUCKET')
+BLOB_STORE_PREFIX = os.getenv('BLOB_STORE_PREFIX', 'queue-bodies/')
+
 
 LOGGING_DIR = os.path.join(BASE_DIR, "log")
 
@@ -1,3 +1,9 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import DeadDeviceToken
+
+
+@admin.register(DeadDeviceToken)
+class DeadDeviceTokenAdmin(admin.ModelAdmin):
+    list_display = ("token", "error_code", "updated_at")
+    search_fields = ("token",)
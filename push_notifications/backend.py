@@ -1,5 +1,12 @@
+from asgiref.sync import sync_to_async
+
 from utilities.utils import CustomException, logger
+from utilities.async_http import get_async_client
+from utilities.retry import DeferredError, get_retry_policy
+from utilities.circuit_breaker import CircuitOpenError, get_circuit_breaker, record_call
+from utilities.concurrency import get_concurrency_limiter
 from .firebase import send_firebase_push_notification
+from .fcm_v1 import get_fcm_v1_sender, send_fcm_v1_push_notification, send_fcm_v1_push_notification_async
 
 
 class PushService:
@@ -8,9 +15,11 @@ class PushService:
         """
         Method to send push notifications based on the specified service type.
 
-        :param service: The service type to use for sending the push notification (e.g., 'firebase', 'sns').
+        :param service: The service type to use for sending the push notification (e.g., 'firebase', 'firebase_v1', 'sns').
         :param payload: The payload is to use for request data to initiate push notification.
+        :return: The provider's result with per-token success and failure, if any.
         :raises CustomException: If the service type is not recognized.
+        :raises CircuitOpenError: If the circuit of the service is open, without calling the provider.
         """
         logger.info("Attempting to send push notification.")
         logger.debug(f"Service: {service}")
@@ -18,12 +27,31 @@ class PushService:
 
         if service == "firebase":
             logger.info("Sending push notification via Firebase.")
-            try:
-                send_firebase_push_notification(payload["title"], payload["content"], payload["extra_args"], payload["tokens"], payload["badge_count"])
-                logger.info("Push notification sent successfully via Firebase.")
-            except Exception as e:
-                logger.error(f"Failed to send push notification via Firebase: {str(e)}")
-                raise
+            PushService._check_circuit(service)
+            with get_concurrency_limiter(service).slot() as call:
+                try:
+                    result = send_firebase_push_notification(payload["title"], payload["content"], payload["extra_args"], payload["tokens"], payload["badge_count"])
+                    logger.info("Push notification sent successfully via Firebase.")
+                    PushService._report(service, call, result)
+                    return result
+                except Exception as e:
+                    logger.error(f"Failed to send push notification via Firebase: {str(e)}")
+                    PushService._report(service, call, error=e)
+                    raise
+
+        elif service == "firebase_v1":
+            logger.info("Sending push notification via FCM v1.")
+            PushService._check_circuit(service)
+            with get_concurrency_limiter(service).slot() as call:
+                try:
+                    result = send_fcm_v1_push_notification(payload["title"], payload["content"], payload["extra_args"], payload["tokens"], payload["badge_count"])
+                    logger.info("Push notification sent successfully via FCM v1.")
+                    PushService._report(service, call, result)
+                    return result
+                except Exception as e:
+                    logger.error(f"Failed to send push notification via FCM v1: {str(e)}")
+                    PushService._report(service, call, error=e)
+                    raise
 
         elif service == "sns":
             logger.info("SNS service is not implemented.")
@@ -34,3 +62,67 @@ class PushService:
             error_message = f"Unrecognized service type: {service}"
             logger.error(error_message)
             raise CustomException(error_message)
+
+    @staticmethod
+    async def send_push_async(service, payload):
+        """
+        Async version of send_push. FCM v1 sends over the shared HTTP/2 client of the event loop,
+        the firebase_admin path runs on a worker thread.
+
+        :return: The provider's result with per-token success and failure, if any.
+        :raises CustomException: If the service type is not recognized.
+        """
+        if service == "firebase_v1":
+            logger.info("Sending push notification via FCM v1.")
+            PushService._check_circuit(service)
+            async with get_concurrency_limiter(service).slot_async() as call:
+                try:
+                    result = await send_fcm_v1_push_notification_async(
+                        payload["title"], payload["content"], payload["extra_args"], payload["tokens"], payload["badge_count"],
+                        client=get_async_client("fcm_v1", get_fcm_v1_sender().new_client),
+                    )
+                    logger.info("Push notification sent successfully via FCM v1.")
+                    PushService._report(service, call, result)
+                    return result
+                except Exception as e:
+                    logger.error(f"Failed to send push notification via FCM v1: {str(e)}")
+                    PushService._report(service, call, error=e)
+                    raise
+
+        return await sync_to_async(PushService.send_push, thread_sensitive=False)(service, payload)
+
+    @staticmethod
+    def _check_circuit(service):
+        """
+        Fail fast while the circuit of the service is open.
+        """
+        if not get_circuit_breaker(service).allow_request():
+            logger.warning(f"Circuit of {service} is open, not sending push notification.")
+            raise CircuitOpenError(service)
+
+    @staticmethod
+    def _report(service, call, result=None, error=None):
+        """
+        Report a send to the circuit breaker and the concurrency limiter of the service, as failed
+        if it raised a retryable error or reached no token because of retryable errors. Sends
+        deferred by the rate limit or the request deadline never reached the provider and are not
+        reported as failed.
+        """
+        policy = get_retry_policy(service)
+        if error is not None:
+            if PushService._deferred(error):
+                return
+            failed = policy.is_retryable(error)
+        elif result is None or result.success_count > 0:
+            failed = False
+        else:
+            errors = [response.exception for response in result.responses if not response.success]
+            if errors and all(PushService._deferred(e) for e in errors):
+                return
+            failed = any(policy.is_retryable(e) and not PushService._deferred(e) for e in errors)
+        record_call(service, failed)
+        call.overloaded = failed
+
+    @staticmethod
+    def _deferred(error):
+        return isinstance(error, DeferredError) or isinstance(error.__cause__, DeferredError)
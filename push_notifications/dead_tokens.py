@@ -0,0 +1,134 @@
+import os
+import datetime
+import threading
+
+from django.utils import timezone
+from firebase_admin import messaging, exceptions
+
+from utilities.utils import logger
+from .models import DeadDeviceToken
+
+
+# Days a dead token is kept in the registry before it is sent to again.
+DEAD_TOKEN_TTL_DAYS = int(os.getenv("DEAD_TOKEN_TTL_DAYS", 30))
+# Seconds between incremental refreshes of the in-memory set from the database.
+DEAD_TOKEN_REFRESH_INTERVAL = int(os.getenv("DEAD_TOKEN_REFRESH_INTERVAL", 60))
+
+
+def dead_token_error_code(exception):
+    """
+    Return the error code if the exception means the token will never be deliverable, else None.
+    """
+    if isinstance(exception, messaging.UnregisteredError):
+        return "UNREGISTERED"
+    if isinstance(exception, messaging.SenderIdMismatchError):
+        return "SENDER_ID_MISMATCH"
+    if isinstance(exception, exceptions.InvalidArgumentError) and "registration token" in str(exception):
+        return "INVALID_TOKEN"
+    return None
+
+
+class DeadTokenRegistry:
+    """
+    Registry of dead device tokens, persisted in the database and checked through an in-memory set.
+
+    The set is loaded once, then every `refresh_interval` seconds only the entries updated since
+    the last refresh are fetched, so tokens reported by other processes are picked up without
+    reloading the table. A push waits for a refresh only on the first load; entries older than
+    `ttl_days` are ignored and removed by the purge_dead_tokens management command.
+    """
+
+    def __init__(self, ttl_days=DEAD_TOKEN_TTL_DAYS, refresh_interval=DEAD_TOKEN_REFRESH_INTERVAL):
+        self.ttl = datetime.timedelta(days=ttl_days)
+        self.refresh_interval = refresh_interval
+        # token -> time the token was last reported dead
+        self._tokens = dict()
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def filter(self, tokens):
+        """
+        Split tokens into the ones to send to and the dead ones.
+
+        :return: A tuple (live_tokens, dropped_tokens), both keeping the given order.
+        """
+        self._refresh()
+        expires_before = self._expires_before()
+        with self._lock:
+            dead_tokens = {token for token in tokens if self._tokens.get(token, expires_before) > expires_before}
+        live_tokens = [token for token in tokens if token not in dead_tokens]
+        dropped_tokens = [token for token in tokens if token in dead_tokens]
+        if dropped_tokens:
+            logger.info(f"Dropped {len(dropped_tokens)} dead device tokens.")
+        return live_tokens, dropped_tokens
+
+    def add_from_result(self, tokens, responses):
+        """
+        Record the tokens whose per-token error shows they are unregistered or invalid.
+
+        :param tokens: The tokens that were sent to.
+        :param responses: The messaging.SendResponse of each token, in the same order.
+        """
+        dead = dict()
+        for token, response in zip(tokens, responses):
+            error_code = None if response.success else dead_token_error_code(response.exception)
+            if error_code:
+                dead[token] = error_code
+        if not dead:
+            return
+
+        DeadDeviceToken.objects.bulk_create(
+            [DeadDeviceToken(token=token, error_code=error_code) for token, error_code in dead.items()],
+            update_conflicts=True,
+            unique_fields=["token"],
+            update_fields=["error_code", "updated_at"],
+        )
+        reported_at = timezone.now()
+        with self._lock:
+            self._tokens.update(dict.fromkeys(dead, reported_at))
+        logger.info(f"Registered {len(dead)} dead device tokens.")
+
+    def purge_expired(self):
+        """
+        Delete the entries older than the TTL.
+
+        :return: Number of entries deleted.
+        """
+        deleted, _ = DeadDeviceToken.objects.filter(updated_at__lt=self._expires_before()).delete()
+        return deleted
+
+    def _refresh(self):
+        """
+        Fetch the entries updated since the last refresh once the refresh interval has passed.
+
+        Only the first load makes concurrent pushes wait; afterwards a push finding a refresh
+        running goes on with the current set.
+        """
+        refreshed_at = self._refreshed_at
+        if refreshed_at is not None and (timezone.now() - refreshed_at).total_seconds() <= self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=refreshed_at is None):
+            return
+        try:
+            if self._refreshed_at is not refreshed_at:
+                return
+            started_at = timezone.now()
+            if refreshed_at is None:
+                entries = DeadDeviceToken.objects.filter(updated_at__gt=self._expires_before())
+            else:
+                # Overlap the previous refresh, for entries saved before it but committed after.
+                entries = DeadDeviceToken.objects.filter(updated_at__gt=refreshed_at - datetime.timedelta(seconds=self.refresh_interval))
+            updated = list(entries.values_list("token", "updated_at"))
+            with self._lock:
+                for token, updated_at in updated:
+                    self._tokens[token] = max(updated_at, self._tokens.get(token, updated_at))
+            self._refreshed_at = started_at
+        finally:
+            self._refresh_lock.release()
+
+    def _expires_before(self):
+        return timezone.now() - self.ttl
+
+
+dead_token_registry = DeadTokenRegistry()
@@ -0,0 +1,312 @@
+import os
+import time
+import asyncio
+import threading
+
+import httpx
+import firebase_admin
+import google.auth.credentials
+import google.auth.transport.requests
+from asgiref.sync import sync_to_async
+from firebase_admin import messaging, exceptions
+
+from utilities.utils import (
+    logger,
+    CustomException,
+)
+from utilities.retry import DeferredError
+from utilities.deadline import call_timeout
+from utilities.async_http import get_async_client, run_in_background_loop
+from common.delivery_log import log_delivery
+from .dead_tokens import dead_token_registry
+from .firebase import MulticastResult, FIREBASE_MESSAGES_PER_SECOND, get_firebase_rate_limiter
+
+
+FCM_V1_URL = "https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
+FCM_V1_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+# Maximum number of FCM v1 requests in flight at the same time, multiplexed over one HTTP/2 connection.
+FCM_V1_MAX_IN_FLIGHT = int(os.getenv("FCM_V1_MAX_IN_FLIGHT", 100))
+# Seconds to wait for FCM before a request is failed.
+FCM_V1_TIMEOUT = float(os.getenv("FCM_V1_TIMEOUT", 10))
+
+# Per-token error codes returned by FCM in the error details.
+FCM_ERROR_TYPES = {
+    "APNS_AUTH_ERROR": messaging.ThirdPartyAuthError,
+    "QUOTA_EXCEEDED": messaging.QuotaExceededError,
+    "SENDER_ID_MISMATCH": messaging.SenderIdMismatchError,
+    "THIRD_PARTY_AUTH_ERROR": messaging.ThirdPartyAuthError,
+    "UNREGISTERED": messaging.UnregisteredError,
+}
+# Canonical error statuses of Google APIs, used when FCM gives no error code.
+STATUS_ERROR_TYPES = {
+    "INVALID_ARGUMENT": exceptions.InvalidArgumentError,
+    "UNAUTHENTICATED": exceptions.UnauthenticatedError,
+    "PERMISSION_DENIED": exceptions.PermissionDeniedError,
+    "NOT_FOUND": exceptions.NotFoundError,
+    "RESOURCE_EXHAUSTED": exceptions.ResourceExhaustedError,
+    "UNAVAILABLE": exceptions.UnavailableError,
+    "INTERNAL": exceptions.InternalError,
+    "DEADLINE_EXCEEDED": exceptions.DeadlineExceededError,
+}
+# Errors caused by the request or the service rather than by the token it was sent to.
+REQUEST_ERROR_TYPES = (
+    exceptions.UnauthenticatedError,
+    exceptions.PermissionDeniedError,
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.UnknownError,
+)
+
+
+class AccessTokenCache:
+    """
+    OAuth access token of a Google credential, refreshed only once it is about to expire.
+    """
+
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        """
+        Return a valid access token, refreshing it first if it has expired.
+        """
+        with self._lock:
+            if not self._credentials.valid:
+                self._credentials.refresh(google.auth.transport.requests.Request())
+                logger.info("Refreshed FCM access token.")
+            return self._credentials.token
+
+    async def get_token_async(self):
+        """
+        Return a valid access token, refreshing it in a worker thread if it has expired.
+        """
+        if self._credentials.valid:
+            return self._credentials.token
+        return await asyncio.to_thread(self.get_token)
+
+
+def _fcm_error(status_code, body):
+    """
+    Create the firebase_admin exception matching an FCM v1 error response.
+    """
+    try:
+        error = body["error"]
+        message = error.get("message") or f"FCM request failed with status {status_code}."
+        error_codes = [detail.get("errorCode") for detail in error.get("details", [])]
+        status = error.get("status")
+    except (KeyError, TypeError, AttributeError):
+        return exceptions.UnknownError(f"FCM request failed with status {status_code}.")
+
+    for error_code in error_codes:
+        if error_code in FCM_ERROR_TYPES:
+            return FCM_ERROR_TYPES[error_code](message)
+    return STATUS_ERROR_TYPES.get(status, exceptions.UnknownError)(message)
+
+
+class FCMv1Sender:
+    """
+    Sends push notifications one message per token through the FCM v1 `messages:send` API.
+
+    The messages of a multicast are sent concurrently over a single HTTP/2 connection, with at
+    most `max_in_flight` requests outstanding.
+    """
+
+    def __init__(self, project_id, credentials, url=FCM_V1_URL, max_in_flight=FCM_V1_MAX_IN_FLIGHT,
+                 timeout=FCM_V1_TIMEOUT, http2_prior_knowledge=False):
+        self.project_id = project_id
+        self.url = httpx.URL(url.format(project_id=project_id))
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.http2_prior_knowledge = http2_prior_knowledge
+        self._access_token = AccessTokenCache(credentials)
+
+    def new_client(self):
+        """
+        Create the HTTP/2 client the requests of a multicast are multiplexed over.
+        """
+        return httpx.AsyncClient(
+            http1=not self.http2_prior_knowledge,
+            http2=True,
+            timeout=self.timeout,
+        )
+
+    @staticmethod
+    def build_message(title, content, extra_args, token, badge_count):
+        """
+        Create the FCM v1 message of a push notification for one token.
+        """
+        message = {
+            "token": token,
+            "notification": {"title": title, "body": content},
+            "android": {
+                "ttl": "3600s",
+                "priority": "high",
+                "notification": {"channel_id": "Notification-Microservice"},
+            },
+            "apns": {"payload": {"aps": {"sound": "default"}}},
+            "webpush": {"fcm_options": {"link": "https://google.com"}},
+        }
+        if extra_args:
+            message["data"] = extra_args
+        if badge_count is not None:
+            message["apns"]["payload"]["aps"]["badge"] = badge_count
+        return {"message": message}
+
+    async def send(self, client, message, timeout=None):
+        """
+        Send one message, returning its messaging.SendResponse instead of raising.
+
+        :param timeout: Seconds to wait for FCM, defaults to the sender's timeout.
+        """
+        try:
+            access_token = await self._access_token.get_token_async()
+            response = await client.post(
+                self.url,
+                json=message,
+                headers={"Authorization": f"Bearer {access_token}"},
+                timeout=timeout or self.timeout,
+            )
+        except httpx.TimeoutException as e:
+            return messaging.SendResponse(None, exceptions.DeadlineExceededError(str(e) or "FCM request timed out.", cause=e))
+        except Exception as e:
+            return messaging.SendResponse(None, exceptions.UnavailableError(str(e) or type(e).__name__, cause=e))
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if response.is_success:
+            return messaging.SendResponse(body, None)
+        return messaging.SendResponse(None, _fcm_error(response.status_code, body))
+
+    async def send_multicast(self, title, content, extra_args, tokens, badge_count, client=None):
+        """
+        Send the push notification to every token. The tokens the project's rate limit has no
+        tokens for in time, or left with too little of the request deadline, get a deferred error.
+
+        :param client: httpx.AsyncClient to send with, a new one is opened and closed if not given.
+        :return: List of messaging.SendResponse, one per token in the same order.
+        """
+        if client is None:
+            async with self.new_client() as client:
+                return await self.send_multicast(title, content, extra_args, tokens, badge_count, client)
+
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def send_to(token):
+            async with in_flight:
+                try:
+                    if FIREBASE_MESSAGES_PER_SECOND > 0:
+                        await get_firebase_rate_limiter(self.project_id).acquire_or_defer_async()
+                    timeout = call_timeout(self.timeout)
+                except DeferredError as e:
+                    log_delivery("push", "firebase_v1", [token], e)
+                    return messaging.SendResponse(None, e)
+                started_at = time.monotonic()
+                response = await self.send(client, self.build_message(title, content, extra_args, token, badge_count), timeout)
+                log_delivery("push", "firebase_v1", [token], response.exception, response.message_id, time.monotonic() - started_at)
+                return response
+
+        return await asyncio.gather(*(send_to(token) for token in tokens))
+
+
+_fcm_v1_sender = None
+_fcm_v1_sender_lock = threading.Lock()
+
+
+def get_fcm_v1_sender():
+    """
+    Return the process-wide FCM v1 sender, created from the initialized Firebase app on first use.
+
+    :raises CustomException: If Firebase is not initialized.
+    """
+    global _fcm_v1_sender
+    if _fcm_v1_sender is None:
+        with _fcm_v1_sender_lock:
+            if _fcm_v1_sender is None:
+                try:
+                    app = firebase_admin.get_app()
+                except ValueError:
+                    logger.error("Firebase is not initialized.")
+                    raise CustomException("Firebase is not initialized.")
+                credentials = google.auth.credentials.with_scopes_if_required(
+                    app.credential.get_credential(), [FCM_V1_SCOPE]
+                )
+                _fcm_v1_sender = FCMv1Sender(app.project_id, credentials)
+    return _fcm_v1_sender
+
+
+def _live_tokens(tokens):
+    """
+    Remove duplicate and known dead tokens, keeping their order.
+
+    :return: A tuple (live_tokens, dropped_tokens).
+    """
+    tokens, dropped_tokens = list(dict.fromkeys(tokens)), []
+    try:
+        tokens, dropped_tokens = dead_token_registry.filter(tokens)
+    except Exception as e:
+        logger.error(f"Failed to check dead device tokens: {str(e)}")
+    logger.info(f"Sending push notification to {len(tokens)} tokens via FCM v1.")
+    return tokens, dropped_tokens
+
+
+def _multicast_result(tokens, responses, dropped_tokens):
+    """
+    Collect the per-token responses of a push notification and register its dead tokens.
+
+    :raises CustomException: If every request failed without reaching FCM.
+    """
+    result = MulticastResult(tokens, responses, dropped_tokens)
+    # Fail the whole notification, like a failed multicast request, when FCM could not be reached at all
+    if responses and all(isinstance(response.exception, REQUEST_ERROR_TYPES) for response in responses):
+        raise CustomException(f"Failed to send push notification: {str(responses[0].exception)}") from responses[0].exception
+
+    try:
+        dead_token_registry.add_from_result(result.tokens, result.responses)
+    except Exception as e:
+        logger.error(f"Failed to register dead device tokens: {str(e)}")
+    logger.info(f"Push notification sent. Success: {result.success_count}, failure: {result.failure_count}.")
+    logger.debug(f"Failed tokens: {result.failed_tokens}")
+    return result
+
+
+async def send_fcm_v1_push_notification_async(title, content, extra_args, tokens, badge_count, client=None):
+    """
+    Sends a push notification to users via the FCM v1 API.
+
+    :param title: The title of the push notification.
+    :param content: The body content of the push notification.
+    :param extra_args: Additional data to send with the notification.
+    :param tokens: List of device tokens to send the notification to.
+    :param badge_count: Badge count to display on the app icon.
+    :param client: (Optional) httpx.AsyncClient to send with.
+    :return: MulticastResult with the per-token responses.
+    :raises CustomException: If Firebase is not initialized or every request failed without reaching FCM.
+    """
+    logger.info("Preparing to send push notification via FCM v1.")
+    sender = get_fcm_v1_sender()
+    tokens, dropped_tokens = await sync_to_async(_live_tokens, thread_sensitive=False)(tokens)
+    responses = await sender.send_multicast(title, content, extra_args, tokens, badge_count, client)
+    return await sync_to_async(_multicast_result, thread_sensitive=False)(tokens, responses, dropped_tokens)
+
+
+def send_fcm_v1_push_notification(title, content, extra_args, tokens, badge_count):
+    """
+    Blocking version of send_fcm_v1_push_notification_async for the synchronous views and workers.
+
+    The requests run on the process-wide background event loop over its shared HTTP/2 client, so
+    successive sends reuse the open connection to FCM instead of each paying a new TLS handshake.
+    """
+    logger.info("Preparing to send push notification via FCM v1.")
+    sender = get_fcm_v1_sender()
+    tokens, dropped_tokens = _live_tokens(tokens)
+
+    async def send_multicast():
+        client = get_async_client("fcm_v1", sender.new_client)
+        return await sender.send_multicast(title, content, extra_args, tokens, badge_count, client)
+
+    responses = run_in_background_loop(send_multicast)
+    return _multicast_result(tokens, responses, dropped_tokens)
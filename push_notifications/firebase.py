@@ -1,5 +1,7 @@
 import os
+import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import messaging
@@ -8,8 +10,16 @@ from utilities.utils import (
     logger,
     CustomException,
 )
+from utilities.retry import get_retry_policy
+from utilities.rate_limit import get_rate_limiter, rate_limit_key
+from utilities.deadline import DeadlineExceeded, call_timeout, propagate_deadline
+from common.delivery_log import log_delivery
+from .dead_tokens import dead_token_registry
 
 
+# Seconds to wait for the Firebase API on every request of the firebase_admin app.
+FIREBASE_TIMEOUT = float(os.getenv("FIREBASE_TIMEOUT", 10))
+
 try:
     # Load Firebase credentials from environment variables
     cred = credentials.Certificate({
@@ -26,11 +36,122 @@ try:
         "universe_domain": os.getenv("FIREBASE_UNIVERSE_DOMAIN")
     })
     # Initialize the Firebase app with the credentials
-    firebase_admin.initialize_app(cred)
+    firebase_admin.initialize_app(cred, {"httpTimeout": FIREBASE_TIMEOUT})
 except ValueError:
     pass
 
 
+# FCM rejects multicast messages with more tokens than this.
+FIREBASE_MULTICAST_MAX_TOKENS = 500
+# Maximum number of multicast chunks sent at the same time.
+FIREBASE_MAX_IN_FLIGHT = int(os.getenv("FIREBASE_MAX_IN_FLIGHT", 4))
+# Messages per second allowed for the Firebase project across the workers of the box, 0 disables the cap.
+FIREBASE_MESSAGES_PER_SECOND = float(os.getenv("FIREBASE_MESSAGES_PER_SECOND", 0))
+
+
+class MulticastResult(messaging.BatchResponse):
+    """
+    Merged response of the multicast chunks sent for one push notification.
+
+    `responses` holds one messaging.SendResponse per token of `tokens`, in the same order;
+    `dropped_tokens` are the known dead tokens that were not sent to.
+    """
+
+    def __init__(self, tokens, responses, dropped_tokens=None):
+        super().__init__(responses)
+        self.tokens = tokens
+        self.dropped_tokens = dropped_tokens or []
+
+    @property
+    def failed_tokens(self):
+        """
+        Dictionary of the tokens that could not be sent to, with their error.
+        """
+        return {
+            token: str(response.exception)
+            for token, response in zip(self.tokens, self.responses)
+            if not response.success
+        }
+
+    def retryable_tokens(self, provider_type):
+        """
+        Dictionary of the failed tokens whose error is worth retrying with the given provider, with their error.
+        """
+        policy = get_retry_policy(provider_type)
+        return {
+            token: str(response.exception)
+            for token, response in zip(self.tokens, self.responses)
+            if not response.success and policy.is_retryable(response.exception)
+        }
+
+
+def get_firebase_rate_limiter(project_id):
+    """
+    Token bucket of the messages of a Firebase project, holding at least a whole multicast chunk.
+    """
+    return get_rate_limiter(
+        rate_limit_key("firebase", project_id), FIREBASE_MESSAGES_PER_SECOND,
+        max(FIREBASE_MESSAGES_PER_SECOND, FIREBASE_MULTICAST_MAX_TOKENS),
+    )
+
+
+def _build_multicast_message(title, content, extra_args, tokens, badge_count):
+    """
+    Create the multicast message of a push notification for up to 500 tokens.
+    """
+    return messaging.MulticastMessage(
+        data=extra_args,
+        tokens=tokens,
+        notification=messaging.Notification(
+            title=title,
+            body=content
+        ),
+        apns=messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(badge=badge_count, sound="default"),
+            ),
+        ),
+        android=messaging.AndroidConfig(
+            ttl=datetime.timedelta(seconds=3600),  # Time-to-live
+            priority='high',
+            notification=messaging.AndroidNotification(
+                channel_id="Notification-Microservice"
+            ),
+        ),
+        webpush=messaging.WebpushConfig(
+            fcm_options=messaging.WebpushFCMOptions(
+                link="https://google.com"
+            )
+        )
+    )
+
+
+def _send_multicast_chunk(title, content, extra_args, tokens, badge_count):
+    """
+    Send one chunk of tokens, turning a failure of the whole request into per-token failures. A
+    chunk the project's rate limit has no tokens for in time fails with RateLimitExceeded, and one
+    left with too little of the request deadline with DeadlineExceeded, so its tokens are retried
+    through the queue.
+    """
+    try:
+        if FIREBASE_MESSAGES_PER_SECOND > 0:
+            get_firebase_rate_limiter(firebase_admin.get_app().project_id).acquire_or_defer(len(tokens))
+        # send_multicast takes no timeout, the request is bounded by the app's FIREBASE_TIMEOUT and
+        # is only started with at least that much of the request deadline left.
+        if call_timeout(FIREBASE_TIMEOUT) < FIREBASE_TIMEOUT:
+            raise DeadlineExceeded()
+        started_at = time.monotonic()
+        result = messaging.send_multicast(_build_multicast_message(title, content, extra_args, tokens, badge_count))
+        latency = time.monotonic() - started_at
+        for token, response in zip(tokens, result.responses):
+            log_delivery("push", "firebase", [token], response.exception, response.message_id, latency)
+        return result.responses, None
+    except Exception as e:
+        logger.error(f"Failed to send push notification to {len(tokens)} tokens: {str(e)}")
+        log_delivery("push", "firebase", tokens, e)
+        return [messaging.SendResponse(None, e) for _ in tokens], e
+
+
 def send_firebase_push_notification(title, content, extra_args, tokens, badge_count):
     """
     Sends a push notification to users via Firebase.
@@ -40,7 +161,7 @@ def send_firebase_push_notification(title, content, extra_args, tokens, badge_co
     :param extra_args: Additional data to send with the notification.
     :param tokens: List of device tokens to send the notification to.
     :param badge_count: Badge count to display on the app icon.
-    :return: The response from Firebase after sending the notification.
+    :return: MulticastResult with the merged per-token responses of every multicast chunk.
     :raises CustomException: If Firebase is not initialized or an error occurs during sending.
     """
     logger.info("Preparing to send push notification via Firebase.")
@@ -53,40 +174,37 @@ def send_firebase_push_notification(title, content, extra_args, tokens, badge_co
         logger.error("Firebase is not initialized.")
         raise CustomException("Firebase is not initialized.")
 
-    # Create the multicast message for Firebase
+    # Remove duplicate and known dead tokens, keeping their order, and split them in chunks FCM accepts
+    tokens, dropped_tokens = list(dict.fromkeys(tokens)), []
     try:
-        response = messaging.MulticastMessage(
-            data=extra_args,
-            tokens=list(set(tokens)),  # Remove duplicate tokens
-            notification=messaging.Notification(
-                title=title,
-                body=content
-            ),
-            apns=messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(badge=badge_count, sound="default"),
-                ),
-            ),
-            android=messaging.AndroidConfig(
-                ttl=datetime.timedelta(seconds=3600),  # Time-to-live
-                priority='high',
-                notification=messaging.AndroidNotification(
-                    channel_id="Notification-Microservice"
-                ),
-            ),
-            webpush=messaging.WebpushConfig(
-                fcm_options=messaging.WebpushFCMOptions(
-                    link="https://google.com"
-                )
-            )
-        )
+        tokens, dropped_tokens = dead_token_registry.filter(tokens)
+    except Exception as e:
+        logger.error(f"Failed to check dead device tokens: {str(e)}")
+    chunks = [
+        tokens[start:start + FIREBASE_MULTICAST_MAX_TOKENS]
+        for start in range(0, len(tokens), FIREBASE_MULTICAST_MAX_TOKENS)
+    ]
+    logger.info(f"Sending push notification to {len(tokens)} tokens in {len(chunks)} multicast requests.")
 
-        # Send the multicast message
-        result = messaging.send_multicast(response)
-        logger.info("Push notification sent successfully.")
-        logger.debug(f"Response: {result}")
+    with ThreadPoolExecutor(max_workers=max(1, min(FIREBASE_MAX_IN_FLIGHT, len(chunks)))) as executor:
+        chunk_results = list(executor.map(
+            propagate_deadline(lambda chunk: _send_multicast_chunk(title, content, extra_args, chunk, badge_count)),
+            chunks,
+        ))
 
-        return result
+    errors = [error for _, error in chunk_results if error is not None]
+    if chunks and len(errors) == len(chunks):
+        raise CustomException(f"Failed to send push notification: {str(errors[0])}") from errors[0]
+
+    result = MulticastResult(
+        tokens,
+        [response for responses, _ in chunk_results for response in responses],
+        dropped_tokens,
+    )
+    try:
+        dead_token_registry.add_from_result(result.tokens, result.responses)
     except Exception as e:
-        logger.error(f"Failed to send push notification: {str(e)}")
-        raise CustomException(f"Failed to send push notification: {str(e)}")
+        logger.error(f"Failed to register dead device tokens: {str(e)}")
+    logger.info(f"Push notification sent. Success: {result.success_count}, failure: {result.failure_count}.")
+    logger.debug(f"Failed tokens: {result.failed_tokens}")
+    return result
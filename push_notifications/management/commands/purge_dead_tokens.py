@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from push_notifications.dead_tokens import dead_token_registry
+
+
+class Command(BaseCommand):
+    """
+    Command for removing the dead token registry entries older than DEAD_TOKEN_TTL_DAYS, run periodically (e.g. daily from cron).
+    """
+
+    help = "Delete the expired entries of the dead device token registry."
+
+    def handle(self, *args, **options):
+        deleted = dead_token_registry.purge_expired()
+        self.stdout.write(f"Deleted {deleted} expired dead device tokens.")
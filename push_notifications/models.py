@@ -1,3 +1,14 @@
 from django.db import models
 
-# Create your models here.
+
+class DeadDeviceToken(models.Model):
+    """
+    Device token that Firebase reported as unregistered or invalid, skipped on later pushes.
+    """
+    token = models.CharField(max_length=512, unique=True)
+    error_code = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.token
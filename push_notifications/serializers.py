@@ -10,3 +10,4 @@ class SendFirebasePushSerializer(serializers.Serializer):
     tokens = serializers.ListField(allow_null=False, required=True, allow_empty=False)
     badge_count = serializers.IntegerField(allow_null=True, required=False)
     extra_args = serializers.JSONField(allow_null=True, required=False)
+    idempotency_key = serializers.CharField(max_length=255, required=False)
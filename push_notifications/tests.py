@@ -1,9 +1,25 @@
+import io
 import json
+import weakref
+from unittest import mock
+
+import httpx
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from firebase_admin import messaging
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from push_notifications import fcm_v1 as fcm_v1_module
+from push_notifications import firebase as firebase_module
+from push_notifications.dead_tokens import DeadTokenRegistry
+from push_notifications.models import DeadDeviceToken
+from utilities import async_http as async_http_module
+from utilities.utils import CustomException
+
 
+@override_settings(DEDUPE_STORE_PATH=":memory:")
 class SendPushAPIViewTests(APITestCase):
     def setUp(self):
         """
@@ -72,3 +88,182 @@ class SendPushAPIViewTests(APITestCase):
         )
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@override_settings(DELIVERY_LOG_ENABLED=False)
+class FirebaseMulticastChunkingTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(firebase_module.firebase_admin, "get_app")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        registry_patcher = mock.patch.object(firebase_module, "dead_token_registry", DeadTokenRegistry())
+        registry_patcher.start()
+        self.addCleanup(registry_patcher.stop)
+
+    def send_multicast(self, message):
+        if "bad-chunk" in message.tokens:
+            raise ValueError("Chunk rejected")
+        return messaging.BatchResponse([
+            messaging.SendResponse(None, messaging.UnregisteredError("Unregistered")) if token.startswith("stale")
+            else messaging.SendResponse({"name": f"projects/p/messages/{token}"}, None)
+            for token in message.tokens
+        ])
+
+    def test_tokens_are_deduplicated_chunked_and_merged(self):
+        """
+        Test that tokens are sent in chunks of 500 and the per-token results are merged in order.
+        """
+        tokens = [f"token-{index}" for index in range(1200)] + ["token-0", "stale-1"]
+        with mock.patch.object(messaging, "send_multicast", side_effect=self.send_multicast) as send_multicast:
+            result = firebase_module.send_firebase_push_notification("Title", "Content", {}, tokens, 1)
+
+        self.assertEqual([len(call.args[0].tokens) for call in send_multicast.call_args_list], [500, 500, 201])
+        self.assertEqual(len(result.responses), 1201)
+        self.assertEqual(result.success_count, 1200)
+        self.assertEqual(list(result.failed_tokens), ["stale-1"])
+
+    def test_failed_chunk_only_fails_its_tokens(self):
+        """
+        Test that a chunk whose request fails marks its own tokens as failed.
+        """
+        tokens = [f"token-{index}" for index in range(500)] + ["bad-chunk"]
+        with mock.patch.object(messaging, "send_multicast", side_effect=self.send_multicast):
+            result = firebase_module.send_firebase_push_notification("Title", "Content", {}, tokens, 1)
+
+        self.assertEqual(result.success_count, 500)
+        self.assertEqual(result.failed_tokens, {"bad-chunk": "Chunk rejected"})
+
+    def test_dead_tokens_are_registered_and_dropped_on_the_next_push(self):
+        """
+        Test that unregistered tokens are persisted and skipped, and listed as dropped, on later pushes.
+        """
+        with mock.patch.object(messaging, "send_multicast", side_effect=self.send_multicast) as send_multicast:
+            firebase_module.send_firebase_push_notification("Title", "Content", {}, ["token-1", "stale-1"], 1)
+            result = firebase_module.send_firebase_push_notification("Title", "Content", {}, ["token-1", "stale-1"], 1)
+
+        self.assertEqual(list(DeadDeviceToken.objects.values_list("token", "error_code")), [("stale-1", "UNREGISTERED")])
+        self.assertEqual(send_multicast.call_args_list[1].args[0].tokens, ["token-1"])
+        self.assertEqual(result.dropped_tokens, ["stale-1"])
+
+    def test_dead_tokens_expire_after_the_ttl(self):
+        """
+        Test that registry entries older than the TTL are sent to again, and removed by purge_dead_tokens.
+        """
+        DeadDeviceToken.objects.create(token="stale-1", error_code="UNREGISTERED")
+        DeadDeviceToken.objects.update(updated_at=firebase_module.datetime.datetime(2000, 1, 1, tzinfo=firebase_module.datetime.timezone.utc))
+
+        live_tokens, dropped_tokens = DeadTokenRegistry(ttl_days=30).filter(["stale-1"])
+        call_command("purge_dead_tokens", stdout=io.StringIO())
+
+        self.assertEqual((live_tokens, dropped_tokens), (["stale-1"], []))
+        self.assertFalse(DeadDeviceToken.objects.exists())
+
+    def test_registry_checks_in_memory_and_refreshes_incrementally(self):
+        """
+        Test that pushes are checked without a query between refreshes, and that a refresh picks up
+        tokens registered by other processes.
+        """
+        registry = DeadTokenRegistry(refresh_interval=60)
+        DeadDeviceToken.objects.create(token="stale-1", error_code="UNREGISTERED")
+        self.assertEqual(registry.filter(["token-1", "stale-1"]), (["token-1"], ["stale-1"]))
+
+        DeadDeviceToken.objects.create(token="stale-2", error_code="UNREGISTERED")
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.filter(["stale-2"]), (["stale-2"], []))
+
+        registry._refreshed_at -= firebase_module.datetime.timedelta(seconds=61)
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.filter(["stale-1", "stale-2"]), ([], ["stale-1", "stale-2"]))
+
+
+class FakeCredentials:
+    def __init__(self):
+        self.valid = False
+        self.token = None
+        self.refresh_count = 0
+
+    def refresh(self, request):
+        self.refresh_count += 1
+        self.token = f"access-token-{self.refresh_count}"
+        self.valid = True
+
+
+@override_settings(DELIVERY_LOG_ENABLED=False)
+class FCMv1SenderTests(TestCase):
+    def setUp(self):
+        self.credentials = FakeCredentials()
+        self.sender = fcm_v1_module.FCMv1Sender("project", self.credentials, max_in_flight=5)
+        self.requests = list()
+        self.clients = list()
+        self.sender.new_client = self.new_client
+        sender_patcher = mock.patch.object(fcm_v1_module, "get_fcm_v1_sender", return_value=self.sender)
+        sender_patcher.start()
+        self.addCleanup(sender_patcher.stop)
+        registry_patcher = mock.patch.object(fcm_v1_module, "dead_token_registry", DeadTokenRegistry())
+        registry_patcher.start()
+        self.addCleanup(registry_patcher.stop)
+        # Clients of the background loop would otherwise outlive the sender of the test
+        clients_patcher = mock.patch.object(async_http_module, "_async_clients", weakref.WeakKeyDictionary())
+        clients_patcher.start()
+        self.addCleanup(clients_patcher.stop)
+
+    def new_client(self):
+        self.clients.append(httpx.AsyncClient(transport=httpx.MockTransport(self.handle)))
+        return self.clients[-1]
+
+    def handle(self, request):
+        self.requests.append(request)
+        token = json.loads(request.content)["message"]["token"]
+        if token.startswith("stale"):
+            return httpx.Response(404, json={"error": {
+                "code": 404, "message": "Requested entity was not found.", "status": "NOT_FOUND",
+                "details": [{"@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError", "errorCode": "UNREGISTERED"}],
+            }})
+        if token.startswith("down"):
+            return httpx.Response(503, json={"error": {"code": 503, "message": "Unavailable", "status": "UNAVAILABLE"}})
+        return httpx.Response(200, json={"name": f"projects/project/messages/{token}"})
+
+    def test_one_request_per_token_with_a_cached_access_token(self):
+        """
+        Test that every token gets its own v1 request, and that successive sends share one client and access token.
+        """
+        tokens = [f"token-{index}" for index in range(20)] + ["token-0"]
+        result = fcm_v1_module.send_fcm_v1_push_notification("Title", "Content", {"key": "value"}, tokens, 3)
+        fcm_v1_module.send_fcm_v1_push_notification("Title", "Content", None, ["token-1"], None)
+
+        self.assertEqual(result.success_count, 20)
+        self.assertEqual(result.responses[0].message_id, "projects/project/messages/token-0")
+        self.assertEqual(len(self.requests), 21)
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.credentials.refresh_count, 1)
+        self.assertEqual(self.requests[0].url, "https://fcm.googleapis.com/v1/projects/project/messages:send")
+        self.assertEqual(self.requests[0].headers["Authorization"], "Bearer access-token-1")
+        message = json.loads(self.requests[0].content)["message"]
+        self.assertEqual(message["data"], {"key": "value"})
+        self.assertEqual(message["apns"]["payload"]["aps"]["badge"], 3)
+
+    def test_unregistered_tokens_fail_and_are_registered_as_dead(self):
+        """
+        Test that FCM error codes map to the firebase_admin errors the dead token registry uses.
+        """
+        result = fcm_v1_module.send_fcm_v1_push_notification("Title", "Content", {}, ["token-1", "stale-1"], 1)
+
+        self.assertEqual(result.failed_tokens, {"stale-1": "Requested entity was not found."})
+        self.assertIsInstance(result.responses[1].exception, messaging.UnregisteredError)
+        self.assertEqual(list(DeadDeviceToken.objects.values_list("token", flat=True)), ["stale-1"])
+
+    def test_unavailable_tokens_are_retryable(self):
+        """
+        Test that tokens failing with a 503 are retryable while unregistered ones are not.
+        """
+        result = fcm_v1_module.send_fcm_v1_push_notification("Title", "Content", {}, ["token-1", "stale-1", "down-1"], 1)
+
+        self.assertEqual(set(result.failed_tokens), {"stale-1", "down-1"})
+        self.assertEqual(result.retryable_tokens("firebase_v1"), {"down-1": "Unavailable"})
+
+    def test_raises_when_fcm_cannot_be_reached(self):
+        """
+        Test that the notification fails as a whole when every request fails on the service side.
+        """
+        with self.assertRaises(CustomException):
+            fcm_v1_module.send_fcm_v1_push_notification("Title", "Content", {}, ["down-1", "down-2"], 1)
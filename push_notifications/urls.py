@@ -1,10 +1,12 @@
 from django.urls import path
 
 from .views import (
+    AsyncSendPushAPIView,
     SendPushAPIView,
 )
 
 
 urlpatterns = [
     path("send/push/<str:service_type>/", SendPushAPIView.as_view(), name="send-push"),
+    path("send/push/<str:service_type>/async/", AsyncSendPushAPIView.as_view(), name="send-push-async"),
 ]
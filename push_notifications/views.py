@@ -1,5 +1,8 @@
 import copy
+import asyncio
 from drf_yasg import openapi
+from adrf.generics import GenericAPIView as AsyncGenericAPIView
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.generics import (
     CreateAPIView,
@@ -17,8 +20,10 @@ from utilities.utils import (
 from .serializers import (
     SendFirebasePushSerializer,
 )
-from utilities.sqs import push_message_to_sqs
-from utilities.constants import PUSH_SERVICE_CHOICE
+from utilities.sqs import push_messages_to_sqs
+from utilities.dedupe import get_dedupe_store
+from utilities.retry import get_retry_policy, schedule_payload_retries
+from utilities.constants import DEFAULT_PRIORITY, PRIORITY_CHOICES, PUSH_SERVICE_CHOICE
 from utilities.permissions import IsAuthenticatedPermission
 
 
@@ -37,34 +42,47 @@ class SendPushAPIView(CreateAPIView):
         self.response_format = ResponseInfo().response
         self.failed_messages_response_list = list()
         self.failed_payload = list()
+        self.retry_payload = list()
+        self.retried_payload = list()
+        self.dropped_tokens = list()
+        self.priority = DEFAULT_PRIORITY
         super(SendPushAPIView, self).__init__(**kwargs)
         logger.debug("SendPushAPIView instance initialized.")
 
     def send_push_service(self, service_type, payload):
         """
-        Method to make service for push service.
+        Method to make service for push service, skipping notifications already sent within the dedupe window.
         """
-        PushService().send_push(service_type, payload)
+        return get_dedupe_store().send_once(
+            "push", payload,
+            lambda data: PushService().send_push(service_type, data),
+            is_sent=self.push_sent,
+        )
 
-    @swagger_auto_schema(
-        manual_parameters=[
-            openapi.Parameter(
-                'service_type',
-                openapi.IN_PATH,
-                description="Service type (e.g., 'firebase')",
-                type=openapi.TYPE_STRING,
-                enum=['firebase']
-            ),
-        ],
-    )
-    def post(self, request, *args, **kwargs):
+    async def send_push_service_async(self, service_type, payload):
         """
-        Handle POST requests to send push notifications.
+        Async version of send_push_service.
         """
-        logger.info("POST request received for sending push notifications.")
+        return await get_dedupe_store().send_once_async(
+            "push", payload,
+            lambda data: PushService().send_push_async(service_type, data),
+            is_sent=self.push_sent,
+        )
 
-        # Retrieve the service type from URL parameters
-        service_type = self.kwargs["service_type"]
+    @staticmethod
+    def push_sent(result):
+        """
+        Whether the notification reached at least one token, or had no token left to send to.
+        """
+        return result is None or result.success_count > 0 or result.failure_count == 0
+
+    def split_payload(self, request, service_type):
+        """
+        Validate the payload items of a request, recording the invalid ones as failed.
+
+        :return: A tuple (queued_payload, direct_payload) of (request_data, data) pairs, data being
+                 the queue message for queued items and the validated data for the others.
+        """
         logger.debug(f"Service type received: {service_type}")
 
         if service_type not in PUSH_SERVICE_CHOICE:
@@ -72,6 +90,13 @@ class SendPushAPIView(CreateAPIView):
             raise CustomException("Invalid service type.", 400)
 
         use_sqs = request.data.get("use_sqs", False)
+        priority = request.data.get("priority", DEFAULT_PRIORITY)
+        if priority not in PRIORITY_CHOICES:
+            logger.error(f"Invalid priority: {priority}")
+            raise CustomException(messages.VALID_PARAMS.format(', '.join(PRIORITY_CHOICES)))
+        self.priority = priority
+        queued_payload = list()
+        direct_payload = list()
 
         logger.debug(f"Looping for payload.")
         for request_data in request.data.get("payload", []):
@@ -82,33 +107,92 @@ class SendPushAPIView(CreateAPIView):
 
                 logger.info("Push notification data validated successfully.")
 
-                try:
-                    if use_sqs:
-                        message = {
-                            "provider_type": "firebase",
-                            "service_type": "push",
-                            "service_data": push_serializer.validated_data
-                        }
-                        push_message_to_sqs(message)
-                    else:
-                        self.send_push_service(service_type, push_serializer.validated_data)
-                        logger.info("Push notification sent successfully.")
-
-                except Exception as e:
-                    # Log any errors that occur during push notification sending
-                    logger.error(f"Error sending push notification: {str(e)}")
-                    self.response_format["data"] = None
-                    self.response_format["error"] = str(e)
-                    self.response_format["status_code"] = status.HTTP_500_INTERNAL_SERVER_ERROR
-                    self.response_format["message"] = [messages.FAILURE.format("Push Notification")]
-                    return Response(self.response_format, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                if use_sqs:
+                    message = {
+                        "provider_type": service_type,
+                        "service_type": "push",
+                        "priority": priority,
+                        "service_data": push_serializer.validated_data
+                    }
+                    queued_payload.append((request_data, message))
+                else:
+                    direct_payload.append((request_data, push_serializer.validated_data))
             else:
                 payload_copy = copy.deepcopy(request_data)
                 payload_copy["errors"] = push_serializer.errors
                 self.failed_payload.append(payload_copy)
 
+        return queued_payload, direct_payload
+
+    def record_result(self, service_type, request_data, validated_data, result):
+        """
+        Record the dropped tokens and the tokens the provider failed to send to, the ones worth
+        retrying apart. result is the provider's result, or the error raised for the whole notification.
+        """
+        if isinstance(result, Exception):
+            self.record_error(service_type, request_data, validated_data, result)
+            return
+
+        logger.info("Push notification sent successfully.")
+        if result is None:
+            return
+        self.dropped_tokens.extend(result.dropped_tokens)
+        if not result.failure_count:
+            return
+
+        retryable_tokens = result.retryable_tokens(service_type)
+        if retryable_tokens:
+            logger.warning(f"Failed to send push notification to {len(retryable_tokens)} tokens, retrying later.")
+            self.retry_payload.append((
+                request_data,
+                {**validated_data, "tokens": list(retryable_tokens)},
+                {"failed_tokens": retryable_tokens},
+            ))
+        failed_tokens = {token: error for token, error in result.failed_tokens.items() if token not in retryable_tokens}
+        if failed_tokens:
+            payload_copy = copy.deepcopy(request_data)
+            payload_copy["errors"] = {"failed_tokens": failed_tokens}
+            self.failed_payload.append(payload_copy)
+
+    def record_error(self, service_type, request_data, validated_data, error):
+        """
+        Record a push notification the provider could not send at all.
+        """
+        # Log any errors that occur during push notification sending
+        logger.error(f"Error sending push notification: {str(error)}")
+        if get_retry_policy(service_type).is_retryable(error):
+            self.retry_payload.append((request_data, validated_data, str(error)))
+            return
+        payload_copy = copy.deepcopy(request_data)
+        payload_copy["errors"] = str(error)
+        self.failed_payload.append(payload_copy)
+
+    def record_queue_failures(self, queued_payload, failed_messages):
+        """
+        Record the payload items that could not be enqueued.
+        """
+        for index, error in failed_messages:
+            payload_copy = copy.deepcopy(queued_payload[index][0])
+            payload_copy["errors"] = error
+            self.failed_payload.append(payload_copy)
+
+    def schedule_retries(self, service_type):
+        """
+        Enqueue the retry of the notifications and tokens that failed with a retryable error.
+        """
+        retried_payload, failed_payload = schedule_payload_retries("push", service_type, self.priority, self.retry_payload)
+        self.retried_payload.extend(retried_payload)
+        self.failed_payload.extend(failed_payload)
+        self.retry_payload = list()
+
+    def sent_response(self):
+        """
+        Response listing the failed payload items, the ones scheduled for a retry and the dropped tokens, if any.
+        """
         response_data = {
-            "failed_payload": None
+            "failed_payload": None,
+            "retried_payload": self.retried_payload or None,
+            "dropped_tokens": self.dropped_tokens or None,
         }
         if len(self.failed_payload) > 0:
             response_data["failed_payload"] = self.failed_payload
@@ -119,3 +203,82 @@ class SendPushAPIView(CreateAPIView):
         self.response_format["status_code"] = status.HTTP_200_OK
         self.response_format["message"] = [messages.SHARED.format("Push Notification")]
         return Response(self.response_format)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'service_type',
+                openapi.IN_PATH,
+                description="Service type (e.g., 'firebase')",
+                type=openapi.TYPE_STRING,
+                enum=['firebase', 'firebase_v1']
+            ),
+        ],
+    )
+    def post(self, request, *args, **kwargs):
+        """
+        Handle POST requests to send push notifications.
+        """
+        logger.info("POST request received for sending push notifications.")
+
+        # Retrieve the service type from URL parameters
+        service_type = self.kwargs["service_type"]
+        queued_payload, direct_payload = self.split_payload(request, service_type)
+
+        for request_data, validated_data in direct_payload:
+            try:
+                result = self.send_push_service(service_type, validated_data)
+            except Exception as e:
+                result = e
+            self.record_result(service_type, request_data, validated_data, result)
+        if self.retry_payload:
+            self.schedule_retries(service_type)
+
+        if queued_payload:
+            self.record_queue_failures(queued_payload, push_messages_to_sqs([message for _, message in queued_payload]))
+
+        return self.sent_response()
+
+
+class AsyncSendPushAPIView(AsyncGenericAPIView, SendPushAPIView):
+    """
+    API view for sending push notifications, without holding a thread while the provider answers.
+    """
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'service_type',
+                openapi.IN_PATH,
+                description="Service type (e.g., 'firebase')",
+                type=openapi.TYPE_STRING,
+                enum=['firebase', 'firebase_v1']
+            ),
+        ],
+    )
+    async def post(self, request, *args, **kwargs):
+        """
+        Handle POST requests to send push notifications on the ASGI event loop, sending the
+        payload items concurrently.
+        """
+        logger.info("POST request received for sending push notifications.")
+
+        service_type = self.kwargs["service_type"]
+        queued_payload, direct_payload = self.split_payload(request, service_type)
+
+        results = await asyncio.gather(
+            *(self.send_push_service_async(service_type, validated_data) for _, validated_data in direct_payload),
+            return_exceptions=True,
+        )
+        for (request_data, validated_data), result in zip(direct_payload, results):
+            self.record_result(service_type, request_data, validated_data, result)
+        if self.retry_payload:
+            await sync_to_async(self.schedule_retries, thread_sensitive=False)(service_type)
+
+        if queued_payload:
+            failed_messages = await sync_to_async(push_messages_to_sqs, thread_sensitive=False)(
+                [message for _, message in queued_payload]
+            )
+            self.record_queue_failures(queued_payload, failed_messages)
+
+        return self.sent_response()
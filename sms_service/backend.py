@@ -1,19 +1,106 @@
-from .twilio import send_twilio_sms
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .twilio import send_twilio_sms, send_twilio_sms_async
 from utilities.utils import logger
+from utilities.retry import RetryableError, DeferredError
+from utilities.circuit_breaker import CircuitOpenError, get_circuit_breaker
+from utilities.concurrency import get_concurrency_limiter
+from utilities.deadline import propagate_deadline
+
+
+# Maximum number of SMS requests in flight for a single send_sms call, 1 sends one after another.
+SMS_MAX_IN_FLIGHT = int(os.getenv("SMS_MAX_IN_FLIGHT", 10))
+
+
+class FailedNumbers(list):
+    """
+    Numbers an SMS could not be sent to. The numbers that failed with a retryable error are not in
+    the list but in `retry_numbers`, a dictionary of their errors.
+    """
+
+    def __init__(self, numbers=(), retry_numbers=None):
+        super().__init__(numbers)
+        self.retry_numbers = retry_numbers or dict()
 
 
 class SmsService:
     @staticmethod
-    def send_sms(service, message, send_to):
+    def send_sms(service, message, send_to, max_in_flight=None):
+        """
+        Send an SMS to every number of send_to.
+
+        With more than one number the sends are fanned out on a thread pool with at most
+        max_in_flight (default SMS_MAX_IN_FLIGHT) requests in flight; the account's
+        messages-per-second cap is applied by the provider function. While the Twilio circuit is
+        open the numbers fail fast with a retryable error instead of waiting for Twilio. Requests
+        in flight to Twilio across the process are bounded by its adaptive concurrency limit, and
+        the numbers left without time before the request deadline are deferred with a retryable error.
+
+        :return: FailedNumbers the message could not be sent to, None for unsupported services.
+        """
+        if service == "twilio":
+            def send_to_number(ph_no):
+                try:
+                    if not get_circuit_breaker("twilio").allow_request():
+                        raise CircuitOpenError("twilio")
+                    with get_concurrency_limiter("twilio").slot() as call:
+                        try:
+                            return send_twilio_sms(message, ph_no), None
+                        except RetryableError as e:
+                            call.overloaded = not isinstance(e, DeferredError)
+                            raise
+                except RetryableError as e:
+                    return None, str(e)
+
+            max_in_flight = max_in_flight or SMS_MAX_IN_FLIGHT
+            if max_in_flight <= 1 or len(send_to) <= 1:
+                results = [send_to_number(ph_no) for ph_no in send_to]
+            else:
+                with ThreadPoolExecutor(max_workers=min(max_in_flight, len(send_to))) as executor:
+                    results = list(executor.map(propagate_deadline(send_to_number), send_to))
+            return SmsService._failed_numbers(send_to, results)
+        else:
+            logger.warning(f"Unsupported service: {service}")
+            return None
+
+    @staticmethod
+    async def send_sms_async(service, message, send_to, max_in_flight=None):
+        """
+        Async version of send_sms, sending to at most max_in_flight numbers at the same time.
 
+        :return: FailedNumbers the message could not be sent to, None for unsupported services.
+        """
         if service == "twilio":
-            failed_message_list = list()
-            for ph_no in send_to:
-                failed_message = send_twilio_sms(message, ph_no)
-                if failed_message:
-                    failed_message_list.append(failed_message)
-            return failed_message_list
+            in_flight = asyncio.Semaphore(max_in_flight or SMS_MAX_IN_FLIGHT)
+
+            async def send_to_number(ph_no):
+                async with in_flight:
+                    try:
+                        if not get_circuit_breaker("twilio").allow_request():
+                            raise CircuitOpenError("twilio")
+                        async with get_concurrency_limiter("twilio").slot_async() as call:
+                            try:
+                                return await send_twilio_sms_async(message, ph_no), None
+                            except RetryableError as e:
+                                call.overloaded = not isinstance(e, DeferredError)
+                                raise
+                    except RetryableError as e:
+                        return None, str(e)
+
+            results = await asyncio.gather(*(send_to_number(ph_no) for ph_no in send_to))
+            return SmsService._failed_numbers(send_to, results)
         else:
             logger.warning(f"Unsupported service: {service}")
             return None
 
+    @staticmethod
+    def _failed_numbers(send_to, results):
+        """
+        Collect the (failed number, retryable error) results of the numbers of send_to.
+        """
+        return FailedNumbers(
+            [failed_message for failed_message, _ in results if failed_message],
+            {ph_no: error for ph_no, (_, error) in zip(send_to, results) if error is not None},
+        )
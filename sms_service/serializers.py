@@ -8,4 +8,5 @@ from utilities.constants import (
 
 class SmsServiceSerializer(serializers.Serializer):
     message = serializers.CharField(allow_null=False, allow_blank=False)
-    send_to = serializers.ListField(child=serializers.CharField(allow_null=False, allow_blank=False), allow_null=False, allow_empty=False)
\ No newline at end of file
+    send_to = serializers.ListField(child=serializers.CharField(allow_null=False, allow_blank=False), allow_null=False, allow_empty=False)
+    idempotency_key = serializers.CharField(max_length=255, required=False)
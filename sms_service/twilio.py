@@ -1,29 +1,179 @@
 import os
+import time
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.base.client_base import TwilioException
 
 from utilities.utils import logger, CustomException
+from utilities.rate_limit import get_rate_limiter, rate_limit_key
+from utilities.retry import DeferredError, RetryableError, get_retry_policy
+from utilities.circuit_breaker import record_call
+from utilities.async_http import get_async_client
+from utilities.deadline import call_timeout
+from common.delivery_log import log_delivery
+
+
+# Keep-alive connections kept open per Twilio client, shared by the threads sending with it.
+TWILIO_POOL_SIZE = int(os.getenv("TWILIO_POOL_SIZE", 32))
+# Messages per second allowed for the Twilio account across the workers of the box, 0 disables the cap.
+TWILIO_MESSAGES_PER_SECOND = float(os.getenv("TWILIO_MESSAGES_PER_SECOND", 0))
+# Seconds to wait for the Twilio API.
+TWILIO_TIMEOUT = float(os.getenv("TWILIO_TIMEOUT", 10))
+TWILIO_MESSAGES_URL = "https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
+
+_twilio_clients = dict()
+_twilio_clients_lock = threading.Lock()
+
+
+class DeadlineTwilioHttpClient(TwilioHttpClient):
+    """
+    TwilioHttpClient whose requests time out after TWILIO_TIMEOUT seconds, cut to what is left of
+    the request deadline.
+    """
+
+    def request(self, *args, timeout=None, **kwargs):
+        """
+        Make an HTTP request to the Twilio API.
+
+        :raises DeadlineExceeded: If too little of the request deadline is left.
+        """
+        return super().request(*args, timeout=call_timeout(timeout or self.timeout), **kwargs)
+
+
+def get_twilio_client(account_sid=None, auth_token=None):
+    """
+    Return the process-wide Twilio client for the given credentials, creating it on first use.
+
+    The client's HTTP session keeps a pool of keep-alive connections to the Twilio API, so
+    consecutive sends reuse an open TLS connection instead of doing a new handshake.
+
+    :param account_sid: Twilio account SID, defaults to TWILIO_ACCOUNT_SID.
+    :param auth_token: Twilio auth token, defaults to TWILIO_AUTH_TOKEN.
+    :return: A twilio.rest.Client instance.
+    """
+    account_sid = account_sid or os.getenv("TWILIO_ACCOUNT_SID")
+    auth_token = auth_token or os.getenv("TWILIO_AUTH_TOKEN")
+    key = (account_sid, auth_token)
+
+    client = _twilio_clients.get(key)
+    if client is None:
+        with _twilio_clients_lock:
+            client = _twilio_clients.get(key)
+            if client is None:
+                http_client = DeadlineTwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT)
+                http_client.session.mount(
+                    "https://", HTTPAdapter(pool_connections=1, pool_maxsize=TWILIO_POOL_SIZE)
+                )
+                client = Client(account_sid, auth_token, http_client=http_client)
+                _twilio_clients[key] = client
+                logger.info("Created Twilio client.")
+    return client
 
 
 def send_twilio_sms(message, send_to):
-    failed_messages = list()
+    """
+    Send an SMS to one number through the shared Twilio client.
+
+    :return: send_to if Twilio rejected the number, else None.
+    :raises RetryableError: If Twilio could not be reached or answered with a retryable status, or
+                            the account's rate limit left no token in time (RateLimitExceeded), or
+                            too little of the request deadline is left (DeadlineExceeded).
+    :raises CustomException: If the Twilio credentials are missing.
+    """
+    started_at = time.monotonic()
     try:
-        client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+        client = get_twilio_client()
+        if TWILIO_MESSAGES_PER_SECOND > 0:
+            get_rate_limiter(rate_limit_key("twilio", client.username), TWILIO_MESSAGES_PER_SECOND).acquire_or_defer()
+            started_at = time.monotonic()
         message_sent = client.messages.create(
             body=message,
             from_=os.getenv("TWILIO_PHONE_NUMBER"),
             to=send_to
         )
         logger.info(f"SMS sent to {send_to}, SID: {message_sent.sid}")
+        record_call("twilio", False)
+        log_delivery("sms", "twilio", [send_to], provider_message_id=message_sent.sid, latency=time.monotonic() - started_at)
 
     except TwilioException as e:
         logger.error(f"Failed to send SMS to {send_to}. Error: {str(e)}")
         if type(e) == TwilioException and str(e) == "Credentials are required to create a TwilioClient":
             logger.error("Invalid Twilio credentials.")
             raise CustomException("Invalid Twilio credentials.")
-        elif e.status == 400:
-            return send_to
-    #
-    # return failed_messages
+        retryable = get_retry_policy("twilio").is_retryable(e)
+        record_call("twilio", retryable)
+        log_delivery("sms", "twilio", [send_to], e, latency=time.monotonic() - started_at)
+        if retryable:
+            raise RetryableError(str(e)) from e
+        return send_to
+    except (requests.ConnectionError, requests.Timeout) as e:
+        logger.error(f"Failed to reach Twilio for {send_to}. Error: {str(e)}")
+        record_call("twilio", True)
+        log_delivery("sms", "twilio", [send_to], e, latency=time.monotonic() - started_at)
+        raise RetryableError(str(e)) from e
+    except DeferredError as e:
+        log_delivery("sms", "twilio", [send_to], e)
+        raise
+
+
+def _new_twilio_async_client():
+    return httpx.AsyncClient(
+        timeout=TWILIO_TIMEOUT,
+        limits=httpx.Limits(max_connections=TWILIO_POOL_SIZE, max_keepalive_connections=TWILIO_POOL_SIZE),
+    )
+
 
+async def send_twilio_sms_async(message, send_to):
+    """
+    Async version of send_twilio_sms, calling the Twilio Messages API with the shared async HTTP client.
+
+    :return: send_to if Twilio rejected the number, else None.
+    :raises RetryableError: If Twilio could not be reached or answered with a retryable status, or
+                            the send was deferred by the rate limit or the request deadline.
+    :raises CustomException: If the Twilio credentials are missing.
+    """
+    account_sid = os.getenv("TWILIO_ACCOUNT_SID")
+    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+    if not account_sid or not auth_token:
+        logger.error("Invalid Twilio credentials.")
+        raise CustomException("Invalid Twilio credentials.")
+
+    try:
+        if TWILIO_MESSAGES_PER_SECOND > 0:
+            await get_rate_limiter(rate_limit_key("twilio", account_sid), TWILIO_MESSAGES_PER_SECOND).acquire_or_defer_async()
+        timeout = call_timeout(TWILIO_TIMEOUT)
+    except DeferredError as e:
+        log_delivery("sms", "twilio", [send_to], e)
+        raise
+    started_at = time.monotonic()
+    try:
+        response = await get_async_client("twilio", _new_twilio_async_client).post(
+            TWILIO_MESSAGES_URL.format(account_sid=account_sid),
+            data={"To": send_to, "From": os.getenv("TWILIO_PHONE_NUMBER"), "Body": message},
+            auth=(account_sid, auth_token),
+            timeout=timeout,
+        )
+    except httpx.TransportError as e:
+        logger.error(f"Failed to reach Twilio for {send_to}. Error: {str(e)}")
+        record_call("twilio", True)
+        log_delivery("sms", "twilio", [send_to], e, latency=time.monotonic() - started_at)
+        raise RetryableError(str(e)) from e
+    latency = time.monotonic() - started_at
+    if response.is_success:
+        sid = response.json().get('sid')
+        logger.info(f"SMS sent to {send_to}, SID: {sid}")
+        record_call("twilio", False)
+        log_delivery("sms", "twilio", [send_to], provider_message_id=sid, latency=latency)
+        return None
 
+    logger.error(f"Failed to send SMS to {send_to}. Error: {response.text}")
+    retryable = get_retry_policy("twilio").retryable_status(response.status_code)
+    record_call("twilio", retryable)
+    log_delivery("sms", "twilio", [send_to], CustomException(response.text, response.status_code), latency=latency)
+    if retryable:
+        raise RetryableError(f"HTTP Error {response.status_code}: {response.text}")
+    return send_to
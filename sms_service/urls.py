@@ -1,9 +1,10 @@
 from django.urls import path
 
-from .views import SmsServiceAPIView
+from .views import AsyncSmsServiceAPIView, SmsServiceAPIView
 
 
 urlpatterns = [
     path("send/sms/<str:service_type>/", SmsServiceAPIView.as_view(), name="send-sms"),
+    path("send/sms/<str:service_type>/async/", AsyncSmsServiceAPIView.as_view(), name="send-sms-async"),
 ]
 
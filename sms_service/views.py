@@ -1,6 +1,9 @@
 import copy
 import os
+import asyncio
 from drf_yasg import openapi
+from adrf.generics import GenericAPIView as AsyncGenericAPIView
+from asgiref.sync import sync_to_async
 from twilio.rest import Client
 from rest_framework import status
 from rest_framework.response import Response
@@ -14,9 +17,11 @@ from utilities.utils import (
 )
 from utilities import messages
 from .serializers import SmsServiceSerializer
-from utilities.sqs import push_message_to_sqs
-from utilities.constants import SMS_SERVICE_CHOICE
-from .backend import SmsService
+from utilities.sqs import push_messages_to_sqs
+from utilities.dedupe import get_dedupe_store
+from utilities.retry import schedule_payload_retries
+from utilities.constants import DEFAULT_PRIORITY, PRIORITY_CHOICES, SMS_SERVICE_CHOICE
+from .backend import FailedNumbers, SmsService
 from utilities.permissions import IsAuthenticatedPermission
 
 
@@ -35,13 +40,67 @@ class SmsServiceAPIView(CreateAPIView):
         self.response_format = ResponseInfo().response
         self.failed_messages_response_list = list()
         self.failed_payload = list()
+        self.retry_payload = list()
+        self.retried_payload = list()
+        self.priority = DEFAULT_PRIORITY
         logger.info("Initializing SmsServiceAPIView.")
         super(SmsServiceAPIView, self).__init__(**kwargs)
 
     def send_sms_service(self, provider_type, service_data):
         logger.info(f"Attempting to send SMS via {provider_type} to {service_data['send_to']}")
-        failed_message = SmsService().send_sms(provider_type, service_data["message"], service_data["send_to"])
+        self.record_failed_numbers(service_data, self.send_sms_once(provider_type, service_data))
 
+    async def send_sms_service_async(self, provider_type, service_data):
+        """
+        Async version of send_sms_service.
+        """
+        logger.info(f"Attempting to send SMS via {provider_type} to {service_data['send_to']}")
+        self.record_failed_numbers(service_data, await self.send_sms_once_async(provider_type, service_data))
+
+    def send_sms_once(self, provider_type, service_data):
+        """
+        Send an SMS unless the same one was already sent within the dedupe window.
+
+        :return: FailedNumbers the message could not be sent to.
+        """
+        return get_dedupe_store().send_once(
+            "sms", service_data,
+            lambda data: SmsService().send_sms(provider_type, data["message"], data["send_to"]),
+            is_sent=lambda failed_message: self.sms_sent(service_data, failed_message), duplicate_result=FailedNumbers(),
+        )
+
+    async def send_sms_once_async(self, provider_type, service_data):
+        """
+        Async version of send_sms_once.
+        """
+        return await get_dedupe_store().send_once_async(
+            "sms", service_data,
+            lambda data: SmsService().send_sms_async(provider_type, data["message"], data["send_to"]),
+            is_sent=lambda failed_message: self.sms_sent(service_data, failed_message), duplicate_result=FailedNumbers(),
+        )
+
+    @staticmethod
+    def sms_sent(service_data, failed_message):
+        """
+        Whether the message reached at least one number, numbers rejected by the provider are not retried.
+        """
+        if failed_message is None:
+            return False
+        retry_numbers = getattr(failed_message, "retry_numbers", {})
+        return len(failed_message) + len(retry_numbers) < len(service_data["send_to"])
+
+    def record_failed_numbers(self, service_data, failed_message):
+        """
+        Record the numbers the provider could not send the message to, the ones worth retrying apart.
+        """
+        retry_numbers = getattr(failed_message, "retry_numbers", {})
+        if retry_numbers:
+            logger.warning(f"Failed to send SMS to {list(retry_numbers)}, retrying later.")
+            self.retry_payload.append((
+                {"message": service_data["message"], "send_to": list(retry_numbers)},
+                {**service_data, "send_to": list(retry_numbers)},
+                retry_numbers,
+            ))
         if len(failed_message) > 0:
             logger.warning(f"Partial success. Failed to send SMS to: {failed_message}")
             self.failed_messages_response_list.append(
@@ -51,22 +110,16 @@ class SmsServiceAPIView(CreateAPIView):
                     "errors": None
                 }
             )
-        else:
+        elif not retry_numbers:
             logger.info(f"SMS sent successfully to all recipients: {service_data['send_to']}")
 
-    @swagger_auto_schema(
-        manual_parameters=[
-            openapi.Parameter(
-                'service_type',
-                openapi.IN_PATH,
-                description="Service type",
-                type=openapi.TYPE_STRING,
-                enum=['twilio']
-            ),
-        ],
-    )
-    def post(self, request, *args, **kwargs):
-        service_type = self.kwargs["service_type"]
+    def split_payload(self, request, service_type):
+        """
+        Validate the payload items of a request, recording the invalid ones as failed.
+
+        :return: A tuple (queued_payload, direct_payload), queued_payload holding (payload, queue message)
+                 pairs and direct_payload the service data of the items to send now.
+        """
         logger.info(f"Received POST request to send SMS via {service_type}.")
         if service_type not in SMS_SERVICE_CHOICE:
             logger.error(f"Invalid service type: {service_type}")
@@ -74,6 +127,13 @@ class SmsServiceAPIView(CreateAPIView):
 
         use_sqs = request.data.get("use_sqs", False)
         logger.info(f"use_sqs flag is set to {use_sqs}.")
+        priority = request.data.get("priority", DEFAULT_PRIORITY)
+        if priority not in PRIORITY_CHOICES:
+            logger.error(f"Invalid priority: {priority}")
+            raise CustomException(messages.VALID_PARAMS.format(', '.join(PRIORITY_CHOICES)))
+        self.priority = priority
+        queued_payload = list()
+        direct_payload = list()
 
         for payload in request.data.get("payload", []):
             serializer = self.get_serializer(data=payload)
@@ -85,30 +145,57 @@ class SmsServiceAPIView(CreateAPIView):
                     "send_to": send_to,
                     "message": message
                 }
+                if serializer.validated_data.get("idempotency_key"):
+                    service_data["idempotency_key"] = serializer.validated_data["idempotency_key"]
 
                 if use_sqs:
-                    logger.info(f"Sending message to SQS for {send_to}.")
+                    logger.info(f"Queueing message to SQS for {send_to}.")
                     message = {
                         "provider_type": "twilio",
                         "service_type": "sms",
+                        "priority": priority,
                         "service_data": service_data
                     }
-                    push_message_to_sqs(message)
-                    logger.info(f"Message pushed to SQS for {send_to}.")
+                    queued_payload.append((payload, message))
                 else:
-                    self.send_sms_service(service_type, service_data)
+                    direct_payload.append(service_data)
             else:
                 payload_copy = copy.deepcopy(payload)
                 payload_copy["errors"] = serializer.errors
                 self.failed_messages_response_list.append(payload_copy)
 
+        return queued_payload, direct_payload
+
+    def record_queue_failures(self, queued_payload, failed_messages):
+        """
+        Record the payload items that could not be enqueued.
+        """
+        for index, error in failed_messages:
+            payload_copy = copy.deepcopy(queued_payload[index][0])
+            payload_copy["errors"] = error
+            self.failed_messages_response_list.append(payload_copy)
+        logger.info(f"{len(queued_payload) - len(failed_messages)} messages pushed to SQS.")
+
+    def schedule_retries(self, provider_type):
+        """
+        Enqueue the retry of the numbers that failed with a retryable error.
+        """
+        retried_payload, failed_payload = schedule_payload_retries("sms", provider_type, self.priority, self.retry_payload)
+        self.retried_payload.extend(retried_payload)
+        self.failed_messages_response_list.extend(failed_payload)
+        self.retry_payload = list()
 
-        if len(self.failed_messages_response_list) > 0:
+    def sent_response(self):
+        """
+        Response listing the failed payload items and numbers, and the ones scheduled for a retry, if any.
+        """
+        if len(self.failed_messages_response_list) > 0 or len(self.retried_payload) > 0:
             logger.warning("Partial success. Some messages failed to send.")
 
 
             self.response_format["data"] = {
-                "failed_payload": self.failed_messages_response_list
+                "failed_payload": self.failed_messages_response_list or None,
+                "retried_payload": self.retried_payload or None,
             }
             self.response_format["status_code"] = status.HTTP_200_OK
             self.response_format["error"] = "Failed Messages."
@@ -119,3 +206,64 @@ class SmsServiceAPIView(CreateAPIView):
         logger.info("Returning response for the SMS service request.")
         return Response(self.response_format, status=self.response_format["status_code"])
 
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'service_type',
+                openapi.IN_PATH,
+                description="Service type",
+                type=openapi.TYPE_STRING,
+                enum=['twilio']
+            ),
+        ],
+    )
+    def post(self, request, *args, **kwargs):
+        service_type = self.kwargs["service_type"]
+        queued_payload, direct_payload = self.split_payload(request, service_type)
+
+        for service_data in direct_payload:
+            self.send_sms_service(service_type, service_data)
+        if self.retry_payload:
+            self.schedule_retries(service_type)
+
+        if queued_payload:
+            self.record_queue_failures(queued_payload, push_messages_to_sqs([message for _, message in queued_payload]))
+
+        return self.sent_response()
+
+
+class AsyncSmsServiceAPIView(AsyncGenericAPIView, SmsServiceAPIView):
+    """
+    Class to create API to send SMS to phone numbers, without holding a thread while the provider answers.
+    """
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'service_type',
+                openapi.IN_PATH,
+                description="Service type",
+                type=openapi.TYPE_STRING,
+                enum=['twilio']
+            ),
+        ],
+    )
+    async def post(self, request, *args, **kwargs):
+        service_type = self.kwargs["service_type"]
+        queued_payload, direct_payload = self.split_payload(request, service_type)
+
+        failed_numbers = await asyncio.gather(*(
+            self.send_sms_once_async(service_type, service_data) for service_data in direct_payload
+        ))
+        for service_data, failed_message in zip(direct_payload, failed_numbers):
+            self.record_failed_numbers(service_data, failed_message)
+        if self.retry_payload:
+            await sync_to_async(self.schedule_retries, thread_sensitive=False)(service_type)
+
+        if queued_payload:
+            failed_messages = await sync_to_async(push_messages_to_sqs, thread_sensitive=False)(
+                [message for _, message in queued_payload]
+            )
+            self.record_queue_failures(queued_payload, failed_messages)
+
+        return self.sent_response()
@@ -6,30 +6,46 @@ logger.setLevel(logging.INFO)
 
 
 def lambda_handler(event, context):
-    SERVER_API = "API_ENDPOINT_FOR_SENDING_MESSAGE"
-    API_KEY = "API_KEY"
-
-    for record in event['Records']:
-        message_body = record['body']
-
-        logger.info(f"Processing message: {message_body}")
+    """
+    Forward a batch of SQS records to the bulk getSQSData endpoint in a single request.
 
-        try:
-            headers = {
-                "Authorization": f"Bearer {API_KEY}"
-            }
-
-            response = requests.post(
-                SERVER_API,
-                data={"json_string": message_body, "receipt_handle": record['receiptHandle']},
-                headers=headers
-            )
+    Requires ReportBatchItemFailures on the event source mapping, only the records listed
+    in batchItemFailures are made visible again for redelivery.
+    """
+    SERVER_API = "API_ENDPOINT_FOR_SENDING_MESSAGE_BULK"
+    API_KEY = "API_KEY"
 
-            logger.info(f"Status Code: {response.status_code}, Response: {response.text}")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed: {e}")
+    records = [
+        {
+            "message_id": record['messageId'],
+            "json_string": record['body'],
+            "receipt_handle": record['receiptHandle'],
+        }
+        for record in event['Records']
+    ]
+    record_ids = [record["message_id"] for record in records]
+
+    logger.info(f"Processing {len(records)} messages.")
+
+    try:
+        headers = {
+            "Authorization": f"Bearer {API_KEY}"
+        }
+
+        response = requests.post(
+            SERVER_API,
+            json={"records": records},
+            headers=headers
+        )
+        logger.info(f"Status Code: {response.status_code}, Response: {response.text}")
+        response.raise_for_status()
+
+        failures = response.json()["data"]["batch_item_failures"]
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+        # Nothing is known about the individual records, retry the whole batch.
+        logger.error(f"Request failed: {e}")
+        failures = [{"itemIdentifier": message_id} for message_id in record_ids]
 
     return {
-        "status_code": 200,
-        "message": "Messages processed successfully!"
+        "batchItemFailures": failures
     }
@@ -0,0 +1,65 @@
+import asyncio
+import weakref
+import threading
+import contextvars
+
+import httpx
+
+
+# Clients of each running event loop, an httpx.AsyncClient can only be used on the loop it was opened on.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(name, factory=None):
+    """
+    Return the shared async HTTP client with the given name for the running event loop.
+
+    Under ASGI every request of the process runs on the same loop, so provider calls share the
+    client's open connections; a loop started for a single call gets its own client.
+
+    :param name: Identifier of the client, e.g. the provider it is used for.
+    :param factory: Callable creating the client on first use, defaults to a plain httpx.AsyncClient.
+    :return: An httpx.AsyncClient instance.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), dict())
+    client = clients.get(name)
+    if client is None or client.is_closed:
+        client = clients[name] = (factory or httpx.AsyncClient)()
+    return client
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """
+    Return the process-wide event loop run by a daemon thread, started on first use.
+    """
+    global _background_loop
+    if _background_loop is None:
+        with _background_loop_lock:
+            if _background_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="background-event-loop", daemon=True).start()
+                _background_loop = loop
+    return _background_loop
+
+
+def run_in_background_loop(coroutine_function, *args, **kwargs):
+    """
+    Run a coroutine function on the background event loop and wait for its result, for synchronous
+    callers. Unlike async_to_sync, which runs each call on a new loop, the loop outlives the call, so
+    the clients of get_async_client keep their open connections from one call to the next.
+
+    The coroutine runs with the context variables of the caller, such as its request deadline.
+    Must not be called from a coroutine, it blocks until the result is ready.
+    """
+    context = contextvars.copy_context()
+
+    async def run():
+        for variable, value in context.items():
+            variable.set(value)
+        return await coroutine_function(*args, **kwargs)
+
+    return asyncio.run_coroutine_threadsafe(run(), get_background_loop()).result()
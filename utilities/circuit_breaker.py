@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+from collections import deque
+
+from utilities.utils import logger
+from utilities.retry import RetryableError
+
+
+# Share of failed calls within the window that opens a circuit.
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5))
+# Calls needed within the window before the failure rate is trusted.
+CIRCUIT_MINIMUM_CALLS = int(os.getenv("CIRCUIT_MINIMUM_CALLS", 10))
+# Seconds of calls the failure rate is computed over.
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", 60))
+# Seconds an open circuit fails fast before letting probe calls through.
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+# Probe calls let through by a half-open circuit, all of them must succeed to close it.
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", 1))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RetryableError):
+    """
+    Raised instead of calling a provider whose circuit is open, the send is worth retrying later.
+    """
+
+    def __init__(self, name):
+        super().__init__(f"{name} is unavailable, its circuit is open.")
+        self.name = name
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a provider, failing calls fast while the provider is degraded instead of
+    letting each of them wait for a timeout.
+
+    The circuit is closed while the provider is healthy. It opens when at least `failure_rate` of
+    the calls of the last `window` seconds failed, given at least `minimum_calls` calls. An open
+    circuit refuses calls for `open_seconds`, then turns half-open and lets `half_open_calls`
+    probe calls through: the circuit closes once they all succeeded and opens again on the first
+    failure.
+
+    Callers ask allow_request before calling the provider and report the outcome with
+    record_success or record_failure. Only failures telling the provider is unhealthy (timeouts,
+    unreachable provider, 429 and 5xx answers) should be reported as failures.
+    """
+
+    def __init__(self, name, failure_rate=CIRCUIT_FAILURE_RATE, minimum_calls=CIRCUIT_MINIMUM_CALLS, window=CIRCUIT_WINDOW_SECONDS,
+                 open_seconds=CIRCUIT_OPEN_SECONDS, half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        # (time, failed) of the calls of the window, while the circuit is closed
+        self._calls = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Whether a call may be made to the provider now. A half-open circuit lets its probe calls through.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state(HALF_OPEN, now)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    # Probes whose outcome was never reported do not keep the circuit half-open for good.
+                    if now - self._opened_at < self.open_seconds:
+                        return False
+                    self._set_state(HALF_OPEN, now)
+                self._probes += 1
+            return True
+
+    def record_success(self):
+        self._record(False)
+
+    def record_failure(self):
+        self._record(True)
+
+    def _record(self, failed):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._set_state(OPEN, now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._set_state(CLOSED, now)
+                return
+            if self.state == OPEN:
+                # Outcome of a call made before the circuit opened.
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] <= now - self.window:
+                self._failures -= self._calls.popleft()[1]
+            if len(self._calls) >= self.minimum_calls and self._failures >= self.failure_rate * len(self._calls):
+                self._set_state(OPEN, now)
+
+    def _set_state(self, state, now):
+        # Called with the lock held.
+        if state != self.state:
+            log = logger.info if state == CLOSED else logger.warning
+            log(f"Circuit of {self.name} is now {state}.")
+        self.state = state
+        self._opened_at = now
+        self._probes = 0
+        self._probe_successes = 0
+        self._calls.clear()
+        self._failures = 0
+
+
+_circuit_breakers = dict()
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """
+    Return the process-wide circuit breaker of a provider, creating it on first use.
+    """
+    breaker = _circuit_breakers.get(name)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
+
+
+def record_call(name, failed):
+    """
+    Report the outcome of a call to a provider to its circuit breaker, failed telling the provider is unhealthy.
+    """
+    breaker = get_circuit_breaker(name)
+    if failed:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from utilities.utils import logger
+from utilities.deadline import DeadlineExceeded, remaining
+
+
+# Concurrent calls a provider starts with, before the limit adapts.
+CONCURRENCY_INITIAL_LIMIT = int(os.getenv("CONCURRENCY_INITIAL_LIMIT", 10))
+# Bounds of the concurrent calls of a provider.
+CONCURRENCY_MIN_LIMIT = int(os.getenv("CONCURRENCY_MIN_LIMIT", 1))
+CONCURRENCY_MAX_LIMIT = int(os.getenv("CONCURRENCY_MAX_LIMIT", 200))
+# Factor the limit is multiplied by when the provider is overloaded.
+CONCURRENCY_BACKOFF = float(os.getenv("CONCURRENCY_BACKOFF", 0.5))
+# A call slower than this many times the usual latency of the provider counts as overloaded.
+CONCURRENCY_LATENCY_SPIKE = float(os.getenv("CONCURRENCY_LATENCY_SPIKE", 3))
+
+
+class Call:
+    """
+    Call made within a slot of an AdaptiveLimiter; the caller sets `overloaded` when the provider
+    answered with a 429, a 5xx or could not be reached.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.overloaded = False
+
+
+class AdaptiveLimiter:
+    """
+    Limit of the concurrent calls to a provider, adapted with AIMD (additive increase,
+    multiplicative decrease) like the TCP congestion window.
+
+    Every healthy call grows the limit by 1 / limit, so the limit grows by about one for each
+    window of calls. An overloaded call (429, 5xx, unreachable provider) or a call slower than
+    `latency_spike` times the usual latency multiplies it by `backoff`, at most once per window:
+    the calls started before the last decrease do not decrease it again. The usual latency is a
+    moving average of the latencies of the healthy calls.
+
+    Calls beyond the limit wait for a slot in arrival order; the limiter can be used from
+    threads and from event loops at the same time.
+    """
+
+    def __init__(self, name, initial_limit=CONCURRENCY_INITIAL_LIMIT, min_limit=CONCURRENCY_MIN_LIMIT, max_limit=CONCURRENCY_MAX_LIMIT,
+                 backoff=CONCURRENCY_BACKOFF, latency_spike=CONCURRENCY_LATENCY_SPIKE):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.backoff = backoff
+        self.latency_spike = latency_spike
+        self.in_flight = 0
+        self.latency = None
+        self._decreased_at = 0.0
+        # threading.Event of waiting threads, (loop, future) of waiting coroutines
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Take a slot, waiting at most timeout seconds (None waits as long as needed).
+
+        :return: True if the slot was taken.
+        """
+        with self._lock:
+            if self._take_slot():
+                return True
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if waiter.wait(timeout):
+            return True
+        return self._cancel_wait(waiter)
+
+    async def acquire_async(self, timeout=None):
+        """
+        Same as acquire, waiting without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._take_slot():
+                return True
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return self._cancel_wait(waiter)
+        except asyncio.CancelledError:
+            if self._cancel_wait(waiter):
+                self.release(None)
+            raise
+
+    def release(self, call):
+        """
+        Give back the slot of a call and adapt the limit to its outcome, None leaving the limit as it is.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if call is not None:
+                self._adapt(call)
+            while self._waiters and self._take_slot(waiting=True):
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                else:
+                    loop, future = waiter
+                    loop.call_soon_threadsafe(_set_result, future)
+
+    @contextmanager
+    def slot(self):
+        """
+        Context manager running a call within a slot, yielding its Call. The wait for the slot
+        is bounded by the request deadline.
+
+        :raises DeadlineExceeded: If no slot was free before the request deadline.
+        """
+        if not self.acquire(remaining()):
+            raise DeadlineExceeded()
+        call = Call()
+        try:
+            yield call
+        finally:
+            self.release(call)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """
+        Async version of slot.
+        """
+        if not await self.acquire_async(remaining()):
+            raise DeadlineExceeded()
+        call = Call()
+        try:
+            yield call
+        finally:
+            self.release(call)
+
+    def stats(self):
+        """
+        Current limit, calls in flight and waiting, and usual latency in seconds.
+        """
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": len(self._waiters),
+                "latency": self.latency,
+            }
+
+    def _take_slot(self, waiting=False):
+        # Called with the lock held; a new caller does not overtake the waiting ones.
+        if self.in_flight >= int(self.limit) or (self._waiters and not waiting):
+            return False
+        self.in_flight += 1
+        return True
+
+    def _cancel_wait(self, waiter):
+        # A waiter already removed from the queue was handed a slot while giving up.
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return False
+            return True
+
+    def _adapt(self, call):
+        # Called with the lock held.
+        now = time.monotonic()
+        latency = now - call.started_at
+        spike = self.latency is not None and latency > self.latency_spike * self.latency
+        if call.overloaded or spike:
+            if call.started_at >= self._decreased_at:
+                previous_limit = int(self.limit)
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._decreased_at = now
+                logger.warning(
+                    f"Concurrency limit of {self.name} cut from {previous_limit} to {int(self.limit)} "
+                    f"({'overloaded' if call.overloaded else f'latency {latency:.2f}s'})."
+                )
+            return
+        self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        previous_limit = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        if int(self.limit) != previous_limit:
+            logger.debug(f"Concurrency limit of {self.name} raised to {int(self.limit)}.")
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(True)
+
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+def get_concurrency_limiter(name):
+    """
+    Return the process-wide adaptive concurrency limiter of a provider, creating it on first use.
+    """
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(name, AdaptiveLimiter(name))
+    return limiter
+
+
+def concurrency_stats():
+    """
+    Dictionary of the stats of every provider's limiter, by provider.
+    """
+    return {name: limiter.stats() for name, limiter in list(_limiters.items())}
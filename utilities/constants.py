@@ -6,4 +6,8 @@ MEDIUM_CHOICE = (
 
 SMS_SERVICE_CHOICE = ["twilio"]
 
-PUSH_SERVICE_CHOICE = ["firebase",]
+PUSH_SERVICE_CHOICE = ["firebase", "firebase_v1"]
+
+# Queue priority lanes, from the one drained first to the one drained last.
+PRIORITY_CHOICES = ["critical", "default", "bulk"]
+DEFAULT_PRIORITY = "default"
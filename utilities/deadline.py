@@ -0,0 +1,88 @@
+import os
+import time
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from utilities.retry import DeferredError
+
+
+# Seconds an API request or a queue message has to send its notifications, from its arrival.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 25))
+# Provider calls are not started with less than this many seconds left, they are deferred to the queue instead.
+DEADLINE_MIN_CALL_SECONDS = float(os.getenv("DEADLINE_MIN_CALL_SECONDS", 0.5))
+
+# time.monotonic() by which the current request must be done, None outside of a request.
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(DeferredError):
+    """
+    Raised instead of calling a provider when too little of the request deadline is left, the send
+    is deferred to the queue rather than failed.
+    """
+
+    def __init__(self):
+        super().__init__("Request deadline reached, deferred to the queue.")
+
+
+@contextmanager
+def request_deadline(seconds=None):
+    """
+    Context manager running a request with a deadline of seconds (default REQUEST_DEADLINE_SECONDS)
+    from now. Within the deadline of an enclosing request, the earlier of the two applies.
+    """
+    deadline = time.monotonic() + (REQUEST_DEADLINE_SECONDS if seconds is None else seconds)
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left before the deadline of the current request, None outside of a request.
+    """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def call_timeout(timeout):
+    """
+    Timeout of a provider call: timeout, cut to what is left of the request deadline.
+
+    :param timeout: Timeout in seconds of the provider, None for no timeout.
+    :raises DeadlineExceeded: If less than DEADLINE_MIN_CALL_SECONDS are left.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left < DEADLINE_MIN_CALL_SECONDS:
+        raise DeadlineExceeded()
+    return left if timeout is None else min(timeout, left)
+
+
+def call_timeouts(connect_timeout, read_timeout):
+    """
+    (connect, read) timeouts of a provider call, each cut to what is left of the request deadline.
+
+    :raises DeadlineExceeded: If less than DEADLINE_MIN_CALL_SECONDS are left.
+    """
+    return call_timeout(connect_timeout), call_timeout(read_timeout)
+
+
+def propagate_deadline(function):
+    """
+    Wrap function to run under the deadline (and the rest of the context, such as the delivery
+    attempt) of the calling thread, for the tasks handed to a thread pool, whose threads do not
+    inherit it.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        # One copy per call, a context cannot be entered by several pool threads at once.
+        return context.copy().run(function, *args, **kwargs)
+    return run
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from utilities.utils import logger
+
+
+# Seconds a sent notification suppresses identical ones, 0 only suppresses concurrent duplicates.
+DEDUPE_WINDOW_SECONDS = int(os.getenv("DEDUPE_WINDOW_SECONDS", 3600))
+# Seconds a claim blocks duplicates while its send is running, the claim of a crashed sender expires after it.
+DEDUPE_CLAIM_TIMEOUT = int(os.getenv("DEDUPE_CLAIM_TIMEOUT", 300))
+# Keys of sent notifications kept in memory in front of SQLite.
+DEDUPE_MEMORY_SIZE = int(os.getenv("DEDUPE_MEMORY_SIZE", 100000))
+
+
+def dedupe_key(service_type, payload):
+    """
+    Key identifying a notification: its idempotency_key if given, else the SHA-256 of its content.
+
+    :param service_type: Channel of the notification ('email', 'sms' or 'push').
+    :param payload: The validated payload item.
+    """
+    idempotency_key = payload.get("idempotency_key")
+    if idempotency_key:
+        return f"{service_type}:key:{idempotency_key}"
+    content = json.dumps(without_idempotency_key(payload), sort_keys=True, default=str)
+    return f"{service_type}:sha256:{hashlib.sha256(content.encode()).hexdigest()}"
+
+
+def without_idempotency_key(payload):
+    return {key: value for key, value in payload.items() if key != "idempotency_key"}
+
+
+class DedupeStore:
+    """
+    Store of the notifications sent within a time window, used to suppress duplicate sends.
+
+    A key is claimed before the provider call. The claim fails if the key was sent less than
+    `window` seconds ago or is being sent by another call; after the call the key is completed,
+    suppressing duplicates for the window, or released so a retry can send it.
+
+    Keys live in a SQLite database shared by the processes of the box (":memory:" keeps them in
+    the current process) and the recently sent ones are also kept in an in-memory LRU, so the
+    duplicates of a hot notification are answered without a query.
+    """
+
+    def __init__(self, path=":memory:", window=DEDUPE_WINDOW_SECONDS, claim_timeout=DEDUPE_CLAIM_TIMEOUT, memory_size=DEDUPE_MEMORY_SIZE):
+        self.path = str(path)
+        self.window = window
+        self.claim_timeout = claim_timeout
+        self.memory_size = memory_size
+        # key -> time until which the key is known to be sent
+        self._sent = OrderedDict()
+        self._purged_at = time.time()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        if self.path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS dedupe_key ("
+            "key TEXT PRIMARY KEY, "
+            "expires_at REAL NOT NULL, "
+            "sent INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def claim(self, key):
+        """
+        Claim a key before sending its notification.
+
+        :return: True if the notification should be sent, False if it is a duplicate.
+        """
+        now = time.time()
+        with self._lock:
+            sent_until = self._sent.get(key)
+            if sent_until is not None and sent_until > now:
+                self._sent.move_to_end(key)
+                claimed = False
+            else:
+                self._sent.pop(key, None)
+                self._purge_expired(now)
+                # Insert the key, or take over an expired entry; a live entry is left untouched.
+                cursor = self._connection.execute(
+                    "INSERT INTO dedupe_key (key, expires_at, sent) VALUES (?, ?, 0) "
+                    "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at, sent = 0 "
+                    "WHERE dedupe_key.expires_at <= ?",
+                    (key, now + self.claim_timeout, now),
+                )
+                claimed = cursor.rowcount == 1
+
+        if not claimed:
+            logger.info(f"Suppressed duplicate notification {key}.")
+        return claimed
+
+    def complete(self, key):
+        """
+        Mark a claimed key as sent, suppressing its duplicates for the window.
+        """
+        sent_until = time.time() + self.window
+        with self._lock:
+            self._connection.execute(
+                "UPDATE dedupe_key SET expires_at = ?, sent = 1 WHERE key = ?", (sent_until, key),
+            )
+            self._sent[key] = sent_until
+            self._sent.move_to_end(key)
+            while len(self._sent) > self.memory_size:
+                self._sent.popitem(last=False)
+
+    def release(self, key):
+        """
+        Drop the claim of a key whose notification could not be sent, so a retry can send it.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM dedupe_key WHERE key = ? AND sent = 0", (key,))
+
+    def send_once(self, service_type, payload, send, is_sent, duplicate_result=None):
+        """
+        Call send unless the notification is a duplicate, then complete or release its claim.
+
+        :param service_type: Channel of the notification, part of its key.
+        :param payload: The validated payload item.
+        :param send: Callable sending the payload, called with the payload without its idempotency_key.
+        :param is_sent: Callable telling from the result of send whether the notification went out.
+        :param duplicate_result: Result returned instead of sending a duplicate.
+        :return: The result of send, or duplicate_result.
+        """
+        key = dedupe_key(service_type, payload)
+        if not self.claim(key):
+            return duplicate_result
+        try:
+            result = send(without_idempotency_key(payload))
+        except BaseException:
+            self.release(key)
+            raise
+        self._finish(key, is_sent(result))
+        return result
+
+    async def send_once_async(self, service_type, payload, send, is_sent, duplicate_result=None):
+        """
+        Async version of send_once, send being a coroutine function. The SQLite queries run on a
+        worker thread, so they never block the event loop.
+        """
+        key = dedupe_key(service_type, payload)
+        if not await sync_to_async(self.claim, thread_sensitive=False)(key):
+            return duplicate_result
+        try:
+            result = await send(without_idempotency_key(payload))
+        except BaseException:
+            await sync_to_async(self.release, thread_sensitive=False)(key)
+            raise
+        await sync_to_async(self._finish, thread_sensitive=False)(key, is_sent(result))
+        return result
+
+    def send_batch_once(self, service_type, payloads, send_batch, is_sent, duplicate_result=None):
+        """
+        Batch version of send_once, a payload item repeated within the batch is a duplicate too.
+
+        :param send_batch: Callable sending a list of payload items and returning one result per item.
+        :return: One result per payload item, duplicate_result for the duplicates.
+        """
+        keys, payloads_to_send = self._claim_batch(service_type, payloads)
+        try:
+            results = send_batch(payloads_to_send) if payloads_to_send else []
+        except BaseException:
+            self._release_batch(keys)
+            raise
+        return self._finish_batch(keys, results, is_sent, duplicate_result)
+
+    async def send_batch_once_async(self, service_type, payloads, send_batch, is_sent, duplicate_result=None):
+        """
+        Async version of send_batch_once, send_batch being a coroutine function. The SQLite queries
+        run on a worker thread, so they never block the event loop.
+        """
+        keys, payloads_to_send = await sync_to_async(self._claim_batch, thread_sensitive=False)(service_type, payloads)
+        try:
+            results = await send_batch(payloads_to_send) if payloads_to_send else []
+        except BaseException:
+            await sync_to_async(self._release_batch, thread_sensitive=False)(keys)
+            raise
+        return await sync_to_async(self._finish_batch, thread_sensitive=False)(keys, results, is_sent, duplicate_result)
+
+    def _claim_batch(self, service_type, payloads):
+        keys = [dedupe_key(service_type, payload) for payload in payloads]
+        # None marks the duplicates.
+        keys = [key if self.claim(key) else None for key in keys]
+        return keys, [without_idempotency_key(payload) for payload, key in zip(payloads, keys) if key is not None]
+
+    def _release_batch(self, keys):
+        for key in keys:
+            if key is not None:
+                self.release(key)
+
+    def _finish_batch(self, keys, results, is_sent, duplicate_result):
+        results = iter(results)
+        batch_results = list()
+        for key in keys:
+            if key is None:
+                batch_results.append(duplicate_result)
+                continue
+            result = next(results)
+            self._finish(key, is_sent(result))
+            batch_results.append(result)
+        return batch_results
+
+    def _finish(self, key, sent):
+        if sent:
+            self.complete(key)
+        else:
+            self.release(key)
+
+    def _purge_expired(self, now):
+        # Called with the lock held, drops the expired keys at most once per claim timeout.
+        if now - self._purged_at < self.claim_timeout:
+            return
+        self._purged_at = now
+        self._connection.execute("DELETE FROM dedupe_key WHERE expires_at <= ?", (now,))
+
+
+_dedupe_store = None
+_dedupe_store_lock = threading.Lock()
+
+
+def get_dedupe_store():
+    """
+    Return the process-wide dedupe store kept at the DEDUPE_STORE_PATH setting.
+    """
+    global _dedupe_store
+    if _dedupe_store is None:
+        with _dedupe_store_lock:
+            if _dedupe_store is None:
+                _dedupe_store = DedupeStore(getattr(settings, "DEDUPE_STORE_PATH", ":memory:"))
+    return _dedupe_store
+
+
+@receiver(setting_changed)
+def reset_dedupe_store(setting, **kwargs):
+    """
+    Drop the process-wide dedupe store when DEDUPE_STORE_PATH changes, such as under override_settings.
+    """
+    global _dedupe_store
+    if setting == "DEDUPE_STORE_PATH":
+        with _dedupe_store_lock:
+            _dedupe_store = None
@@ -58,6 +58,8 @@ CALENDAR_INVITE_FAILED = "Calendar sent failed."
 NOTIFICATION_MARK_READ = "Notification Marked as read."
 SEND_SUCCESS = '{} sent successfully'
 SEND_FAILED = 'Failed to send {}'
+UPLOADED = '{} uploaded successfully.'
+ALREADY_SENT = '{} already sent.'
 
 MESSAGE_SENT = "Message sent successfully."
 INVALID_MESSAGE_CONTENT = "Invalid message content."
@@ -0,0 +1,29 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from utilities.deadline import request_deadline
+
+
+class RequestDeadlineMiddleware:
+    """
+    Run every API request under a deadline of REQUEST_DEADLINE_SECONDS from its arrival, bounding
+    the timeouts of the provider calls it makes.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with request_deadline():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with request_deadline():
+            return await self.get_response(request)
@@ -0,0 +1,347 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+
+from utilities.utils import logger
+from utilities.constants import DEFAULT_PRIORITY, PRIORITY_CHOICES
+
+
+# SQS accepts at most 10 entries and 256 KiB of message bodies per batch call.
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+
+
+class QueueReceiveError(Exception):
+    """
+    Raised by receive_messages when the queue could not be read.
+    """
+
+
+class BaseQueueBackend:
+    """
+    Interface of the queues used for asynchronous notification sending.
+
+    Received messages are dictionaries with MessageId, ReceiptHandle and Body keys; a received
+    message stays hidden for the visibility timeout and is redelivered unless it gets deleted.
+    """
+
+    def send_messages(self, bodies, delay_seconds=0):
+        """
+        Enqueue message bodies.
+
+        :param bodies: List of message body strings.
+        :param delay_seconds: Seconds before the messages can be received.
+        :return: List of (index, error) tuples for the bodies that could not be enqueued.
+        """
+        raise NotImplementedError
+
+    def receive_messages(self, max_messages=10, wait_time=0, visibility_timeout=30):
+        """
+        Receive up to max_messages messages, waiting at most wait_time seconds for one to arrive.
+
+        :raises QueueReceiveError: If the queue could not be read.
+        """
+        raise NotImplementedError
+
+    def delete_messages(self, receipt_handles):
+        """
+        Acknowledge processed messages by receipt handle.
+        """
+        raise NotImplementedError
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        """
+        Hide received messages for another visibility_timeout seconds.
+        """
+        raise NotImplementedError
+
+
+class SQSQueueBackend(BaseQueueBackend):
+    """
+    Queue backend on top of an Amazon SQS queue, using the batch APIs.
+    """
+
+    def __init__(self, client=None, queue_url=None):
+        self._client = client
+        self.queue_url = queue_url or os.getenv("SQS_URL")
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        The boto3 SQS client, created on first use.
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client(
+                        'sqs',
+                        region_name=os.getenv("AWS_REGION"),
+                        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+                        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+                    )
+        return self._client
+
+    @staticmethod
+    def _chunk_entries(entries):
+        """
+        Split batch entries into groups that respect the SQS per-call entry and size limits.
+        """
+        chunk, chunk_bytes = [], 0
+        for entry in entries:
+            entry_bytes = len(entry.get("MessageBody", "").encode("utf-8"))
+            if chunk and (len(chunk) == SQS_BATCH_MAX_ENTRIES or chunk_bytes + entry_bytes > SQS_BATCH_MAX_BYTES):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(entry)
+            chunk_bytes += entry_bytes
+        if chunk:
+            yield chunk
+
+    def send_messages(self, bodies, delay_seconds=0):
+        entries = [
+            {"Id": str(index), "MessageBody": body, "DelaySeconds": delay_seconds}
+            for index, body in enumerate(bodies)
+        ]
+
+        failed_messages = list()
+        for chunk in self._chunk_entries(entries):
+            try:
+                response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=chunk)
+            except (BotoCoreError, ClientError) as e:
+                # The whole batch was rejected, report every entry of it as failed.
+                logger.error(f"Failed to send message batch to SQS: {e}")
+                failed_messages.extend((int(entry["Id"]), str(e)) for entry in chunk)
+                continue
+
+            for failed in response.get("Failed", []):
+                logger.error(f"Failed to send message {failed['Id']} to SQS: {failed.get('Message')}")
+                failed_messages.append((int(failed["Id"]), failed.get("Message", failed.get("Code"))))
+
+            logger.info(f"{len(response.get('Successful', []))} messages sent successfully to SQS.")
+
+        return failed_messages
+
+    def receive_messages(self, max_messages=10, wait_time=0, visibility_timeout=30):
+        try:
+            response = self.client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=min(max_messages, SQS_BATCH_MAX_ENTRIES),
+                WaitTimeSeconds=wait_time,
+                VisibilityTimeout=visibility_timeout,
+            )
+        except (BotoCoreError, ClientError) as e:
+            raise QueueReceiveError(f"Failed to receive messages from SQS: {e}") from e
+        return response.get("Messages", [])
+
+    def delete_messages(self, receipt_handles):
+        for start in range(0, len(receipt_handles), SQS_BATCH_MAX_ENTRIES):
+            chunk = receipt_handles[start:start + SQS_BATCH_MAX_ENTRIES]
+            try:
+                response = self.client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(index), "ReceiptHandle": receipt_handle}
+                        for index, receipt_handle in enumerate(chunk)
+                    ],
+                )
+            except (BotoCoreError, ClientError) as e:
+                # The messages become visible again and will be redelivered.
+                logger.error(f"Failed to delete message batch from SQS: {e}")
+                continue
+
+            for failed in response.get("Failed", []):
+                logger.error(f"Failed to delete message from SQS: {failed.get('Message')}")
+            logger.info(f"{len(response.get('Successful', []))} messages deleted from SQS.")
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        for start in range(0, len(receipt_handles), SQS_BATCH_MAX_ENTRIES):
+            chunk = receipt_handles[start:start + SQS_BATCH_MAX_ENTRIES]
+            try:
+                self.client.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(index), "ReceiptHandle": receipt_handle, "VisibilityTimeout": visibility_timeout}
+                        for index, receipt_handle in enumerate(chunk)
+                    ],
+                )
+            except (BotoCoreError, ClientError) as e:
+                logger.error(f"Failed to change visibility of SQS messages: {e}")
+
+
+class LocalQueueBackend(BaseQueueBackend):
+    """
+    Queue backend stored in a local SQLite database, for running the async pipeline without AWS.
+
+    The database runs in WAL mode so several processes on the same box can share a queue file;
+    the path ":memory:" keeps the queue inside the current process.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, path=":memory:", queue_name="default"):
+        self.path = str(path)
+        self.queue_name = queue_name
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        if self.path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS queue_message ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "queue TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "visible_at REAL NOT NULL, "
+            "receipt_handle TEXT, "
+            "receive_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS queue_message_visible ON queue_message (queue, visible_at)"
+        )
+
+    def send_messages(self, bodies, delay_seconds=0):
+        visible_at = time.time() + delay_seconds
+        with self._lock:
+            self._connection.executemany(
+                "INSERT INTO queue_message (queue, body, visible_at) VALUES (?, ?, ?)",
+                [(self.queue_name, body, visible_at) for body in bodies],
+            )
+        logger.info(f"{len(bodies)} messages sent successfully to local queue {self.queue_name}.")
+        return []
+
+    def receive_messages(self, max_messages=10, wait_time=0, visibility_timeout=30):
+        give_up_at = time.monotonic() + wait_time
+        while True:
+            try:
+                messages = self._claim(max_messages, visibility_timeout)
+            except sqlite3.Error as e:
+                raise QueueReceiveError(f"Failed to receive messages from local queue {self.queue_name}: {e}") from e
+            if messages or time.monotonic() >= give_up_at:
+                return messages
+            time.sleep(self.POLL_INTERVAL)
+
+    def _claim(self, max_messages, visibility_timeout):
+        now = time.time()
+        messages = list()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, body FROM queue_message WHERE queue = ? AND visible_at <= ? ORDER BY id LIMIT ?",
+                    (self.queue_name, now, max_messages),
+                ).fetchall()
+                for message_id, body in rows:
+                    receipt_handle = f"{message_id}:{uuid.uuid4().hex}"
+                    self._connection.execute(
+                        "UPDATE queue_message SET visible_at = ?, receipt_handle = ?, receive_count = receive_count + 1 "
+                        "WHERE id = ?",
+                        (now + visibility_timeout, receipt_handle, message_id),
+                    )
+                    messages.append({"MessageId": str(message_id), "ReceiptHandle": receipt_handle, "Body": body})
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return messages
+
+    def delete_messages(self, receipt_handles):
+        with self._lock:
+            self._connection.executemany(
+                "DELETE FROM queue_message WHERE receipt_handle = ?",
+                [(receipt_handle,) for receipt_handle in receipt_handles],
+            )
+        logger.info(f"{len(receipt_handles)} messages deleted from local queue {self.queue_name}.")
+
+    def change_visibility(self, receipt_handles, visibility_timeout):
+        visible_at = time.time() + visibility_timeout
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE queue_message SET visible_at = ? WHERE receipt_handle = ?",
+                [(visible_at, receipt_handle) for receipt_handle in receipt_handles],
+            )
+
+
+_queue_backends = dict()
+_queue_backend_lock = threading.Lock()
+
+
+def _create_queue_backend(priority):
+    backend_name = getattr(settings, "QUEUE_BACKEND", "sqs")
+    lane = settings.QUEUE_PRIORITY_LANES[priority]
+    if backend_name == "sqs":
+        queue_url = lane.get("sqs_url") or os.getenv("SQS_URL")
+        # Lanes without a queue of their own share the backend of the default queue.
+        for backend in _queue_backends.values():
+            if backend.queue_url == queue_url:
+                return backend
+        return SQSQueueBackend(queue_url=queue_url)
+    if backend_name == "local":
+        return LocalQueueBackend(getattr(settings, "LOCAL_QUEUE_PATH", ":memory:"), queue_name=priority)
+    raise ValueError(f"Unsupported queue backend: {backend_name}")
+
+
+def get_queue_backend(priority=DEFAULT_PRIORITY):
+    """
+    Return the process-wide queue backend of a priority lane, selected by the QUEUE_BACKEND setting
+    ('sqs' or 'local').
+
+    :raises ValueError: If the backend or the priority is not supported.
+    """
+    if priority not in PRIORITY_CHOICES:
+        raise ValueError(f"Unsupported priority: {priority}")
+    backend = _queue_backends.get(priority)
+    if backend is None:
+        with _queue_backend_lock:
+            if priority not in _queue_backends:
+                _queue_backends[priority] = _create_queue_backend(priority)
+                logger.info(f"Using {getattr(settings, 'QUEUE_BACKEND', 'sqs')} queue backend for {priority} messages.")
+            backend = _queue_backends[priority]
+    return backend
+
+
+def get_queue_lanes():
+    """
+    Return the distinct queue backends of the priority lanes, the one to drain first first.
+
+    :return: List of (priority, backend) tuples; lanes sharing a queue appear once, under the highest priority.
+    """
+    lanes = list()
+    for priority in PRIORITY_CHOICES:
+        backend = get_queue_backend(priority)
+        if all(backend is not lane_backend for _, lane_backend in lanes):
+            lanes.append((priority, backend))
+    return lanes
+
+
+_dead_letter_backend = None
+
+
+def get_dead_letter_backend():
+    """
+    Return the process-wide backend of the dead-letter queue, holding the notifications that failed
+    for good: the SQS queue of the SQS_DEAD_LETTER_URL setting, or the 'dead_letter' local queue.
+
+    :raises ValueError: If the backend is not supported or no dead-letter queue is configured.
+    """
+    global _dead_letter_backend
+    if _dead_letter_backend is None:
+        with _queue_backend_lock:
+            if _dead_letter_backend is None:
+                backend_name = getattr(settings, "QUEUE_BACKEND", "sqs")
+                if backend_name == "sqs":
+                    queue_url = getattr(settings, "SQS_DEAD_LETTER_URL", None)
+                    if not queue_url:
+                        raise ValueError("SQS_DEAD_LETTER_URL is not set.")
+                    _dead_letter_backend = SQSQueueBackend(queue_url=queue_url)
+                elif backend_name == "local":
+                    _dead_letter_backend = LocalQueueBackend(getattr(settings, "LOCAL_QUEUE_PATH", ":memory:"), queue_name="dead_letter")
+                else:
+                    raise ValueError(f"Unsupported queue backend: {backend_name}")
+    return _dead_letter_backend
@@ -0,0 +1,183 @@
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from utilities.retry import DeferredError
+from utilities.deadline import remaining, DEADLINE_MIN_CALL_SECONDS
+
+
+# Longest wait in seconds for a token before a send is deferred to the queue instead.
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 5))
+
+
+class RateLimitExceeded(DeferredError):
+    """
+    Raised when a send would wait too long for a token of its provider account, the send is
+    deferred to the queue rather than failed.
+    """
+
+    def __init__(self, key):
+        super().__init__(f"Rate limit of {key} reached, deferred to the queue.")
+        self.key = key
+
+
+def rate_limit_key(provider, account):
+    """
+    Key of the token bucket of a provider account, the account being hashed so no credential is stored.
+    """
+    return f"{provider}:{hashlib.sha256(str(account).encode()).hexdigest()[:16]}"
+
+
+class RateLimitStore:
+    """
+    Balances of the token buckets, in a SQLite database shared by the processes of the box
+    (":memory:" keeps them in the current process), so every worker draws from the same buckets.
+
+    A reservation runs in an immediate transaction: the balance of the bucket is refilled for the
+    time elapsed since its last update and the tokens are taken from it, possibly leaving it
+    negative until they have been refilled.
+    """
+
+    def __init__(self, path=":memory:"):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        if self.path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_bucket ("
+            "key TEXT PRIMARY KEY, "
+            "tokens REAL NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+
+    def reserve(self, key, rate, capacity, tokens, timeout):
+        """
+        Reserve tokens of a bucket and return the seconds to wait for them, or None if that exceeds the timeout.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Wall-clock time, the balances are shared with other processes.
+                now = time.time()
+                row = self._connection.execute(
+                    "SELECT tokens, updated_at FROM token_bucket WHERE key = ?", (key,),
+                ).fetchone()
+                balance = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+
+                wait = max(0.0, (tokens - balance) / rate)
+                if timeout is not None and wait > timeout:
+                    self._connection.execute("ROLLBACK")
+                    return None
+                self._connection.execute(
+                    "INSERT INTO token_bucket (key, tokens, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                    (key, balance - tokens, now),
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return wait
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` acquisitions per second with bursts of up to `capacity`, its
+    balance being kept in a RateLimitStore so it is shared by the processes using the same store.
+    """
+
+    def __init__(self, rate, capacity=None, key="default", store=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.key = key
+        self.store = store or RateLimitStore()
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Take tokens from the bucket, sleeping until they are available.
+
+        :param tokens: Number of tokens to take.
+        :param timeout: Maximum seconds to wait, None waits as long as needed.
+        :return: True if the tokens were taken, False if they would not be available in time.
+        """
+        wait = self.store.reserve(self.key, self.rate, self.capacity, tokens, timeout)
+        if wait:
+            time.sleep(wait)
+        return wait is not None
+
+    async def acquire_async(self, tokens=1, timeout=None):
+        """
+        Same as acquire, waiting without blocking the event loop. The reservation is a SQLite
+        transaction that can wait on other workers' locks, so it runs on a worker thread.
+        """
+        wait = await sync_to_async(self.store.reserve, thread_sensitive=False)(self.key, self.rate, self.capacity, tokens, timeout)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait is not None
+
+    def acquire_or_defer(self, tokens=1, timeout=None):
+        """
+        Take tokens from the bucket, waiting at most timeout (default RATE_LIMIT_MAX_WAIT) seconds
+        for them, and never so long that the request deadline leaves no time for the call.
+
+        :raises RateLimitExceeded: If the tokens would not be available in time.
+        """
+        if not self.acquire(tokens, self._max_wait(timeout)):
+            raise RateLimitExceeded(self.key)
+
+    async def acquire_or_defer_async(self, tokens=1, timeout=None):
+        """
+        Same as acquire_or_defer, waiting without blocking the event loop.
+        """
+        if not await self.acquire_async(tokens, self._max_wait(timeout)):
+            raise RateLimitExceeded(self.key)
+
+    @staticmethod
+    def _max_wait(timeout):
+        timeout = RATE_LIMIT_MAX_WAIT if timeout is None else timeout
+        left = remaining()
+        if left is not None:
+            timeout = max(0.0, min(timeout, left - DEADLINE_MIN_CALL_SECONDS))
+        return timeout
+
+
+_rate_limit_store = None
+_rate_limiters = dict()
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limit_store():
+    """
+    Return the process-wide rate limit store kept at the RATE_LIMIT_STORE_PATH setting.
+    """
+    global _rate_limit_store
+    if _rate_limit_store is None:
+        with _rate_limiters_lock:
+            if _rate_limit_store is None:
+                _rate_limit_store = RateLimitStore(getattr(settings, "RATE_LIMIT_STORE_PATH", ":memory:"))
+    return _rate_limit_store
+
+
+def get_rate_limiter(key, rate, capacity=None):
+    """
+    Return the token bucket for the given key, creating it on first use. Buckets with the same
+    key share their balance with the other processes using the same rate limit store.
+
+    :param key: Identifier of the limited resource, see rate_limit_key.
+    :param rate: Acquisitions allowed per second.
+    :param capacity: Maximum burst size, defaults to one second worth of tokens.
+    """
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        store = get_rate_limit_store()
+        with _rate_limiters_lock:
+            limiter = _rate_limiters.setdefault(key, TokenBucket(rate, capacity, key, store))
+    return limiter
@@ -0,0 +1,218 @@
+import os
+import re
+import copy
+import random
+import smtplib
+
+import httpx
+import requests
+from firebase_admin import exceptions as firebase_exceptions
+
+from utilities.utils import logger, CustomException
+from utilities.sqs import encode_message_body, push_messages_to_sqs, release_message_body
+from utilities.queue_backends import get_dead_letter_backend
+
+
+# Attempts of a notification, the first send included, before it goes to the dead-letter queue.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", 5))
+# Backoff in seconds before the first retry, doubled for every further attempt.
+RETRY_BASE_DELAY = int(os.getenv("RETRY_BASE_DELAY", 10))
+# Longest backoff in seconds, SQS delays a message by at most 15 minutes.
+SQS_MAX_DELAY_SECONDS = 900
+RETRY_MAX_DELAY = min(int(os.getenv("RETRY_MAX_DELAY", SQS_MAX_DELAY_SECONDS)), SQS_MAX_DELAY_SECONDS)
+
+
+class RetryableError(Exception):
+    """
+    Send failure worth retrying later, raised by the provider functions that otherwise report failures by return value.
+    """
+
+
+class DeferredError(RetryableError):
+    """
+    Send that was not attempted and is deferred to the queue instead: the provider was not called,
+    so it tells nothing about the provider's health.
+    """
+
+
+# Errors worth retrying when they carry no status code: the provider could not be reached, timed
+# out or asked to slow down.
+RETRYABLE_ERRORS = (
+    RetryableError,
+    ConnectionError,
+    TimeoutError,
+    requests.ConnectionError,
+    requests.Timeout,
+    httpx.TransportError,
+    smtplib.SMTPServerDisconnected,
+    firebase_exceptions.UnavailableError,
+    firebase_exceptions.InternalError,
+    firebase_exceptions.DeadlineExceededError,
+    firebase_exceptions.ResourceExhaustedError,
+)
+
+# Outcomes of schedule_retry.
+RETRY = "retry"
+DEAD_LETTER = "dead_letter"
+
+
+def is_retryable_http_status(status_code):
+    """
+    Rate limited (429) and server side (5xx) responses are retryable, other client errors are not.
+    """
+    return status_code == 429 or 500 <= status_code < 600
+
+
+def is_retryable_smtp_code(reply_code):
+    """
+    SMTP 4xx replies are transient failures, 5xx replies are permanent ones.
+    """
+    return 400 <= reply_code < 500
+
+
+def error_status_code(error):
+    """
+    Status code carried by a provider error: its HTTP status or its SMTP reply code, None if it has none.
+    """
+    for attribute in ("status_code", "smtp_code", "status"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    return getattr(getattr(error, "http_response", None), "status_code", None)
+
+
+class RetryPolicy:
+    """
+    Retry policy of a provider: which errors are retried, how many times and after which backoff.
+
+    The backoff before the n-th retry is a random number of seconds between 0 and
+    min(max_delay, base_delay * 2 ** (n - 1)) ("full jitter"), so the retries of a burst of
+    failures do not reach the provider all together.
+    """
+
+    def __init__(self, retryable_status=is_retryable_http_status, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.retryable_status = retryable_status
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        """
+        Whether a send that raised error may succeed later. A CustomException raised from a provider
+        error is classified by that error.
+        """
+        if isinstance(error, CustomException) and error.__cause__ is not None:
+            return self.is_retryable(error.__cause__)
+        status_code = error_status_code(error)
+        if status_code is not None:
+            return self.retryable_status(status_code)
+        return isinstance(error, RETRYABLE_ERRORS)
+
+    def delay(self, attempt):
+        """
+        Seconds to wait before retrying a send whose attempt-th attempt failed.
+        """
+        return round(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+
+
+RETRY_POLICIES = {
+    "sendgrid": RetryPolicy(),
+    "smtp": RetryPolicy(is_retryable_smtp_code),
+    "twilio": RetryPolicy(),
+    "firebase": RetryPolicy(),
+    "firebase_v1": RetryPolicy(),
+}
+
+
+def get_retry_policy(provider_type):
+    """
+    Return the retry policy of a provider, the HTTP one for providers without a policy of their own.
+    """
+    return RETRY_POLICIES.get(provider_type) or RETRY_POLICIES["sendgrid"]
+
+
+def failure_details(provider_type, error):
+    """
+    Details of a failed email result, flagging the failures worth retrying and the deferred sends.
+    """
+    if isinstance(error, DeferredError):
+        return {"retryable": True, "deferred": True}
+    return {"retryable": True} if get_retry_policy(provider_type).is_retryable(error) else {}
+
+
+def _retry_idempotency_key(idempotency_key, attempt):
+    # A retry may only carry the failed part of a notification, so it gets a key of its own and the
+    # part already sent does not suppress it as a duplicate.
+    return f"{re.sub(r':retry[0-9]+$', '', idempotency_key)}:retry{attempt}"
+
+
+def schedule_retry(message, error):
+    """
+    Re-enqueue a notification whose send failed with a retryable error, delayed by the backoff of
+    its provider's policy, or move it to the dead-letter queue once its attempts are exhausted.
+
+    :param message: Queue message of the failed send; its "attempt" (1 if missing) is the attempt that failed.
+    :param error: Description of the failure, kept on a dead-lettered message.
+    :return: RETRY or DEAD_LETTER, None if the message could not be enqueued.
+    """
+    attempt = message.get("attempt", 1)
+    policy = get_retry_policy(message.get("provider_type"))
+    if attempt >= policy.max_attempts:
+        logger.warning(f"Giving up on {message.get('service_type')} message after {attempt} attempts: {error}")
+        return DEAD_LETTER if dead_letter(message, error) else None
+
+    service_data = dict(message["service_data"])
+    if service_data.get("idempotency_key"):
+        service_data["idempotency_key"] = _retry_idempotency_key(service_data["idempotency_key"], attempt + 1)
+    delay = policy.delay(attempt)
+    failed_messages = push_messages_to_sqs(
+        [{**message, "service_data": service_data, "attempt": attempt + 1}], delay_seconds=delay,
+    )
+    if failed_messages:
+        logger.error(f"Failed to schedule the retry of a {message.get('service_type')} message: {failed_messages[0][1]}")
+        return None
+    logger.info(f"Scheduled attempt {attempt + 1} of a {message.get('service_type')} message in {delay} seconds.")
+    return RETRY
+
+
+def dead_letter(message, error):
+    """
+    Move a notification that will not be retried to the dead-letter queue, with the error of its last attempt.
+
+    :return: True if the message was enqueued.
+    """
+    try:
+        backend = get_dead_letter_backend()
+        message_body = encode_message_body({**message, "errors": error})
+        failed_messages = backend.send_messages([message_body])
+    except (ValueError, OSError) as e:
+        logger.error(f"Dead-letter queue is not setup: {e}")
+        return False
+    if failed_messages:
+        release_message_body(message_body)
+        logger.error(f"Failed to dead-letter a {message.get('service_type')} message: {failed_messages[0][1]}")
+        return False
+    logger.warning(f"Dead-lettered a {message.get('service_type')} message: {error}")
+    return True
+
+
+def schedule_payload_retries(service_type, provider_type, priority, retry_payload):
+    """
+    Schedule the retry of the payload items of a request that failed with a retryable error.
+
+    :param retry_payload: List of (item, service_data, error) tuples, item being reported back to the caller.
+    :return: A tuple (retried_payload, failed_payload) of copies of the items with their errors,
+             the failed ones being those that could not be scheduled.
+    """
+    retried_payload, failed_payload = list(), list()
+    for item, service_data, error in retry_payload:
+        outcome = schedule_retry({
+            "provider_type": provider_type,
+            "service_type": service_type,
+            "priority": priority,
+            "service_data": service_data,
+        }, error)
+        item_copy = copy.deepcopy(item)
+        item_copy["errors"] = error
+        (retried_payload if outcome == RETRY else failed_payload).append(item_copy)
+    return retried_payload, failed_payload
@@ -1,83 +1,232 @@
 import os
 import json
-import boto3
-from botocore.exceptions import ClientError
+import zlib
+import base64
+import atexit
+import threading
 
-from utilities.utils import logger, CustomException
+from django.conf import settings
 
+from utilities.utils import logger
+from utilities.constants import DEFAULT_PRIORITY, PRIORITY_CHOICES
+from utilities.queue_backends import get_queue_backend
+from utilities.storage import get_blob_store
 
-try:
-    sqs = boto3.client(
-        'sqs',
-        region_name=os.getenv("AWS_REGION"),
-        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
-        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
-    )
-except Exception:
-    sqs = None
 
+# Batch size used to acknowledge messages, the most SQS accepts in one DeleteMessageBatch call.
+ACKNOWLEDGE_BATCH_SIZE = 10
+# Message bodies larger than this are zlib compressed, 0 disables compression.
+SQS_COMPRESS_MIN_BYTES = int(os.getenv("SQS_COMPRESS_MIN_BYTES", 16 * 1024))
+# Bodies still larger than this once compressed go to the blob store and the message only carries
+# a reference; SQS bills every 64 KiB of a message as one request and rejects more than 256 KiB.
+SQS_CLAIM_CHECK_MIN_BYTES = int(os.getenv("SQS_CLAIM_CHECK_MIN_BYTES", 64 * 1024))
 
-def push_message_to_sqs(message):
-    if sqs is None:
-        CustomException("SQS is not setup.")
-    try:
-        response = sqs.send_message(
-            QueueUrl=os.getenv("SQS_URL"),
-            MessageBody=json.dumps(message),
-            DelaySeconds=10,
-        )
-        if response.get("ResponseMetadata").get("HTTPStatusCode", None) == 200:
-            # Message sent successfully.
-            logger.info("Message sent successfully to SQS.")
 
-    except sqs.exceptions.InvalidMessageContents:
-        # Invalid message content.
-        logger.error("Message sent successfully to SQS.")
+def encode_message_body(message, compress_min_bytes=None, claim_check_min_bytes=None):
+    """
+    Serialize a queue message, compressing large bodies and offloading the largest to the blob store.
+
+    Small messages stay plain JSON. A compressed body is sent as {"encoding": "zlib", "body": <base64>}
+    and an offloaded one as {"encoding": "zlib" or "json", "claim_check": <blob id>}.
+
+    :param message: Message dictionary to enqueue.
+    :return: The message body string.
+    :raises OSError: If the body could not be written to the blob store.
+    """
+    compress_min_bytes = SQS_COMPRESS_MIN_BYTES if compress_min_bytes is None else compress_min_bytes
+    claim_check_min_bytes = SQS_CLAIM_CHECK_MIN_BYTES if claim_check_min_bytes is None else claim_check_min_bytes
 
-    except sqs.exceptions.UnsupportedOperation:
-        # Unsupported operation.
-        logger.error("Unsupported operation.")
+    body = json.dumps(message)
+    # The thresholds and the SQS limits are in bytes, not characters.
+    encoding, content = "json", body.encode("utf-8")
+    if (not compress_min_bytes or len(content) <= compress_min_bytes) and len(content) <= claim_check_min_bytes:
+        return body
 
+    if compress_min_bytes and len(content) > compress_min_bytes:
+        encoding, content = "zlib", zlib.compress(content)
+        encoded_body = json.dumps({"encoding": encoding, "body": base64.b64encode(content).decode()})
+        if len(encoded_body.encode("utf-8")) <= claim_check_min_bytes:
+            return encoded_body
 
-def receiver_message_sqs(receipt_handle):
+    blob_id = get_blob_store().save([content])
+    logger.info(f"Offloaded a {len(content)} bytes queue message body to blob {blob_id}.")
+    return json.dumps({"encoding": encoding, "claim_check": blob_id})
+
+
+def decode_message_body(message_body):
+    """
+    Decode a body produced by encode_message_body, fetching offloaded bodies from the blob store.
+
+    :param message_body: The JSON string stored in the queue message.
+    :return: The message dictionary.
+    :raises OSError: If an offloaded body could not be read from the blob store.
     """
-    Retrieve a message from an SQS queue using the receipt handle.
+    message = json.loads(message_body)
+    if not isinstance(message, dict) or "encoding" not in message:
+        return message
+
+    if "claim_check" in message:
+        content = get_blob_store().read(message["claim_check"])
+    else:
+        content = base64.b64decode(message["body"])
+    if message["encoding"] == "zlib":
+        content = zlib.decompress(content)
+    return json.loads(content)
+
 
-    :param receipt_handle: The receipt handle of the message to retrieve.
-    :return: The message body if successful, otherwise None.
+def release_message_body(message_body):
+    """
+    Delete the blob an offloaded body references, once its message is acknowledged or could not
+    be enqueued; other bodies hold nothing to release. Errors are logged, not raised.
+
+    :param message_body: The JSON string of the queue message.
     """
-    if sqs is None:
-        CustomException("SQS is not setup.")
     try:
-        # Receive the message from the queue
-        response = sqs.receive_message(
-            QueueUrl=os.getenv("SQS_URL"),
-            AttributeNames=['All'],
-            MaxNumberOfMessages=1,
-            VisibilityTimeout=0,
-            WaitTimeSeconds=0
-        )
-
-        # Check if messages are returned
-        messages = response.get('Messages', [])
-        if not messages:
-            print("No messages in the queue.")
-            return None
-
-        # Loop through messages and find the one with the matching receipt handle
-        for message in messages:
-            if message['ReceiptHandle'] == receipt_handle:
-                sqs.delete_message(
-                    QueueUrl=os.getenv("SQS_URL"),
-                    ReceiptHandle=receipt_handle
-                )
-                # Print out the message body
-                print(f"Message received: {message['Body']}")
-                return message['Body']
-
-        print("No message found with the given receipt handle.")
-        return None
-
-    except ClientError as e:
-        print(f"An error occurred: {e}")
-        return None
+        message = json.loads(message_body)
+        if isinstance(message, dict) and "claim_check" in message:
+            get_blob_store().delete(message["claim_check"])
+            logger.debug(f"Released queue message blob {message['claim_check']}.")
+    except (ValueError, TypeError, OSError) as e:
+        logger.error(f"Failed to release queue message body: {e}")
+
+
+def push_messages_to_sqs(messages, delay_seconds=None):
+    """
+    Push several messages to the queues of their priority lanes using batch calls.
+
+    Each message goes to the lane named by its "priority" key ("default" if missing), with the
+    delay configured for that lane in QUEUE_PRIORITY_LANES.
+
+    :param messages: List of message dictionaries to enqueue.
+    :param delay_seconds: Seconds before the messages can be received, instead of the delay of their lane.
+    :return: List of (index, error) tuples for the messages that could not be enqueued,
+             where index is the position of the message in the given list.
+    """
+    lanes = dict()
+    for index, message in enumerate(messages):
+        lanes.setdefault(message.get("priority", DEFAULT_PRIORITY), list()).append(index)
+
+    failed_messages = list()
+    for priority, lane_indexes in lanes.items():
+        try:
+            backend = get_queue_backend(priority)
+        except Exception as e:
+            logger.error(f"Queue is not setup: {e}")
+            failed_messages.extend((index, "SQS is not setup.") for index in lane_indexes)
+            continue
+
+        bodies, indexes = list(), list()
+        for index in lane_indexes:
+            try:
+                bodies.append(encode_message_body(messages[index]))
+                indexes.append(index)
+            except OSError as e:
+                logger.error(f"Failed to offload queue message body: {e}")
+                failed_messages.append((index, str(e)))
+
+        # Map the positions of the sent bodies back to the given messages.
+        lane_delay_seconds = settings.QUEUE_PRIORITY_LANES[priority]["delay_seconds"] if delay_seconds is None else delay_seconds
+        for index, error in backend.send_messages(bodies, delay_seconds=lane_delay_seconds):
+            release_message_body(bodies[index])
+            failed_messages.append((indexes[index], error))
+    return sorted(failed_messages)
+
+
+def push_message_to_sqs(message):
+    """
+    Push a single message to the configured queue.
+
+    :param message: Message dictionary to enqueue.
+    :return: True if the message was enqueued.
+    """
+    return not push_messages_to_sqs([message])
+
+
+class SQSAcknowledger:
+    """
+    Class for acknowledging processed queue messages by receipt handle.
+
+    Receipt handles are collected and deleted in batches once `batch_size` handles are pending
+    or `flush_interval` seconds have passed since the first one. Without a backend, the messages
+    are deleted from the queue of the `priority` lane. The blobs of offloaded bodies are deleted
+    along with their messages.
+    """
+
+    def __init__(self, backend=None, batch_size=ACKNOWLEDGE_BATCH_SIZE, flush_interval=1.0, priority=DEFAULT_PRIORITY):
+        self.backend = backend
+        self.priority = priority
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = list()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def acknowledge(self, receipt_handle, message_body=None):
+        """
+        Mark a message as processed so it gets deleted from the queue.
+
+        :param receipt_handle: The receipt handle of the processed message.
+        :param message_body: The body of the message, whose blob is deleted with it if it was offloaded.
+        """
+        with self._lock:
+            self._pending.append((receipt_handle, message_body))
+            if len(self._pending) < self.batch_size:
+                if self._timer is None and self.flush_interval > 0:
+                    self._timer = threading.Timer(self.flush_interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            entries = self._take_pending()
+        self._delete(entries)
+
+    def flush(self):
+        """
+        Delete every pending receipt handle right away.
+        """
+        with self._lock:
+            entries = self._take_pending()
+        self._delete(entries)
+
+    def _take_pending(self):
+        entries, self._pending = self._pending, list()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return entries
+
+    def _delete(self, entries):
+        if not entries:
+            return
+        try:
+            backend = self.backend or get_queue_backend(self.priority)
+            backend.delete_messages([receipt_handle for receipt_handle, _ in entries])
+        except Exception as e:
+            # The messages become visible again and will be redelivered, their blobs are kept.
+            logger.error(f"Failed to acknowledge {len(entries)} messages: {e}")
+            return
+        for _, message_body in entries:
+            if message_body is not None:
+                release_message_body(message_body)
+
+
+acknowledgers = {
+    priority: SQSAcknowledger(
+        batch_size=int(os.getenv("SQS_DELETE_BATCH_SIZE", ACKNOWLEDGE_BATCH_SIZE)),
+        flush_interval=float(os.getenv("SQS_DELETE_FLUSH_INTERVAL", 1.0)),
+        priority=priority,
+    )
+    for priority in PRIORITY_CHOICES
+}
+for _acknowledger in acknowledgers.values():
+    atexit.register(_acknowledger.flush)
+
+
+def acknowledge_message_sqs(receipt_handle, priority=DEFAULT_PRIORITY, message_body=None):
+    """
+    Acknowledge a processed queue message using the shared acknowledger of its priority lane.
+
+    :param receipt_handle: The receipt handle of the processed message.
+    :param priority: Priority lane the message was received from.
+    :param message_body: The body of the message, whose blob is deleted with it if it was offloaded.
+    """
+    acknowledgers.get(priority, acknowledgers[DEFAULT_PRIORITY]).acknowledge(receipt_handle, message_body)
@@ -0,0 +1,265 @@
+import os
+import re
+import mmap
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+
+from utilities import messages
+from utilities.utils import logger
+
+
+FILE_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def check_file_id(file_id):
+    """
+    Ensure a file id is a SHA-256 hex digest, so it can be used in paths and keys safely.
+
+    :raises ValueError: If the id is not a SHA-256 hex digest.
+    """
+    if not isinstance(file_id, str) or not FILE_ID_PATTERN.match(file_id):
+        raise ValueError(f"Invalid file id: {file_id}")
+    return file_id
+
+
+class BaseFileStore:
+    """
+    Interface of the content-addressed stores holding uploaded attachments and offloaded queue bodies.
+
+    A file is identified by the SHA-256 hex digest of its content, so saving the same content twice
+    returns the same id.
+    """
+
+    def save(self, chunks):
+        """
+        Store the content given as an iterable of bytes chunks and return its file id.
+        """
+        raise NotImplementedError
+
+    def open(self, file_id):
+        """
+        Context manager yielding the content of a file as a bytes-like object.
+
+        :raises FileNotFoundError: If no file has the given id.
+        """
+        raise NotImplementedError
+
+    def exists(self, file_id):
+        raise NotImplementedError
+
+    def delete(self, file_id):
+        raise NotImplementedError
+
+    def read(self, file_id):
+        """
+        Return the content of a file as bytes.
+        """
+        with self.open(file_id) as content:
+            return bytes(content)
+
+
+class LocalFileStore(BaseFileStore):
+    """
+    Content-addressed file store on the local disk.
+
+    A file is identified by the SHA-256 hex digest of its content and stored once under
+    `<root>/<first two characters of the id>/<id>`; saving the same content again returns the same
+    id without writing it twice. Files are read through a read-only mmap, so several emails using
+    one file share the page cache instead of each holding a copy.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, file_id):
+        """
+        Path of the file with the given id.
+
+        :raises ValueError: If the id is not a SHA-256 hex digest.
+        """
+        check_file_id(file_id)
+        return os.path.join(self.root, file_id[:2], file_id)
+
+    def exists(self, file_id):
+        try:
+            return os.path.isfile(self.path(file_id))
+        except ValueError:
+            return False
+
+    def size(self, file_id):
+        return os.path.getsize(self.path(file_id))
+
+    def save(self, chunks):
+        """
+        Store the content given as an iterable of bytes chunks and return its file id.
+
+        The content is hashed while it is written to a temporary file, which is then moved into
+        place atomically, so a reader never sees a partially written file.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        descriptor, temp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(descriptor, "wb") as temp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            file_id = digest.hexdigest()
+            path = self.path(file_id)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+                logger.info(f"Stored file {file_id}.")
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return file_id
+
+    @contextmanager
+    def open(self, file_id):
+        """
+        Context manager yielding the content of a file as a read-only mmap (bytes for an empty file).
+
+        :raises FileNotFoundError: If no file has the given id.
+        """
+        try:
+            file = open(self.path(file_id), "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(messages.DOES_NOT_EXIST.format(f"File {file_id}")) from None
+        with file:
+            if os.fstat(file.fileno()).st_size == 0:
+                yield b""
+                return
+            content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield content
+            finally:
+                content.close()
+
+    def delete(self, file_id):
+        try:
+            os.remove(self.path(file_id))
+        except FileNotFoundError:
+            pass
+
+
+class S3FileStore(BaseFileStore):
+    """
+    Content-addressed file store in an Amazon S3 bucket, for consumers running on other hosts.
+
+    Files are stored under `<prefix><id>`; boto3 errors are raised as OSError, FileNotFoundError
+    for a missing file.
+    """
+
+    def __init__(self, bucket, prefix="", client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        The boto3 S3 client, created on first use.
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client(
+                        's3',
+                        region_name=os.getenv("AWS_REGION"),
+                        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+                        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+                    )
+        return self._client
+
+    def key(self, file_id):
+        return f"{self.prefix}{check_file_id(file_id)}"
+
+    def save(self, chunks):
+        content = b"".join(chunks)
+        file_id = hashlib.sha256(content).hexdigest()
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.key(file_id), Body=content)
+        except (BotoCoreError, ClientError) as e:
+            raise OSError(f"Failed to store file {file_id}: {e}") from e
+        logger.info(f"Stored file {file_id} in S3.")
+        return file_id
+
+    @contextmanager
+    def open(self, file_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(file_id))
+            content = response["Body"].read()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise FileNotFoundError(messages.DOES_NOT_EXIST.format(f"File {file_id}")) from None
+            raise OSError(f"Failed to read file {file_id}: {e}") from e
+        except BotoCoreError as e:
+            raise OSError(f"Failed to read file {file_id}: {e}") from e
+        yield content
+
+    def exists(self, file_id):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(file_id))
+        except ValueError:
+            return False
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return False
+            raise OSError(f"Failed to check file {file_id}: {e}") from e
+        return True
+
+    def delete(self, file_id):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(file_id))
+        except (BotoCoreError, ClientError) as e:
+            raise OSError(f"Failed to delete file {file_id}: {e}") from e
+
+
+_file_store = None
+_file_store_lock = threading.Lock()
+
+
+def get_file_store():
+    """
+    Return the process-wide file store rooted at the FILE_STORE_PATH setting.
+    """
+    global _file_store
+    if _file_store is None:
+        with _file_store_lock:
+            if _file_store is None:
+                _file_store = LocalFileStore(settings.FILE_STORE_PATH)
+    return _file_store
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """
+    Return the process-wide store of offloaded queue bodies selected by the BLOB_STORE_BACKEND
+    setting ('local' or 's3').
+    """
+    global _blob_store
+    if _blob_store is None:
+        with _file_store_lock:
+            if _blob_store is None:
+                backend_name = getattr(settings, "BLOB_STORE_BACKEND", "local")
+                if backend_name == "local":
+                    _blob_store = LocalFileStore(settings.BLOB_STORE_PATH)
+                elif backend_name == "s3":
+                    _blob_store = S3FileStore(settings.BLOB_STORE_BUCKET, settings.BLOB_STORE_PREFIX)
+                else:
+                    raise ValueError(f"Unsupported blob store: {backend_name}")
+                logger.info(f"Using {backend_name} blob store.")
+    return _blob_store